@@ -0,0 +1,81 @@
+"""
+Per-turn overhead of logging in the chat request path.
+
+Runs ChatModelService.generate_response_langchain() against a fake chat llm (no network),
+with a tool call on every turn, over a prefilled chat history. Each turn is timed with logging
+at DEBUG (formatted and written to os.devnull) and at WARNING (debug records disabled).
+
+    python benchmarks/bench_logging.py --history 500 --turns 200
+"""
+from pathlib import Path
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from langchain_core.messages import AIMessage
+from services.chat_history import InMemoryChatHistoryManager
+from services.chat_model import ChatModelService, MyCustomHandler
+from utils import setup_logging
+
+
+class FakeChatLLM:
+    """Answers every other call with a get_weather tool call, and runs the callback handler like ChatTogether does."""
+
+    def __init__(self):
+        self.calls = 0
+        self.handler = MyCustomHandler()
+
+    def invoke(self, messages):
+        self.handler.on_chat_model_start({}, [messages], run_id=None)
+        self.calls += 1
+        if self.calls % 2:
+            return AIMessage(content="", tool_calls=[
+                {"name": "get_weather", "args": {"location": "San Francisco"}, "id": f"call_{self.calls}"}])
+        return AIMessage(content="It is 60 degrees and foggy in San Francisco.")
+
+
+def make_history(size: int) -> InMemoryChatHistoryManager:
+    history = InMemoryChatHistoryManager()
+    for i in range(size // 2):
+        history.add_human_message(f"Question {i}: what is the weather like in San Francisco today?")
+        history.add_ai_message(f"Answer {i}: it is 60 degrees and foggy in San Francisco. " * 3)
+    return history
+
+
+def run(level: str, history_size: int, turns: int) -> list:
+    with open(os.devnull, "w") as devnull:
+        setup_logging(level, fmt="color", stream=devnull, force=True)
+        service = ChatModelService("fake-api-key")
+        service.chat_llm = FakeChatLLM()
+        service.set_chat_history(make_history(history_size))
+        timings = []
+        for i in range(turns):
+            start = time.perf_counter()
+            service.generate_response_langchain(f"What is the weather in San Francisco? ({i})")
+            timings.append(time.perf_counter() - start)
+        service.tool_manager.shutdown()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--history", type=int, default=500, help="messages in the chat history before the first turn")
+    parser.add_argument("--turns", type=int, default=200)
+    args = parser.parse_args()
+
+    results = {level: run(level, args.history, args.turns) for level in ("DEBUG", "WARNING")}
+    print(f"{args.turns} turns, history starts at {args.history} messages")
+    print(f"{'level':<8} {'mean ms':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    for level, timings in results.items():
+        ms = sorted(t * 1000 for t in timings)
+        print(f"{level:<8} {statistics.mean(ms):9.3f} {ms[len(ms) // 2]:9.3f} {ms[int(len(ms) * 0.99)]:9.3f}")
+    overhead = statistics.mean(results["DEBUG"]) / statistics.mean(results["WARNING"])
+    print(f"DEBUG logging costs {overhead:.1f}x the per-turn time of WARNING")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Memory per chat history message, langchain message objects in a list vs CompactMessageStore.
+
+Builds --sessions chat histories of --turns turns each. Every turn is a human question, an AI tool
+call with the response metadata Together returns, a tool result and an AI answer, and every session
+starts with the same system prompt. Reports the bytes allocated per message (tracemalloc) for each
+representation, and the time to build the context list for one LLM request from each.
+
+    python benchmarks/bench_memory.py --sessions 200 --turns 25
+"""
+from pathlib import Path
+import argparse
+import gc
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+from services.chat_model import ChatModelService
+from services.message_store import CompactMessageStore
+
+
+CITIES = ["San Francisco", "New York", "Chicago", "Austin", "Seattle", "Denver", "Boston", "Miami"]
+
+
+def session_messages(service: ChatModelService, session: int, turns: int):
+    """Messages of one session, with content varying between sessions like real chats."""
+    yield SystemMessage(content=service.get_system_message())
+    for turn in range(turns):
+        city = CITIES[(session + turn) % len(CITIES)]
+        call_id = f"call_{session}_{turn}"
+        yield HumanMessage(content=f"What is the weather like in {city} today? Asking for trip {session}-{turn}.")
+        yield AIMessage(
+            content="", id=f"run-{session:08x}-{turn:08x}",
+            tool_calls=[{"name": "get_weather", "args": {"location": city}, "id": call_id}],
+            response_metadata={"token_usage": {"completion_tokens": 18, "prompt_tokens": 240 + turn * 90,
+                                               "total_tokens": 258 + turn * 90},
+                               "model_name": "meta-llama/Llama-3.3-70B-Instruct-Turbo",
+                               "system_fingerprint": None, "finish_reason": "tool_calls", "logprobs": None},
+            usage_metadata={"input_tokens": 240 + turn * 90, "output_tokens": 18, "total_tokens": 258 + turn * 90})
+        yield ToolMessage(content=f"It's 60 degrees and foggy in {city}.", name="get_weather", tool_call_id=call_id)
+        yield AIMessage(
+            content=f"It is currently 60 degrees and foggy in {city}, so bring a light jacket for trip {session}-{turn}.",
+            id=f"run-{session:08x}-{turn:08x}-answer",
+            response_metadata={"token_usage": {"completion_tokens": 25, "prompt_tokens": 280 + turn * 90,
+                                               "total_tokens": 305 + turn * 90},
+                               "model_name": "meta-llama/Llama-3.3-70B-Instruct-Turbo",
+                               "system_fingerprint": None, "finish_reason": "stop", "logprobs": None},
+            usage_metadata={"input_tokens": 280 + turn * 90, "output_tokens": 25, "total_tokens": 305 + turn * 90})
+
+
+def measure(build, service: ChatModelService, sessions: int, turns: int):
+    """(bytes allocated and still held per message, the histories) for histories built by build(messages)."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    histories = [build(session_messages(service, s, turns)) for s in range(sessions)]
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    count = sum(len(h) for h in histories)
+    return held / count, histories
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=200)
+    parser.add_argument("--turns", type=int, default=25, help="turns per session, 4 messages each")
+    args = parser.parse_args()
+
+    service = ChatModelService("unused")
+    # build a session of each outside the measurement, so neither run pays one time import costs
+    list(session_messages(service, 0, 1))
+    CompactMessageStore(session_messages(service, 0, 1))
+
+    results = {}
+    for name, build in (("list of messages", list), ("CompactMessageStore", CompactMessageStore)):
+        per_message, histories = measure(build, service, args.sessions, args.turns)
+        start = time.perf_counter()
+        for history in histories[:20]:
+            list(history)
+        context_ms = (time.perf_counter() - start) / min(20, len(histories)) * 1000
+        results[name] = per_message
+        print(f"{name:>22}: {per_message:8.0f} bytes/message, {context_ms:7.2f} ms to read a session's "
+              f"{len(histories[0])} messages")
+        del histories
+
+    saved = 1 - results["CompactMessageStore"] / results["list of messages"]
+    print(f"{args.sessions} sessions x {args.turns * 4 + 1} messages, CompactMessageStore uses {saved:.0%} less memory")
+
+
+if __name__ == "__main__":
+    main()
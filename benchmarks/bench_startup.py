@@ -0,0 +1,103 @@
+"""
+Cold start benchmark: import time profile, ChatModelService construction, first request setup,
+and streamlit time to first render, each measured in a fresh interpreter.
+
+    python benchmarks/bench_startup.py             # summary plus the 15 slowest imports
+    python benchmarks/bench_startup.py --top 40 --repeat 5 --json startup.json
+
+Import times come from python -X importtime. Time to first render runs src/streamlit_app.py
+with streamlit's AppTest, which executes the script once the way a first page load does.
+No network is used, the API key is a placeholder.
+"""
+from pathlib import Path
+from typing import Dict, List, Tuple
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+
+SRC_DIR = Path(__file__).resolve().parents[1] / "src"
+ENV = {**os.environ, "PYTHONPATH": str(SRC_DIR), "TOGETHER_API_KEY": "stub-api-key", "LOG_LEVEL": "WARNING"}
+
+# each snippet prints the seconds it measured
+SERVICE_SNIPPET = """
+import time
+start = time.perf_counter()
+from services.chat_model import ChatModelService
+imported = time.perf_counter()
+service = ChatModelService("stub-api-key")
+constructed = time.perf_counter()
+service.warm_up()
+warmed = time.perf_counter()
+print(imported - start, constructed - imported, warmed - constructed)
+"""
+FIRST_RENDER_SNIPPET = """
+import time
+start = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+app = AppTest.from_file({app_path!r}, default_timeout=120)
+app.run()
+assert not app.exception, app.exception
+print(time.perf_counter() - start)
+"""
+
+
+def run_python(args: List[str]) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, *args], cwd=SRC_DIR, env=ENV, capture_output=True, text=True, check=True)
+
+
+def import_profile(module: str) -> Tuple[float, List[Tuple[str, int, int]]]:
+    """Seconds to import module and (module, self us, cumulative us) for every module imported at startup."""
+    stderr = run_python(["-X", "importtime", "-c", f"import {module}"]).stderr
+    rows = []
+    total_us = 0
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = (part.strip() if i == 2 else int(part)
+                                        for i, part in enumerate(line[len("import time:"):].split("|")))
+        rows.append((name, self_us, cumulative_us))
+        if name == module:
+            total_us = cumulative_us  # includes everything module imported
+    return total_us / 1e6, rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="streamlit_app", help="module to profile imports of")
+    parser.add_argument("--top", type=int, default=15, help="slowest imports to list")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement, the median is reported")
+    parser.add_argument("--no-render", action="store_true", help="skip the streamlit time to first render")
+    parser.add_argument("--json", type=Path, help="also write the results to this file")
+    args = parser.parse_args()
+
+    profiles = [import_profile(args.module) for _ in range(args.repeat)]
+    results: Dict[str, float] = {f"import {args.module} s": statistics.median(p[0] for p in profiles)}
+
+    service_runs = [[float(x) for x in run_python(["-c", SERVICE_SNIPPET]).stdout.split()] for _ in range(args.repeat)]
+    results["import services.chat_model s"] = statistics.median(r[0] for r in service_runs)
+    results["ChatModelService() s"] = statistics.median(r[1] for r in service_runs)
+    results["first request setup (warm_up) s"] = statistics.median(r[2] for r in service_runs)
+
+    if not args.no_render:
+        snippet = FIRST_RENDER_SNIPPET.format(app_path=str(SRC_DIR / "streamlit_app.py"))
+        results["time to first render s"] = statistics.median(
+            float(run_python(["-c", snippet]).stdout.split()[-1]) for _ in range(args.repeat))
+
+    for name, seconds in results.items():
+        print(f"{name:<36} {seconds:8.3f}")
+
+    # slowest modules by cumulative time, from the last profile
+    print(f"\nslowest imports under {args.module}, cumulative ms (self ms)")
+    for name, self_us, cumulative_us in sorted(profiles[-1][1], key=lambda r: r[2], reverse=True)[:args.top]:
+        print(f"{cumulative_us / 1000:10.1f} ({self_us / 1000:7.1f})  {name}")
+
+    if args.json:
+        args.json.write_text(json.dumps({"results": results, "imports": profiles[-1][1]}, indent=2) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""
+Offline benchmarks of the chat request path against the local Together API stub (stub_server.py).
+
+Drives ChatModelService and ToolManager through scripted scenarios and reports throughput,
+p50/p99 turn latency and peak traced memory per scenario. Results are compared against
+benchmarks/baseline.json, and the run fails if any scenario regressed by more than --tolerance.
+
+    python benchmarks/run_benchmarks.py                  # run and compare with the baseline
+    python benchmarks/run_benchmarks.py --save-baseline  # run and store the results as the new baseline
+    python benchmarks/run_benchmarks.py --quick -s tool_calls -s long_history
+    python benchmarks/run_benchmarks.py -s streaming_tools_serial -s streaming_tools_overlapped
+
+Baselines are only comparable on the same machine, so store one before changing code.
+"""
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, List
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from langchain_core.messages import AIMessage
+from langchain_core.tools import tool
+from services.chat_history import InMemoryChatHistoryManager
+from services.chat_model import ChatModelService
+from services.tool_manager import ToolManager
+from services.tool_registry import ToolRegistry
+from stub_server import StubServer
+from utils import setup_logging
+
+
+BASELINE_FILE = Path(__file__).resolve().parent / "baseline.json"
+# metrics where a bigger value is a regression, throughput is the other way round
+LOWER_IS_BETTER = ("p50_ms", "p99_ms", "peak_kib")
+# seconds the get_weather tool of the streaming_tools scenarios takes, by city suffix, like a real weather API
+SLOW_TOOL_SECONDS = {"a": 0.1, "b": 0.05, "c": 0.02}
+# seconds per streamed chunk in the streaming_tools scenarios, about one token of a 70B model
+STREAMING_TOOLS_CHUNK_DELAY = 0.01
+
+
+@dataclass
+class Scenario:
+    name: str
+    description: str
+    turns: int
+    # called once before timing, returns the function that runs turn i
+    setup: Callable[[str], Callable[[int], None]]
+    # stub server seconds between streamed chunks
+    chunk_delay: float = 0.0
+
+
+def make_service(base_url: str, history_size: int = 0) -> ChatModelService:
+    service = ChatModelService("stub-api-key", base_url=base_url)
+    history = InMemoryChatHistoryManager()
+    service.set_chat_history(history)
+    for i in range(history_size // 2):
+        history.add_human_message(f"Question {i}: tell me something interesting about the number {i}.")
+        history.add_ai_message(f"Answer {i}: {i} is a fine number, " * 8)
+    return service
+
+
+def chat_scenario(base_url: str) -> Callable[[int], None]:
+    service = make_service(base_url)
+    return lambda i: service.generate_response_langchain(f"Hello, this is message {i}.")
+
+
+def tool_calls_scenario(base_url: str) -> Callable[[int], None]:
+    service = make_service(base_url)
+    # new cities every turn, so the tool result cache does not hide the tool calls
+    return lambda i: service.generate_response_langchain(f"What is the weather in City{i}a, City{i}b and City{i}c?")
+
+
+def long_history_scenario(base_url: str) -> Callable[[int], None]:
+    service = make_service(base_url, history_size=2000)
+    return lambda i: service.generate_response_langchain(f"And what about the number {i}?")
+
+
+def streaming_scenario(base_url: str) -> Callable[[int], None]:
+    service = make_service(base_url)
+
+    def turn(i: int) -> None:
+        for _ in service.stream_response_langchain(f"What is the weather in City{i}a and City{i}b?"):
+            pass
+    return turn
+
+
+def slow_tool_registry() -> ToolRegistry:
+    @tool
+    def get_weather(location: str):
+        """Call to get the current weather."""
+        time.sleep(SLOW_TOOL_SECONDS[location[-1]])
+        return f"It's 60 degrees and foggy in {location}."
+
+    registry = ToolRegistry()
+    registry.register(get_weather)
+    return registry
+
+
+def streaming_tools_scenario(prefetch: bool) -> Callable[[str], Callable[[int], None]]:
+    """Streamed turns with 3 tool calls of different latency, the tools run after the stream, or prefetched
+    while it is still streaming."""
+    def setup(base_url: str) -> Callable[[int], None]:
+        service = make_service(base_url)
+        service.tool_manager = ToolManager(registry=slow_tool_registry(), cache_policies={},
+                                           prefetch_tools=["get_weather"] if prefetch else [])
+
+        def turn(i: int) -> None:
+            for _ in service.stream_response_langchain(f"What is the weather in City{i}a, City{i}b and City{i}c?"):
+                pass
+        return turn
+    return setup
+
+
+def tool_manager_scenario(base_url: str) -> Callable[[int], None]:
+    tool_manager = ToolManager(cache_policies={})
+
+    def turn(i: int) -> None:
+        tool_calls = [{"name": "get_weather", "args": {"location": f"City{i}-{n}"}, "id": f"call_{i}_{n}", "type": "tool_call"}
+                      for n in range(8)]
+        tool_manager.execute_tool_calls(AIMessage(content="", tool_calls=tool_calls))
+    return turn
+
+
+SCENARIOS = [
+    Scenario("chat", "one LLM call per turn, no tools", 200, chat_scenario),
+    Scenario("tool_calls", "3 parallel tool calls and 2 LLM calls per turn", 100, tool_calls_scenario),
+    Scenario("long_history", "plain turns over a 2000 message history", 50, long_history_scenario),
+    Scenario("streaming", "streamed responses with 2 tool calls per turn", 100, streaming_scenario),
+    Scenario("tool_manager", "ToolManager only, 8 uncached tool calls per turn", 500, tool_manager_scenario),
+    Scenario("streaming_tools_serial", "streamed 100/50/20ms tool calls, run once the response is complete", 30,
+             streaming_tools_scenario(prefetch=False), chunk_delay=STREAMING_TOOLS_CHUNK_DELAY),
+    Scenario("streaming_tools_overlapped", "streamed 100/50/20ms tool calls, started as their arguments arrive", 30,
+             streaming_tools_scenario(prefetch=True), chunk_delay=STREAMING_TOOLS_CHUNK_DELAY),
+]
+
+
+def run_scenario(scenario: Scenario, base_url: str, turns: int) -> Dict[str, float]:
+    # timing pass
+    turn = scenario.setup(base_url)
+    turn(-1)  # warm up clients and connections
+    timings: List[float] = []
+    start = time.perf_counter()
+    for i in range(turns):
+        turn_start = time.perf_counter()
+        turn(i)
+        timings.append(time.perf_counter() - turn_start)
+    elapsed = time.perf_counter() - start
+
+    # memory pass, separate since tracemalloc slows everything down
+    tracemalloc.start()
+    turn = scenario.setup(base_url)
+    for i in range(turns):
+        turn(i)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    ms = sorted(t * 1000 for t in timings)
+    return {
+        "turns": turns,
+        "throughput": turns / elapsed,
+        "p50_ms": statistics.median(ms),
+        "p99_ms": ms[min(len(ms) - 1, int(len(ms) * 0.99))],
+        "peak_kib": peak / 1024,
+    }
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]],
+            tolerance: float) -> List[str]:
+    """Returns a line for every metric that is worse than the baseline by more than tolerance."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for metric in LOWER_IS_BETTER:
+            if base.get(metric) and result[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f"{name} {metric}: {result[metric]:.2f} vs baseline {base[metric]:.2f}")
+        if base.get("throughput") and result["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(f"{name} throughput: {result['throughput']:.1f}/s vs baseline {base['throughput']:.1f}/s")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-s", "--scenario", action="append", choices=[s.name for s in SCENARIOS],
+                        help="scenario to run, repeat for more, defaults to all")
+    parser.add_argument("--quick", action="store_true", help="a tenth of the turns, for a smoke test")
+    parser.add_argument("--latency", type=float, default=0.0, help="stub server latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="stub server latency jitter in seconds")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed regression, 0.25 is 25%%")
+    args = parser.parse_args()
+
+    setup_logging("WARNING", force=True)
+    scenarios = [s for s in SCENARIOS if not args.scenario or s.name in args.scenario]
+    results = {}
+    with StubServer(latency=args.latency, jitter=args.jitter) as server:
+        print(f"{'scenario':<26} {'turns':>6} {'turns/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'peak KiB':>10}")
+        for scenario in scenarios:
+            turns = max(1, scenario.turns // 10) if args.quick else scenario.turns
+            server.chunk_delay = scenario.chunk_delay
+            result = results[scenario.name] = run_scenario(scenario, server.base_url, turns)
+            print(f"{scenario.name:<26} {turns:>6} {result['throughput']:9.1f} {result['p50_ms']:9.2f} "
+                  f"{result['p99_ms']:9.2f} {result['peak_kib']:10.0f}")
+        print(f"stub server handled {server.requests} requests")
+    if "streaming_tools_serial" in results and "streaming_tools_overlapped" in results:
+        serial, overlapped = results["streaming_tools_serial"]["p50_ms"], results["streaming_tools_overlapped"]["p50_ms"]
+        print(f"tool prefetch: p50 {overlapped:.1f} ms overlapped vs {serial:.1f} ms serial, "
+              f"{serial - overlapped:.1f} ms saved per turn")
+
+    if args.save_baseline:
+        baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+        baseline.setdefault("scenarios", {}).update(results)
+        baseline["python"] = platform.python_version()
+        baseline["machine"] = platform.platform()
+        args.baseline.write_text(json.dumps(baseline, indent=2, sort_keys=True) + "\n")
+        print(f"saved baseline to {args.baseline}")
+        return 0
+    if not args.baseline.exists():
+        print(f"no baseline at {args.baseline}, run with --save-baseline to store one")
+        return 0
+
+    regressions = compare(results, json.loads(args.baseline.read_text()).get("scenarios", {}), args.tolerance)
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    if not regressions:
+        print(f"no regressions over {args.tolerance:.0%} against {args.baseline}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,221 @@
+"""
+Local stub of Together's OpenAI compatible /v1/chat/completions endpoint, for offline benchmarks.
+
+Responses are scripted from the last message:
+    user message with "weather in A, B and C"   -> one get_weather tool call per city (if tools are bound)
+    user message asking for the coolest cities  -> a get_coolest_cities tool call (if tools are bound)
+    anything else                               -> a short text answer, quoting any tool results
+
+Supports "stream": true (server sent events), and a configurable latency, jitter and per chunk delay.
+
+    python benchmarks/stub_server.py --port 8765 --latency 0.2 --jitter 0.05
+    TOGETHER_API_BASE=http://127.0.0.1:8765/v1 TOGETHER_API_KEY=stub streamlit run src/streamlit_app.py
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+
+
+WEATHER_RE = re.compile(r"weather in (.+?)[?.!]*$", re.IGNORECASE)
+CITY_SPLIT_RE = re.compile(r"\s*(?:,|\band\b)\s*")
+# words per streamed content chunk
+STREAM_CHUNK_WORDS = 2
+# characters per streamed tool call arguments chunk
+STREAM_CHUNK_ARG_CHARS = 8
+
+
+def count_tokens(text: str) -> int:
+    return (len(text) + 3) // 4
+
+
+def message_text(message: Dict[str, Any]) -> str:
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        content = " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content
+
+
+def tool_call(name: str, args: Dict[str, Any]) -> Dict[str, Any]:
+    return {"id": f"call_{uuid.uuid4().hex[:12]}", "type": "function",
+            "function": {"name": name, "arguments": json.dumps(args)}}
+
+
+def scripted_reply(request: Dict[str, Any]) -> Dict[str, Any]:
+    """The assistant message for a chat completion request, with content and maybe tool_calls."""
+    messages: List[Dict[str, Any]] = request.get("messages") or []
+    tool_names = {t.get("function", {}).get("name") for t in request.get("tools") or []}
+    last = messages[-1] if messages else {"role": "user", "content": ""}
+    text = message_text(last).strip()
+
+    if last.get("role") == "user":
+        match = WEATHER_RE.search(text)
+        if match and "get_weather" in tool_names:
+            cities = [c for c in CITY_SPLIT_RE.split(match.group(1)) if c]
+            return {"role": "assistant", "content": "",
+                    "tool_calls": [tool_call("get_weather", {"location": city}) for city in cities]}
+        if "coolest cities" in text.lower() and "get_coolest_cities" in tool_names:
+            return {"role": "assistant", "content": "", "tool_calls": [tool_call("get_coolest_cities", {})]}
+        return {"role": "assistant", "content": f"You said: {text[:200]}. Anything else I can help with?"}
+
+    tool_results = []
+    for message in reversed(messages):
+        if message.get("role") != "tool":
+            break
+        tool_results.append(message_text(message))
+    return {"role": "assistant", "content": "Here is what I found. " + " ".join(reversed(tool_results))}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "StubServer"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass  # quiet, benchmarks print their own results
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        self.server.requests += 1
+        time.sleep(self.server.delay())
+
+        reply = scripted_reply(request)
+        prompt_tokens = sum(count_tokens(message_text(m)) for m in request.get("messages") or [])
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": count_tokens(reply["content"]),
+                 "total_tokens": prompt_tokens + count_tokens(reply["content"])}
+        finish_reason = "tool_calls" if reply.get("tool_calls") else "stop"
+        base = {"id": f"chatcmpl-{uuid.uuid4().hex[:16]}", "created": int(time.time()),
+                "model": request.get("model", "stub")}
+        if request.get("stream"):
+            self.stream(base, reply, finish_reason, usage)
+        else:
+            self.send_json(200, {**base, "object": "chat.completion", "usage": usage,
+                                 "choices": [{"index": 0, "message": reply, "finish_reason": finish_reason}]})
+
+    def send_json(self, status: int, body: Dict[str, Any]) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def stream(self, base: Dict[str, Any], reply: Dict[str, Any], finish_reason: str, usage: Dict[str, int]) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        chunk = {**base, "object": "chat.completion.chunk"}
+
+        def send_delta(delta: Dict[str, Any], finish: Optional[str] = None, **extra: Any) -> None:
+            self.send_event({**chunk, **extra, "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]})
+
+        send_delta({"role": "assistant", "content": ""})
+        words = reply["content"].split(" ") if reply["content"] else []
+        for i in range(0, len(words), STREAM_CHUNK_WORDS):
+            time.sleep(self.server.chunk_delay)
+            piece = " ".join(words[i:i + STREAM_CHUNK_WORDS])
+            send_delta({"content": piece if i == 0 else " " + piece})
+        # tool calls stream like the real API: id and name first, then the arguments a few characters at a time
+        for index, call in enumerate(reply.get("tool_calls") or []):
+            function = call["function"]
+            send_delta({"tool_calls": [{"index": index, "id": call["id"], "type": call["type"],
+                                        "function": {"name": function["name"], "arguments": ""}}]})
+            arguments = function["arguments"]
+            for i in range(0, len(arguments), STREAM_CHUNK_ARG_CHARS):
+                time.sleep(self.server.chunk_delay)
+                send_delta({"tool_calls": [{"index": index,
+                                            "function": {"arguments": arguments[i:i + STREAM_CHUNK_ARG_CHARS]}}]})
+        # the stop token takes a decoding step like any other
+        time.sleep(self.server.chunk_delay)
+        send_delta({}, finish_reason, usage=usage)
+        self.send_data(b"data: [DONE]\n\n")
+        self.send_data(b"")
+
+    def send_event(self, body: Dict[str, Any]) -> None:
+        self.send_data(b"data: " + json.dumps(body).encode() + b"\n\n")
+
+    def send_data(self, data: bytes) -> None:
+        """One HTTP/1.1 chunk, an empty one ends the response."""
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+class StubServer(ThreadingHTTPServer):
+    """Stub Together API on a background thread. Use as a context manager, base_url is the /v1 url."""
+    daemon_threads = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, jitter: float = 0.0,
+                 chunk_delay: float = 0.0, seed: int = 0):
+        """
+        Args:
+            port: 0 picks a free port
+            latency: seconds before the first byte of every response
+            jitter: latency varies uniformly by +- jitter seconds
+            chunk_delay: seconds between streamed content and tool call arguments chunks
+            seed: for the jitter, so runs are repeatable
+        """
+        super().__init__((host, port), StubHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.chunk_delay = chunk_delay
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def handle_error(self, request: Any, client_address: Any) -> None:
+        # clients drop keep-alive connections whenever they like, only report real errors
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def delay(self) -> float:
+        with self._random_lock:
+            return max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+
+    def start(self) -> "StubServer":
+        self._thread = threading.Thread(target=self.serve_forever, name="toolchat7-stub-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self) -> "StubServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--chunk-delay", type=float, default=0.0)
+    args = parser.parse_args()
+    server = StubServer(port=args.port, latency=args.latency, jitter=args.jitter, chunk_delay=args.chunk_delay)
+    print(f"stub Together API at {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
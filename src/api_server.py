@@ -0,0 +1,392 @@
+"""
+Headless HTTP chat API, a plain ASGI app using the same ChatModelService, ToolManager and chat history
+classes as the streamlit app, without streamlit's rerun of the whole script per interaction.
+
+Run with any ASGI server, eg:
+    pip install uvicorn
+    uvicorn api_server:app --app-dir src --port 8000
+
+Endpoints, session_id is any string of letters, digits, "_", "-" and "." chosen by the client:
+    POST   /v1/sessions/{session_id}/chat     {"content": "..."} -> {"session_id", "content", "message", "events"}
+    POST   /v1/sessions/{session_id}/stream   {"content": "..."} -> text/event-stream of {"delta": "..."} events
+    GET    /v1/sessions/{session_id}/history  -> {"session_id", "messages"}, or NDJSON with ?format=ndjson
+    DELETE /v1/sessions/{session_id}
+    GET    /healthz
+    GET    /metrics                           -> Prometheus text, see services/metrics.py
+
+Each session has its own chat history, and turns within one session run one at a time.
+Histories are kept by the session manager, which spills idle sessions to disk and reloads them
+when used again (see services/session_manager.py), or in SQLite if CHAT_HISTORY_DB is set.
+At most API_MAX_CONCURRENCY turns run at once. Up to API_MAX_WAITING more wait for a slot,
+and past that requests get 503 with Retry-After, so a burst cannot pile up unbounded work.
+A streamed response is produced no faster than the client reads it.
+LLM retries, hedged requests and model fallbacks (see services/resilience.py) are listed in "events"
+of a chat response, and sent as "resilience" events in a stream.
+"""
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+import asyncio
+import json
+import os
+import re
+import threading
+from dotenv import load_dotenv
+from langchain_core.messages import message_to_dict
+from services.async_runtime import await_on_shared_loop
+from services.chat_history import json_dumps
+from services.chat_model import ChatModelService
+from services.metrics import metrics
+from services.resilience import ResilienceEvent
+from services.scheduler import request_scope
+from services.session_manager import ManagedChatHistoryManager, default_session_manager
+from services.sqlite_chat_history import SQLiteChatHistoryManager
+from utils import get_logger
+
+
+log = get_logger("api_server")
+
+Scope = Dict[str, Any]
+Receive = Callable[[], Awaitable[Dict[str, Any]]]
+Send = Callable[[Dict[str, Any]], Awaitable[None]]
+
+# turns running at the same time, each holds an LLM request or tool calls in flight
+API_MAX_CONCURRENCY = int(os.getenv("API_MAX_CONCURRENCY", "32"))
+# turns waiting for a slot before new requests are turned away with 503
+API_MAX_WAITING = int(os.getenv("API_MAX_WAITING", "256"))
+# in-memory sessions kept, the least recently used are dropped
+API_MAX_SESSIONS = int(os.getenv("API_MAX_SESSIONS", "10000"))
+MAX_BODY_BYTES = 1024 * 1024
+# streamed deltas produced ahead of what the client has read
+STREAM_BUFFER_CHUNKS = 64
+
+SESSION_PATH_RE = re.compile(r"^/v1/sessions/(?P<session_id>[\w.-]{1,128})(?:/(?P<action>chat|stream|history))?/?$")
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str, headers: Optional[List[Tuple[bytes, bytes]]] = None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or []
+
+
+@dataclass
+class Session:
+    history: Any
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+
+def new_chat_history(session_id: str) -> ManagedChatHistoryManager | SQLiteChatHistoryManager:
+    """Chat history for a session, persisted in SQLite if CHAT_HISTORY_DB is set, like the streamlit app.
+    Otherwise kept by the session manager, which spills idle sessions to disk."""
+    db_path = os.getenv("CHAT_HISTORY_DB")
+    if db_path:
+        return SQLiteChatHistoryManager(session_id, db_path)
+    return default_session_manager().history(session_id)
+
+
+def find_chat_history(session_id: str) -> ManagedChatHistoryManager | SQLiteChatHistoryManager | None:
+    """Chat history of an existing session, like new_chat_history(), or None. Unknown sessions are not added
+    to the session manager, so requests for made up ids do not hold memory."""
+    db_path = os.getenv("CHAT_HISTORY_DB")
+    if db_path:
+        return SQLiteChatHistoryManager(session_id, db_path)
+    return default_session_manager().find(session_id)
+
+
+class ChatAPI:
+    """The ASGI app. The ChatModelService is created on startup, or on the first request if the server
+    does not send lifespan events."""
+
+    def __init__(self, service_factory: Optional[Callable[[], ChatModelService]] = None,
+                 history_factory: Callable[[str], Any] = new_chat_history,
+                 history_lookup: Optional[Callable[[str], Any]] = None,
+                 max_concurrency: int = API_MAX_CONCURRENCY, max_waiting: int = API_MAX_WAITING,
+                 max_sessions: int = API_MAX_SESSIONS):
+        """
+        Args:
+            service_factory: returns the ChatModelService, defaults to one using TOGETHER_API_KEY
+            history_factory: returns a new chat history for a session id
+            history_lookup: returns the chat history of an existing session, or None, without creating one.
+                Defaults to find_chat_history with the default history_factory, otherwise to history_factory
+            max_concurrency: max turns running at once
+            max_waiting: max turns waiting for a slot, more are rejected with 503
+            max_sessions: max sessions kept, least recently used are dropped
+        """
+        self.service_factory = service_factory or default_service
+        self.history_factory = history_factory
+        if history_lookup is None:
+            history_lookup = find_chat_history if history_factory is new_chat_history else history_factory
+        self.history_lookup = history_lookup
+        self.max_concurrency = max_concurrency
+        self.max_waiting = max_waiting
+        self.max_sessions = max_sessions
+        self.service: Optional[ChatModelService] = None
+        self.sessions: OrderedDict[str, Session] = OrderedDict()
+        self.waiting = 0
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._service_lock = threading.Lock()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            try:
+                await self.route(scope, receive, send)
+            except HTTPError as e:
+                await send_json(send, e.status, {"error": str(e)}, e.headers)
+            except Exception as e:
+                log.exception("%s %s failed: %r", scope["method"], scope["path"], e)
+                await send_json(send, 500, {"error": "internal error"})
+
+    async def lifespan(self, receive: Receive, send: Send) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    # build the client and bind the tools now, rather than on the first request
+                    service = await asyncio.to_thread(self.get_service)
+                    await asyncio.to_thread(service.warm_up)
+                    await send({"type": "lifespan.startup.complete"})
+                except Exception as e:
+                    log.exception("startup failed")
+                    await send({"type": "lifespan.startup.failed", "message": repr(e)})
+                    return
+            elif message["type"] == "lifespan.shutdown":
+                if self.service is not None:
+                    self.service.tool_manager.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def get_service(self) -> ChatModelService:
+        with self._service_lock:
+            if self.service is None:
+                self.service = self.service_factory()
+            return self.service
+
+    async def route(self, scope: Scope, receive: Receive, send: Send) -> None:
+        method, path = scope["method"], scope["path"]
+        if path == "/healthz" and method == "GET":
+            await send_json(send, 200, {"status": "ok", "sessions": len(self.sessions), "waiting": self.waiting})
+            return
+        if path == "/metrics" and method == "GET":
+            await send_response(send, 200, metrics.render_prometheus().encode(), b"text/plain; version=0.0.4")
+            return
+        match = SESSION_PATH_RE.match(path)
+        if not match:
+            raise HTTPError(404, f"not found: {path}")
+        session_id, action = match["session_id"], match["action"]
+
+        if action is None and method == "DELETE":
+            session = self.sessions.pop(session_id, None)
+            if session is not None:
+                async with session.lock:
+                    self.delete_history(session_id, session.history)
+            else:
+                # evicted from self.sessions, or never used by this process, but may still be kept by the
+                # session manager or in SQLite
+                history = self.history_lookup(session_id)
+                if history is not None:
+                    self.delete_history(session_id, history)
+            await send_response(send, 204, b"")
+        elif action == "history" and method == "GET":
+            await self.send_history(scope, send, session_id)
+        elif action in ("chat", "stream") and method == "POST":
+            content = parse_content(await read_body(receive))
+            async with self.turn_slot():
+                service = self.service or await asyncio.to_thread(self.get_service)
+                session = self.get_session(session_id, service)
+                async with session.lock:
+                    if action == "chat":
+                        events: List[ResilienceEvent] = []
+                        # the coroutine runs on the shared loop with a copy of this context, scope included
+                        with request_scope(session=session_id):
+                            response_ai_msg = await await_on_shared_loop(
+                                service.agenerate_response(content, chat_history=session.history,
+                                                           on_event=events.append))
+                        await send_json(send, 200, {"session_id": session_id, "content": response_ai_msg.content,
+                                                    "message": message_to_dict(response_ai_msg),
+                                                    "events": [event_dict(e) for e in events]})
+                    else:
+                        await self.stream_turn(send, service, session_id, session, content)
+        else:
+            raise HTTPError(405, f"{method} not allowed on {path}")
+
+    def turn_slot(self) -> "TurnSlot":
+        if self._slots is None:
+            # created on first use, so it belongs to the server's event loop
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+        if self._slots.locked() and self.waiting >= self.max_waiting:
+            raise HTTPError(503, "server busy, retry later", [(b"retry-after", b"1")])
+        return TurnSlot(self)
+
+    def get_session(self, session_id: str, service: ChatModelService) -> Session:
+        session = self.sessions.get(session_id)
+        if session is not None:
+            self.sessions.move_to_end(session_id)
+            return session
+        history = self.history_factory(session_id)
+        # a resumed persistent session already starts with the system message
+        if next(history.iter_messages(), None) is None:
+            history.add_system_message(service.get_system_message())
+        session = self.sessions[session_id] = Session(history)
+        while len(self.sessions) > self.max_sessions:
+            oldest_id, oldest = next(iter(self.sessions.items()))
+            if oldest.lock.locked():
+                break  # busy, try again on the next new session
+            del self.sessions[oldest_id]
+        return session
+
+    @staticmethod
+    def delete_history(session_id: str, history: Any) -> None:
+        history.clear()
+        if isinstance(history, ManagedChatHistoryManager):
+            history.manager.forget(session_id)
+
+    async def send_history(self, scope: Scope, send: Send, session_id: str) -> None:
+        session = self.sessions.get(session_id)
+        history = session.history if session is not None else self.history_lookup(session_id)
+        # evicted sessions are still kept by the session manager or in SQLite
+        if history is None or next(history.iter_messages(), None) is None:
+            raise HTTPError(404, f"unknown session {session_id}")
+        query = parse_qs(scope.get("query_string", b"").decode())
+        if query.get("format") == ["ndjson"]:
+            await send({"type": "http.response.start", "status": 200,
+                        "headers": [(b"content-type", b"application/x-ndjson")]})
+            for line in history.export_ndjson():
+                await send({"type": "http.response.body", "body": line.encode(), "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        else:
+            messages = [message_to_dict(m) for m in history.iter_messages()]
+            await send_json(send, 200, {"session_id": session_id, "messages": messages})
+
+    async def stream_turn(self, send: Send, service: ChatModelService, session_id: str, session: Session,
+                          content: str) -> None:
+        """Runs the sync streaming tool loop on a worker thread and forwards its deltas as server sent events.
+        The thread waits whenever STREAM_BUFFER_CHUNKS deltas are unsent, so a slow client slows the producer
+        instead of buffering the whole response."""
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        credits = threading.Semaphore(STREAM_BUFFER_CHUNKS)
+        stopped = threading.Event()
+        done = object()
+
+        def on_event(event: ResilienceEvent) -> None:
+            loop.call_soon_threadsafe(queue.put_nowait, event)
+
+        def produce() -> None:
+            deltas = service.stream_response_langchain(content, chat_history=session.history, on_event=on_event)
+            item: Any = done
+            try:
+                with request_scope(session=session_id):
+                    for delta in deltas:
+                        credits.acquire()
+                        if stopped.is_set():
+                            break  # client went away
+                        loop.call_soon_threadsafe(queue.put_nowait, delta)
+            except Exception as e:
+                log.exception("stream_response_langchain failed: %r", e)
+                item = e
+            finally:
+                deltas.close()
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")]})
+        producer = loop.run_in_executor(None, produce)
+        try:
+            while True:
+                item = await queue.get()
+                if item is done:
+                    await send_event(send, "done", {})
+                    break
+                if isinstance(item, Exception):
+                    await send_event(send, "error", {"error": repr(item)})
+                    break
+                if isinstance(item, ResilienceEvent):
+                    await send_event(send, "resilience", event_dict(item))
+                    continue
+                await send_event(send, None, {"delta": item})
+                credits.release()
+        finally:
+            stopped.set()
+            credits.release(STREAM_BUFFER_CHUNKS)
+            await producer
+        await send({"type": "http.response.body", "body": b""})
+
+
+class TurnSlot:
+    """async with: wait for one of the max_concurrency slots, counted in waiting until one is free."""
+
+    def __init__(self, api: ChatAPI):
+        self.api = api
+
+    async def __aenter__(self) -> None:
+        self.api.waiting += 1
+        try:
+            await self.api._slots.acquire()
+        finally:
+            self.api.waiting -= 1
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.api._slots.release()
+
+
+def default_service() -> ChatModelService:
+    load_dotenv()
+    api_key = os.getenv("TOGETHER_API_KEY")
+    if not api_key:
+        raise RuntimeError("TOGETHER_API_KEY is not set")
+    return ChatModelService(api_key)
+
+
+async def read_body(receive: Receive) -> bytes:
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise HTTPError(400, "client disconnected")
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > MAX_BODY_BYTES:
+            raise HTTPError(413, f"body larger than {MAX_BODY_BYTES} bytes")
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+def event_dict(event: ResilienceEvent) -> Dict[str, Any]:
+    return {**asdict(event), "message": str(event)}
+
+
+def parse_content(body: bytes) -> str:
+    try:
+        content = json.loads(body).get("content")
+    except (ValueError, AttributeError):
+        raise HTTPError(400, 'body must be a JSON object like {"content": "..."}')
+    if not isinstance(content, str) or not content.strip():
+        raise HTTPError(400, "content must be a non empty string")
+    return content
+
+
+async def send_response(send: Send, status: int, body: bytes, content_type: bytes = b"application/json",
+                        headers: Optional[List[Tuple[bytes, bytes]]] = None) -> None:
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode()),
+                            *(headers or [])]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_json(send: Send, status: int, body: Dict[str, Any],
+                    headers: Optional[List[Tuple[bytes, bytes]]] = None) -> None:
+    await send_response(send, status, json_dumps(body).encode(), headers=headers)
+
+
+async def send_event(send: Send, event: Optional[str], data: Dict[str, Any]) -> None:
+    prefix = f"event: {event}\n" if event else ""
+    await send({"type": "http.response.body", "body": f"{prefix}data: {json_dumps(data)}\n\n".encode(),
+                "more_body": True})
+
+
+app = ChatAPI()
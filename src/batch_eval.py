@@ -0,0 +1,263 @@
+"""
+Batch runner for conversation test data, replays many .tsv conversations through ChatModelService concurrently.
+
+    python src/batch_eval.py tests/conversations --out results.jsonl --workers 16 --rps 5 --tpm 200000
+
+Conversation files are tab separated, one message per line, "role<TAB>content". Lines starting with #
+and a "role<TAB>content" header are skipped. In content, \\n, \\t and \\\\ stand for newline, tab and backslash.
+    system   extra system message, added after the default one
+    human    sent to the model, "user" works too
+    ai       the reference answer, recorded next to the model's answer but not checked, "assistant" works too
+    expect   text the answer to the previous human message must contain, case insensitive
+
+Each conversation gets its own chat history. Up to --workers conversations run at once, and all of
+them share one --rps and --tpm limit on LLM requests, taking turns in the scheduler queue. Results are appended to --out as one JSON line per
+conversation as soon as it finishes, so an interrupted run continues where it stopped when rerun
+with the same --out. A file that cannot be parsed is recorded as an errored conversation, and the
+others still run. Exits 1 if any conversation failed an expectation or errored.
+"""
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Set, TextIO, Tuple
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from dotenv import load_dotenv
+from services.async_runtime import run_coroutine
+from services.chat_history import InMemoryChatHistoryManager, json_dumps
+from services.chat_model import ChatModelService
+from services.model_registry import TOGETHERAI_LLAMA33_70B_MODEL
+from services.scheduler import LLMScheduler, request_scope
+from utils import get_logger
+
+
+log = get_logger("batch_eval")
+
+HUMAN_ROLES = ("human", "user")
+AI_ROLES = ("ai", "assistant")
+ESCAPES = {"n": "\n", "t": "\t", "\\": "\\"}
+
+
+@dataclass
+class Turn:
+    human: str
+    reference: Optional[str] = None
+    expect: List[str] = field(default_factory=list)
+
+
+@dataclass
+class Conversation:
+    id: str
+    system: List[str] = field(default_factory=list)
+    turns: List[Turn] = field(default_factory=list)
+
+
+def unescape(text: str) -> str:
+    out, chars = [], iter(text)
+    for c in chars:
+        if c == "\\":
+            nxt = next(chars, "")
+            out.append(ESCAPES.get(nxt, "\\" + nxt))
+        else:
+            out.append(c)
+    return "".join(out)
+
+
+def parse_conversation(conversation_id: str, lines: Iterable[str]) -> Conversation:
+    """Parse the lines of a .tsv conversation file.
+
+    Raises:
+        ValueError: on an unknown role, or an ai/expect line before the first human line
+    """
+    conversation = Conversation(conversation_id)
+    first = True
+    for line_number, line in enumerate(lines, start=1):
+        line = line.rstrip("\r\n")
+        if not line.strip() or line.startswith("#"):
+            continue
+        role, _, content = line.partition("\t")
+        role = role.strip().lower()
+        if first and role == "role":
+            first = False
+            continue
+        first = False
+        content = unescape(content)
+        if role == "system":
+            conversation.system.append(content)
+        elif role in HUMAN_ROLES:
+            conversation.turns.append(Turn(content))
+        elif role in AI_ROLES or role == "expect":
+            if not conversation.turns:
+                raise ValueError(f"{conversation_id} line {line_number}: {role} before the first human message")
+            if role == "expect":
+                conversation.turns[-1].expect.append(content)
+            else:
+                conversation.turns[-1].reference = content
+        else:
+            raise ValueError(f"{conversation_id} line {line_number}: unknown role {role!r}")
+    return conversation
+
+
+def find_conversations(paths: Iterable[str]) -> List[Path]:
+    files = []
+    for path in map(Path, paths):
+        files.extend(sorted(path.rglob("*.tsv")) if path.is_dir() else [path])
+    return files
+
+
+def conversation_id_for(path: Path) -> str:
+    """The path relative to the current directory if possible, so results stay valid if the files move with it."""
+    try:
+        return path.resolve().relative_to(Path.cwd()).as_posix()
+    except ValueError:
+        return path.resolve().as_posix()
+
+
+def completed_ids(out_path: Path, retry_errors: bool) -> Set[str]:
+    """Conversations already in the results file. A partly written last line from an interrupted run is ignored."""
+    done = set()
+    if not out_path.exists():
+        return done
+    with open(out_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(result, dict) or result.get("conversation") is None:
+                continue
+            if not (retry_errors and result.get("status") == "error"):
+                done.add(result["conversation"])
+    return done
+
+
+def load_conversations(files: Iterable[Path], done: Set[str]) -> Tuple[List[Conversation], List[Dict[str, Any]]]:
+    """Parse the conversation files not in done. A file that cannot be read or parsed is returned as an error
+    result instead, so one malformed file does not stop the batch."""
+    conversations, errors = [], []
+    for f in files:
+        conversation_id = conversation_id_for(f)
+        if conversation_id in done:
+            continue
+        try:
+            conversations.append(parse_conversation(conversation_id, f.read_text(encoding="utf-8").splitlines()))
+        except ValueError as e:  # also UnicodeDecodeError
+            log.warning("conversation %s is not valid: %s", conversation_id, e)
+            errors.append({"conversation": conversation_id, "status": "error", "error": str(e), "turns": [],
+                           "passed": False, "seconds": 0.0})
+    return conversations, errors
+
+
+def open_results(out_path: Path, restart: bool) -> TextIO:
+    """Open the results file for appending, starting a new line if an interrupted run left a partial one."""
+    if restart or not out_path.exists():
+        return open(out_path, "w", encoding="utf-8")
+    with open(out_path, "rb") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size:
+            f.seek(-1, os.SEEK_END)
+        needs_newline = size > 0 and f.read(1) != b"\n"
+    out = open(out_path, "a", encoding="utf-8")
+    if needs_newline:
+        out.write("\n")
+    return out
+
+
+async def run_conversation(service: ChatModelService, conversation: Conversation) -> Dict[str, Any]:
+    chat_history = InMemoryChatHistoryManager()
+    chat_history.add_system_message(service.get_system_message())
+    for content in conversation.system:
+        chat_history.add_system_message(content)
+    result: Dict[str, Any] = {"conversation": conversation.id, "status": "ok", "turns": []}
+    start = time.perf_counter()
+    try:
+        with request_scope(session=conversation.id):
+            await run_turns(service, conversation, chat_history, result)
+    except Exception as e:
+        log.warning("conversation %s failed: %r", conversation.id, e)
+        result.update(status="error", error=repr(e))
+    result["passed"] = result["status"] == "ok" and all(t["passed"] for t in result["turns"])
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+
+async def run_turns(service: ChatModelService, conversation: Conversation, chat_history: InMemoryChatHistoryManager,
+                    result: Dict[str, Any]) -> None:
+    for turn in conversation.turns:
+        turn_start = time.perf_counter()
+        response = await service.agenerate_response(turn.human, chat_history=chat_history)
+        answer = response.content if isinstance(response.content, str) else json.dumps(response.content)
+        failed = [e for e in turn.expect if e.lower() not in answer.lower()]
+        result["turns"].append({
+            "human": turn.human,
+            "answer": answer,
+            "reference": turn.reference,
+            "expect": turn.expect,
+            "passed": not failed,
+            "seconds": round(time.perf_counter() - turn_start, 3),
+        })
+
+
+async def run_batch(service: ChatModelService, conversations: List[Conversation], out: TextIO,
+                    workers: int) -> List[Dict[str, Any]]:
+    """Run conversations with at most workers at once, writing each result to out when it finishes."""
+    slots = asyncio.Semaphore(workers)
+    results = []
+
+    async def run_one(conversation: Conversation) -> None:
+        async with slots:
+            result = await run_conversation(service, conversation)
+        # only the event loop thread writes, so lines never interleave
+        out.write(json_dumps(result) + "\n")
+        out.flush()
+        results.append(result)
+        log.info("%s %s in %.1fs", conversation.id, "passed" if result["passed"] else "FAILED", result["seconds"])
+
+    await asyncio.gather(*(run_one(c) for c in conversations))
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help=".tsv files, or directories searched for .tsv files")
+    parser.add_argument("--out", type=Path, default=Path("batch_eval_results.jsonl"))
+    parser.add_argument("--workers", type=int, default=8, help="conversations running at once")
+    parser.add_argument("--rps", type=float, default=2.0, help="max LLM requests per second, for all conversations")
+    parser.add_argument("--tpm", type=float, help="max LLM tokens per minute, for all conversations")
+    parser.add_argument("--model", default=TOGETHERAI_LLAMA33_70B_MODEL)
+    parser.add_argument("--retry-errors", action="store_true", help="rerun conversations that errored last time")
+    parser.add_argument("--restart", action="store_true", help="ignore and overwrite existing results")
+    args = parser.parse_args()
+
+    load_dotenv()
+    api_key = os.getenv("TOGETHER_API_KEY")
+    if not api_key:
+        print("TOGETHER_API_KEY is not set", file=sys.stderr)
+        return 2
+
+    files = find_conversations(args.paths)
+    done = set() if args.restart else completed_ids(args.out, args.retry_errors)
+    conversations, invalid = load_conversations(files, done)
+    print(f"{len(files)} conversations, {len(files) - len(conversations) - len(invalid)} already in {args.out}, "
+          f"{len(invalid)} not valid, running {len(conversations)}")
+
+    service = ChatModelService(api_key, args.model)
+    # requests wait as long as the batch needs, rather than the interactive LLM_QUEUE_TIMEOUT
+    service.scheduler = LLMScheduler(rps=args.rps, tpm=args.tpm, timeout=None)
+    start = time.perf_counter()
+    with open_results(args.out, args.restart) as out:
+        for result in invalid:
+            out.write(json_dumps(result) + "\n")
+        results = invalid + run_coroutine(run_batch(service, conversations, out, args.workers))
+    failed = [r["conversation"] for r in results if not r["passed"]]
+    print(f"{len(results) - len(failed)} passed, {len(failed)} failed or errored in {time.perf_counter() - start:.1f}s")
+    for conversation_id in failed:
+        print(f"  FAILED {conversation_id}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+"""
+Process wide asyncio event loop and pooled HTTP clients.
+
+Every ChatModelService in the process (one per API key, cached by streamlit) shares these,
+so many concurrent chats use one event loop thread and one keep-alive connection pool
+instead of one blocked thread and one connection per in-flight LLM request.
+With HTTP_CASSETTE set, the clients record their traffic to, or replay it from, a cassette file,
+see services/http_cassette.py.
+"""
+from typing import Any, Coroutine, Optional, TypeVar
+import asyncio
+import threading
+import httpx
+from services.http_cassette import async_cassette_transport, cassette_transport
+
+
+HTTP_MAX_CONNECTIONS = 100
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 20
+# seconds an idle keep-alive connection stays in the pool
+HTTP_KEEPALIVE_EXPIRY = 30.0
+HTTP_TIMEOUT = httpx.Timeout(120.0, connect=10.0)
+
+T = TypeVar("T")
+
+_lock = threading.Lock()
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_thread: Optional[threading.Thread] = None
+_http_client: Optional[httpx.Client] = None
+_async_http_client: Optional[httpx.AsyncClient] = None
+
+
+def http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Return the shared event loop, starting its daemon thread on first use."""
+    global _loop, _loop_thread
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(target=_loop.run_forever, name="toolchat7-event-loop", daemon=True)
+            _loop_thread.start()
+        return _loop
+
+
+def run_coroutine(coro: Coroutine[Any, Any, T], timeout: Optional[float] = None) -> T:
+    """Run coro on the shared event loop and wait for its result.
+    Can be called from any thread except the event loop thread itself, eg a streamlit script thread.
+
+    Raises:
+        RuntimeError: if called from the shared event loop thread, which would deadlock
+    """
+    loop = get_event_loop()
+    if threading.current_thread() is _loop_thread:
+        coro.close()
+        raise RuntimeError("run_coroutine() called from the shared event loop, use await instead")
+    return asyncio.run_coroutine_threadsafe(coro, loop).result(timeout)
+
+
+async def await_on_shared_loop(coro: Coroutine[Any, Any, T]) -> T:
+    """Await coro on the shared event loop from any other running event loop, eg an ASGI server's.
+    Cancelling the caller cancels coro."""
+    loop = get_event_loop()
+    if asyncio.get_running_loop() is loop:
+        return await coro
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+
+def get_http_client() -> httpx.Client:
+    """Shared keep-alive HTTP client for sync LLM calls."""
+    global _http_client
+    with _lock:
+        if _http_client is None:
+            _http_client = httpx.Client(limits=http_limits(), timeout=HTTP_TIMEOUT,
+                                        transport=cassette_transport(http_limits()))
+        return _http_client
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """Shared keep-alive HTTP client for async LLM calls.
+    Its connections belong to the shared event loop, so only await it from there (see run_coroutine)."""
+    global _async_http_client
+    with _lock:
+        if _async_http_client is None:
+            _async_http_client = httpx.AsyncClient(limits=http_limits(), timeout=HTTP_TIMEOUT,
+                                                   transport=async_cassette_transport(http_limits()))
+        return _async_http_client
@@ -1,13 +1,115 @@
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, TYPE_CHECKING
 import json
 from langchain_community.chat_message_histories import StreamlitChatMessageHistory
+from langchain_core.chat_history import BaseChatMessageHistory
 from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage, SystemMessage
+from langchain_core.messages import message_to_dict, messages_from_dict
+from services.message_store import CompactMessageStore
+from utils import get_logger
 
-class ChatHistoryManager(StreamlitChatMessageHistory):
-    def __init__(self):
-        super().__init__(key="langchain_messages")
-        print(f"CHAD: ChatHistoryManager init complete.")
+if TYPE_CHECKING:
+    from services.context_window import ContextWindowBuilder
+
+try:
+    # optional fast JSON backend, about 5x faster than json for large histories
+    import orjson
+except ImportError:
+    orjson = None
+
+log = get_logger(__name__)
+
+# messages added per add_messages() call when importing
+IMPORT_BATCH_SIZE = 500
+
+
+def json_dumps(obj: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj, default=str).decode()
+    return json.dumps(obj, default=str, ensure_ascii=False)
+
+
+def json_loads(data: str | bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dict_to_message(msg: Any) -> BaseMessage:
+    """Convert a dict from export_json()/export_ndjson() back to a message.
+    Also accepts the older flat format, a dict with 'type', 'content' and other message fields.
+
+    Raises:
+        ValueError: If msg is not a valid message dict
+    """
+    if not isinstance(msg, dict) or "type" not in msg:
+        raise ValueError("Each message must be a dictionary with at least a 'type' key")
+    if "data" not in msg:
+        if "content" not in msg:
+            raise ValueError("Each message must be a dictionary with at least 'type' and 'content' keys")
+        msg = {"type": msg["type"], "data": {k: v for k, v in msg.items() if k != "type"}}
+    return messages_from_dict([msg])[0]
+
+class DisplayMessage(NamedTuple):
+    """AI or Human message as shown in the chat UI, content already converted to markdown text."""
+    type: str
+    content: str
+
+
+def to_display_message(msg: BaseMessage) -> Optional[DisplayMessage]:
+    """Returns None for messages that are not displayed: system, tool, and any messages without content."""
+    return display_message(msg.type, msg.content)
+
+
+def display_message(type_name: str, content: Any) -> Optional[DisplayMessage]:
+    if type_name not in ("ai", "human") or not content:
+        return None
+    if isinstance(content, str):
+        return DisplayMessage(type_name, content)
+    # list of content blocks, show just the text parts
+    text = "\n\n".join(block if isinstance(block, str) else block.get("text", "")
+                        for block in content)
+    return DisplayMessage(type_name, text) if text else None
+
+
+class ChatHistoryMixin:
+    """Helpers shared by every chat history backend: typed add_*_message methods, the display view,
+    JSON/NDJSON export and import.
+    The backend is a langchain BaseChatMessageHistory that provides messages, add_message() and clear().
+    """
+
+    def init_display_view(self) -> None:
+        # display view of the history, updated incrementally as messages are added
+        self._display_messages: List[DisplayMessage] = []
+        self._display_synced_count = 0
+        self._display_source_id: Optional[int] = None
+
+    def add_message(self, message: BaseMessage) -> None:
+        super().add_message(message)
+        self._sync_display_messages()
+
+    def clear(self) -> None:
+        super().clear()
+        self._display_messages = []
+        self._display_synced_count = 0
+
+    def _sync_display_messages(self) -> None:
+        """Bring the display view up to date, only looking at messages added since the last sync.
+        Rebuilds from scratch if the history list was replaced or shrunk, eg by clear() or import_json().
+        """
+        messages = self.messages
+        if id(messages) != self._display_source_id or len(messages) < self._display_synced_count:
+            self._display_messages = []
+            self._display_synced_count = 0
+            self._display_source_id = id(messages)
+        if isinstance(messages, CompactMessageStore):
+            # read type and content straight from the store, without building message objects
+            new = (display_message(messages.type_at(i), messages.content_at(i))
+                   for i in range(self._display_synced_count, len(messages)))
+        else:
+            new = (to_display_message(msg) for msg in messages[self._display_synced_count:])
+        self._display_messages.extend(filter(None, new))
+        self._display_synced_count = len(messages)
     
     def add_human_message(self, content: str) -> None:
         self.add_message(HumanMessage(content=content))
@@ -52,51 +154,133 @@ class ChatHistoryManager(StreamlitChatMessageHistory):
         self.append(message)
 
 
-    def get_just_ai_human_message(self) -> List[BaseMessage]:
+    def iter_messages(self) -> Iterator[BaseMessage]:
+        """Iterate over all messages, oldest first. Backends that page messages from storage override this."""
+        return iter(self.messages)
+
+
+    def get_context_messages(self, context_builder: "ContextWindowBuilder") -> List[BaseMessage]:
+        """Messages to send to the LLM, the history trimmed by context_builder to fit the model's context window.
+        Backends that do not keep all messages in memory override this to load only what can fit."""
+        # a list, since CompactMessageStore builds message objects on each read
+        return context_builder.build(list(self.messages))
+
+
+    def get_just_ai_human_message(self) -> List[DisplayMessage]:
         """
         Get all  AI or Human messages from the chat history.
         Skip system, tool, and any messages without content.
 
+        The list is kept up to date as messages are added, so calling this on every streamlit rerun
+        does not walk or copy the whole history.
+
         Returns:
-            List[BaseMessage]: A list of BaseMessage objects
+            List[DisplayMessage]: the display view, do not modify it
         """
-        messages = []
-        for msg in self.messages:
-            if msg.type in ["ai", "human"]:
-                if msg.content:
-                    messages.append(BaseMessage(content=msg.content, type=msg.type))
-        print(f"CHAD: get_just_ai_human_message() returning {len(messages)} of {len(self.messages)} messages")
-        return messages
+        self._sync_display_messages()
+        log.debug("get_just_ai_human_message() returning %d of %d messages", len(self._display_messages), self._display_synced_count)
+        return self._display_messages
 
     
     def export_json(self) -> str:
-        """Export chat history as JSON string."""
-        # TODO fix this
-        #return json.dumps(self.messages)
-        return '[]'
+        """Export chat history as JSON string, a list of message dicts.
+        Lossless, every message type keeps its fields such as tool_calls and tool_call_id."""
+        return "[" + ",".join(json_dumps(message_to_dict(msg)) for msg in self.iter_messages()) + "]"
+
+    def export_ndjson(self) -> Iterator[str]:
+        """Export chat history as newline delimited JSON, one message dict per line.
+        Lines are generated one at a time, so a huge history is never held twice in memory."""
+        for msg in self.iter_messages():
+            yield json_dumps(message_to_dict(msg)) + "\n"
         
-    def import_json(self, json_str: str) -> None:
-        """Import chat history from JSON string.
+    def import_json(self, json_str: str | bytes) -> None:
+        """Import chat history from JSON string, replacing the current history.
         
         Args:
-            json_str: JSON string containing chat messages
+            json_str: JSON string containing a list of chat messages, as returned by export_json()
             
         Raises:
             ValueError: If JSON format is invalid
         """
-        messages = json.loads(json_str)
+        messages = json_loads(json_str)
         if not isinstance(messages, list):
             raise ValueError("JSON must contain a list of messages")
-            
-        for msg in messages:
-            if not isinstance(msg, dict) or not all(key in msg for key in ['type', 'content']):
-                raise ValueError("Each message must be a dictionary with at least 'type' and 'content' keys")
-            
+        messages = [dict_to_message(msg) for msg in messages]
+        self.clear()
+        self.add_messages(messages)
+
+    def import_ndjson(self, lines: Iterable[str | bytes]) -> None:
+        """Import chat history from newline delimited JSON, replacing the current history.
+        Lines are parsed and added in batches, so lines can be a file object that is read as we go.
+        If any line is invalid, the previous history is restored.
+
+        Args:
+            lines: one message dict per line, as returned by export_ndjson()
+
+        Raises:
+            ValueError: If a line is not a valid message
+        """
+        previous = list(self.messages)
         self.clear()
-        for msg in messages:
-            self.add_message(BaseMessage(
-                content=msg["content"],
-                type=msg["type"],
-            ))
+        try:
+            batch = []
+            for line_number, line in enumerate(lines, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    batch.append(dict_to_message(json_loads(line)))
+                except ValueError as e:
+                    raise ValueError(f"Invalid message on line {line_number}: {e}") from e
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    self.add_messages(batch)
+                    batch = []
+            self.add_messages(batch)
+        except Exception:
+            self.clear()
+            self.add_messages(previous)
+            raise
+
+
+class ChatHistoryManager(ChatHistoryMixin, StreamlitChatMessageHistory):
+    """Chat history kept in streamlit's st.session_state, lost when the server restarts.
+    Messages are kept in a CompactMessageStore, to keep the memory used by each session down.
+    See SQLiteChatHistoryManager for a persistent backend."""
+    key = "langchain_messages"
+
+    def __init__(self):
+        super().__init__(key=self.key)
+        self.init_display_view()
+        log.debug("ChatHistoryManager init complete.")
+
+    @property
+    def messages(self) -> CompactMessageStore:
+        import streamlit as st
+        store = st.session_state.get(self.key)
+        if not isinstance(store, CompactMessageStore):
+            # a list from StreamlitChatMessageHistory, or from before messages were stored compactly
+            store = st.session_state[self.key] = CompactMessageStore(store or ())
+        return store
+
+    @messages.setter
+    def messages(self, value: Iterable[BaseMessage]) -> None:
+        import streamlit as st
+        st.session_state[self.key] = value if isinstance(value, CompactMessageStore) else CompactMessageStore(value)
+
+
+class InMemoryChatHistoryManager(ChatHistoryMixin, BaseChatMessageHistory):
+    """Chat history in memory, for use outside streamlit, eg the chat API, scripts, benchmarks and tests."""
+
+    def __init__(self, messages: Optional[Iterable[BaseMessage]] = None):
+        self.messages: CompactMessageStore = CompactMessageStore()
+        self.init_display_view()
+        if messages:
+            self.add_messages(list(messages))
+
+    def add_message(self, message: BaseMessage) -> None:
+        self.messages.append(message)
+        self._sync_display_messages()
 
-        self.messages = messages 
\ No newline at end of file
+    def clear(self) -> None:
+        self.messages.clear()
+        self._display_messages = []
+        self._display_synced_count = 0
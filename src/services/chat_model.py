@@ -1,79 +1,231 @@
-from typing import ClassVar, Union, Optional, List, Dict, Any
+from concurrent.futures import Future
+from functools import cached_property
+from typing import ClassVar, Union, Optional, List, Dict, Any, Iterator, Tuple, TYPE_CHECKING
 from uuid import UUID
 import pprint
-import traceback
-from pydantic import BaseModel
-from langchain_together import ChatTogether
 from langchain_core.callbacks import BaseCallbackHandler
-from langchain_core.language_models.chat_models import BaseChatModel
-from langchain_core.messages import BaseMessage
-from langchain.chat_models import init_chat_model
-from services.tool_manager import ToolManager   
-from services.chat_history import ChatHistoryManager
-from utils import warn, error, success, dbg_important
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, ToolMessage, message_chunk_to_message
+from services.metrics import MetricsCallbackHandler, observe_tool_turns
+from services.resilience import EventCallback, ResiliencePolicy, ResilientCaller
+from services.response_cache import ResponseCache
+from services.scheduler import LLMScheduler, default_scheduler
+from services.tool_prefetch import ToolCallPrefetcher
+from services.model_registry import (ModelRegistry, TOGETHERAI_MIXTRAL_MODEL, TOGETHERAI_LLAMA3_405B_MODEL,
+                                     TOGETHERAI_LLAMA33_70B_MODEL)
+from utils import get_logger, lazy_pformat, Lazy
 
+if TYPE_CHECKING:
+    # imported on first use, they pull in langchain_together, openai and the tool schemas
+    from langchain_together import ChatTogether
+    from services.chat_history import ChatHistoryManager
+    from services.context_window import ContextWindowBuilder
+    from services.tool_manager import ToolManager
+
+
+log = get_logger(__name__)
+
+# completion tokens charged in the scheduler's tokens per minute bucket when the client has no max_tokens
+DEFAULT_COMPLETION_TOKENS_ESTIMATE = 1024
 
-# Mixtral 8x7B was deprecated 2024/11/30 according to https://docs.mistral.ai/getting-started/models/models_overview/
-TOGETHERAI_MIXTRAL_MODEL = "mistralai/Mixtral-8x7B-Instruct-v0.1"
-TOGETHERAI_LLAMA3_405B_MODEL = "meta-llama/Meta-Llama-3.1-405B-Instruct-Turbo"
-TOGETHERAI_LLAMA33_70B_MODEL = "meta-llama/Llama-3.3-70B-Instruct-Turbo"
-MIXTRAL_STOPS = ["</s>", "[INST]", "[/INST]"]
-LLAMA3_STOPS = ["<|eot_id|>"]
 
 class ChatModelService:
-    def __init__(self, api_key: str):
+    """Chat with tool calling on a Together model.
+
+    Construction is cheap: the client, context window budget, ToolManager and bind_tools() are built
+    on first use, so creating the service does not delay the first page render. Call warm_up() to
+    build them ahead of the first request instead.
+    """
+    # this is how many turns we allow the AI to call tools.  3 for now while debugging, increase to 5 or 10 later.
+    max_tool_turns: ClassVar[int] = 3
+
+    def __init__(self, api_key: str, model_id: str = TOGETHERAI_LLAMA33_70B_MODEL,
+                 response_cache: Optional[ResponseCache] = None, resilience: Optional[ResiliencePolicy] = None,
+                 **model_params):
+        """
+        Args:
+            api_key: Together AI API key
+            model_id: Together model id, any chat model in docs/together-models.sorted.json
+            response_cache: cache for LLM responses, defaults to ResponseCache.from_env(), which is off
+                unless enabled. Only used if temperature is 0.
+            resilience: retries, hedging and fallback models for LLM calls, defaults to ResiliencePolicy.from_env()
+            model_params: ChatTogether params overriding the registry defaults for model_id, eg max_tokens
+        """
         self.api_key = api_key
-        #self.chat_llm_no_tools = self.mixtral_model()
-        #self.chat_llm_no_tools = self.llama_model_405b()
+        self.model_id = model_id
+        self.model_params = model_params
+        self._response_cache_option = ResponseCache.from_env() if response_cache is None else response_cache
+        # optional rate limits and fair queue for LLM requests, shared by all chats in the process.
+        # Cache hits are not limited.
+        self.scheduler: Optional[LLMScheduler] = default_scheduler()
+        self.resilience = ResilientCaller(ResiliencePolicy.from_env() if resilience is None else resilience)
+
+
+    @cached_property
+    def chat_llm_no_tools(self) -> "ChatTogether":
+        return self.get_model(self.model_id, **self.model_params)
+
+
+    @cached_property
+    def tool_manager(self) -> "ToolManager":
+        from services.tool_manager import ToolManager
+        return ToolManager()
+
+
+    @cached_property
+    def context_builder(self) -> "ContextWindowBuilder":
+        from services.context_window import ContextWindowBuilder
+        return ContextWindowBuilder.for_model(self.chat_llm_no_tools.model_name, self.chat_llm_no_tools.max_tokens or 0)
+
+
+    @cached_property
+    def chat_llm(self):
+        """The client with every tool bound, built on the first request.
+        Two threads making the very first request may both build it, which is harmless."""
         try:
-            self.chat_llm_no_tools = self.llama_model_70b()
-            self.tool_manager = ToolManager()
-            dbg_important(f"CHAD: ChatModelService self.chat_llm_no_tools before bind_tools: {self.chat_llm_no_tools}")
-            self.chat_llm = self.chat_llm_no_tools.bind_tools(self.tool_manager.working_tools)
-            success(f"CHAD: ChatModelService bind_tools() SUCCESS! tools={self.tool_manager.working_tools}\n")
+            chat_llm = self.tool_manager.registry.bind(self.chat_llm_no_tools)
         except Exception as e:
-            error(f"CHAD: ChatModelService: {type(e)} Exception:\n{e}\n{repr(e)}\n")
-            error(traceback.format_exc())
-            print("\n\n")
+            log.exception("ChatModelService bind_tools() %s Exception: %r", type(e), e)
             raise e
+        log.info("ChatModelService bind_tools() SUCCESS! tools=%s", self.tool_manager.registry.names())
+        return chat_llm
+
+
+    def model_chain(self, tools: Optional[Tuple[str, ...]] = None) -> Iterator[Tuple[str, Any]]:
+        """(model id, client) to try in order, with the tools named in tools bound, or every tool if None.
+        The fallback clients are only built once the primary fails."""
+        registry = self.tool_manager.registry
+        yield self.model_id, self.chat_llm if tools is None else registry.bind(self.chat_llm_no_tools, tools)
+        for model_id in self.resilience.policy.fallback_models:
+            if model_id != self.model_id:
+                yield model_id, registry.bind(self.get_model(model_id, **self.model_params), tools)
+
+
+    def select_tools(self, messages: List[BaseMessage]) -> Optional[Tuple[str, ...]]:
+        """Names of the tools to send with a request for messages, None for all of them.
+        See ToolRegistry.select_for_messages."""
+        return self.tool_manager.registry.select_for_messages(messages)
+
+
+    @cached_property
+    def response_cache(self) -> Optional[ResponseCache]:
+        return self.usable_response_cache(self._response_cache_option)
+
+
+    @cached_property
+    def cache_namespace(self) -> str:
+        llm = self.chat_llm_no_tools
+        params = {name: getattr(llm, name, None) for name in ("temperature", "max_tokens", "top_p", "stop")}
+        return ResponseCache.namespace(llm.model_name, params, self.tool_manager.registry.schemas())
+
+
+    def warm_up(self) -> None:
+        """Build everything the first request needs, eg at server startup or on a background thread."""
+        self.chat_llm
+        self.context_builder
+        if self.response_cache is not None:
+            self.cache_namespace
+
+
+    def set_response_cache(self, response_cache: Optional[ResponseCache]) -> None:
+        """Use response_cache for LLM calls, or no cache if None or if the model's temperature is not 0."""
+        self.response_cache = self.usable_response_cache(response_cache)
+
+
+    def usable_response_cache(self, response_cache: Optional[ResponseCache]) -> Optional[ResponseCache]:
+        if response_cache is not None and self.chat_llm_no_tools.temperature != 0:
+            log.info("response cache not used, temperature=%s", self.chat_llm_no_tools.temperature)
+            return None
+        return response_cache
+
+
+    def cache_key(self, messages: List[BaseMessage], tools: Optional[Tuple[str, ...]] = None) -> Optional[str]:
+        """Response cache key for messages sent with the tools named in tools, or every tool if None.
+        None if there is no response cache."""
+        if self.response_cache is None:
+            return None
+        namespace = self.cache_namespace if tools is None else f"{self.cache_namespace}:{','.join(tools)}"
+        return ResponseCache.make_key(namespace, messages)
+
+
+    def invoke_llm(self, messages: List[BaseMessage], on_event: Optional[EventCallback] = None) -> AIMessage:
+        """chat_llm.invoke(messages), replayed from the response cache if the same request was made before.
+        Transient errors are retried and slow requests hedged, then the fallback models are tried, see
+        services.resilience. on_event is called with each retry, hedge and fallback."""
+        tools = self.select_tools(messages)
+        key = self.cache_key(messages, tools)
+        cached = self.response_cache.get(key) if key else None
+        if cached is not None:
+            return cached
+
+        tokens = self.estimate_tokens(messages)
+
+        def attempt(model_id: str, llm) -> AIMessage:
+            response_ai_msg = llm.invoke(messages)
+            self.settle_tokens(tokens, response_ai_msg)
+            return response_ai_msg
+
+        # the scheduler wait is outside the attempt, so a full queue does not make the model look slow and hedge
+        acquire = (lambda: self.scheduler.acquire(tokens)) if self.scheduler is not None else None
+        model_id, response_ai_msg = self.resilience.call(attempt, self.model_chain(tools), on_event,
+                                                         acquire=acquire)
+        # a fallback model's answer is not what model_id would have said
+        if key and model_id == self.model_id:
+            self.response_cache.put(key, response_ai_msg)
+        return response_ai_msg
+
+
+    async def ainvoke_llm(self, messages: List[BaseMessage], on_event: Optional[EventCallback] = None) -> AIMessage:
+        """Async version of invoke_llm."""
+        tools = self.select_tools(messages)
+        key = self.cache_key(messages, tools)
+        cached = self.response_cache.get(key) if key else None
+        if cached is not None:
+            return cached
+
+        tokens = self.estimate_tokens(messages)
+
+        async def attempt(model_id: str, llm) -> AIMessage:
+            response_ai_msg = await llm.ainvoke(messages)
+            self.settle_tokens(tokens, response_ai_msg)
+            return response_ai_msg
+
+        acquire = (lambda: self.scheduler.aacquire(tokens)) if self.scheduler is not None else None
+        model_id, response_ai_msg = await self.resilience.acall(attempt, self.model_chain(tools), on_event,
+                                                                acquire=acquire)
+        if key and model_id == self.model_id:
+            self.response_cache.put(key, response_ai_msg)
+        return response_ai_msg
+
+
+    def estimate_tokens(self, messages: List[BaseMessage]) -> int:
+        """Tokens the scheduler charges for a request before its usage is known: the prompt and the max completion.
+        0 if there is no scheduler."""
+        if self.scheduler is None:
+            return 0
+        from services.context_window import TOOL_SCHEMA_RESERVE_TOKENS, count_message_tokens
+        completion_tokens = self.chat_llm_no_tools.max_tokens or DEFAULT_COMPLETION_TOKENS_ESTIMATE
+        return sum(map(count_message_tokens, messages)) + TOOL_SCHEMA_RESERVE_TOKENS + completion_tokens
+
+
+    def settle_tokens(self, estimated: int, response_ai_msg: AIMessage) -> None:
+        """Correct the scheduler's token count with the usage reported in the response, if any."""
+        if self.scheduler is not None:
+            usage = getattr(response_ai_msg, "usage_metadata", None) or {}
+            self.scheduler.settle(estimated, usage.get("total_tokens"))
 
 
-    def mixtral_model(self) -> ChatTogether:
-        if not '_mixtral_model' in self.__dict__:      
-            self._mixtral_model = ChatTogether(
-                model=TOGETHERAI_MIXTRAL_MODEL,
-                together_api_key=self.api_key,
-                max_tokens=512,
-                stop=MIXTRAL_STOPS,
-                top_p=0.9,
-                temperature=0,
-                callbacks=[MyCustomHandler()],
-            )
-        return self._mixtral_model
-
-    def llama_model_405b(self) -> ChatTogether:
-        if not '_llama_model_405b' in self.__dict__:      
-            self._llama_model_405b = ChatTogether(
-                model=TOGETHERAI_LLAMA3_405B_MODEL,
-                together_api_key=self.api_key,
-                max_tokens=1024,
-                stop=LLAMA3_STOPS,
-                temperature=0,
-                callbacks=[MyCustomHandler()],
-            )
-        return self._llama_model_405b
-
-    def llama_model_70b(self) -> ChatTogether:
-        if not '_llama_model_70b' in self.__dict__:        
-            self._llama_model_70b = ChatTogether(
-                model=TOGETHERAI_LLAMA33_70B_MODEL,
-                together_api_key=self.api_key,
-                max_tokens=1024,
-                stop=LLAMA3_STOPS,
-                temperature=0,
-                callbacks=[MyCustomHandler()],
-            )
-        return self._llama_model_70b
+    def get_model(self, model_id: str, **params) -> "ChatTogether":
+        """Memoized ChatTogether client for model_id, see ModelRegistry.get_client"""
+        return model_registry.get_client(model_id, self.api_key, **params)
+
+    def mixtral_model(self) -> "ChatTogether":
+        return self.get_model(TOGETHERAI_MIXTRAL_MODEL)
+
+    def llama_model_405b(self) -> "ChatTogether":
+        return self.get_model(TOGETHERAI_LLAMA3_405B_MODEL)
+
+    def llama_model_70b(self) -> "ChatTogether":
+        return self.get_model(TOGETHERAI_LLAMA33_70B_MODEL)
 
     def get_system_message(self) -> str:
         system_prompt = """
@@ -84,14 +236,22 @@ class ChatModelService:
         return ' '.join(system_prompt.split())
 
 
-    def set_chat_history(self, chat_history: ChatHistoryManager, skip_system_message: bool = False):
+    def set_chat_history(self, chat_history: "ChatHistoryManager", skip_system_message: bool = False):
         self.chat_history = chat_history
         if not skip_system_message:
             # should we check to see if a system message already exists? No, trust the boolean.
             self.chat_history.add_system_message(self.get_system_message())
 
 
-    def generate_response_langchain(self, content: str = None) -> str:
+    def build_context(self, chat_history: "ChatHistoryManager" = None) -> List[BaseMessage]:
+        """Messages to send to the chat llm, chat_history trimmed to fit the model's context window."""
+        chat_history = self.chat_history if chat_history is None else chat_history
+        context = chat_history.get_context_messages(self.context_builder)
+        log.debug("build_context() %d messages for max_prompt_tokens=%d", len(context), self.context_builder.max_prompt_tokens)
+        return context
+
+
+    def generate_response_langchain(self, content: str = None, on_event: Optional[EventCallback] = None) -> str:
         """Generate a chat response using the Langchain API.
         uses the chat_history and the chat_llm to generate a response.
         
@@ -99,45 +259,177 @@ class ChatModelService:
 
         Args:
             content: Content of the message to generate a response for. If None, the last message in the chat_history is used.
+            on_event: called with each LLM retry, hedged request and model fallback, see services.resilience
         Returns:
             str: Generated response text
         """
         if content:
             self.chat_history.add_human_message(content)
 
-        # this is how many turns we allow the AI to call tools.  3 for now while debugging, increase to 5 or 10 later.
-        max_tool_turns = 3
-        remaining_tool_turns = max_tool_turns
+        remaining_tool_turns = self.max_tool_turns
         while remaining_tool_turns > 0:
             remaining_tool_turns -= 1
             # response_ai_msg is a AI Message object, the response from AI to human.
-            dbg_important(f"\nCHAD: generate_response_langchain remaining_tool_turns={remaining_tool_turns} chat_history.messages length={len(self.chat_history.messages)} ")
-            response_ai_msg = self.chat_llm.invoke(self.chat_history.messages)
-            tool_responses = []
-            try:
-                dbg_important("\nCHAD: generate_response_langchain() response_ai_msg: ")
-                pprint.pp(response_ai_msg)
-                tool_responses = self.tool_manager.execute_tool_calls(response_ai_msg)
-            except Exception as e:
-                error(f"\nCHAD: execute_tool_calls failed.\n{e}\n\n")
-                raise e
-            if (tool_responses and len(tool_responses) > 0):
-                # add the AI message with tool_calls to the chat history before adding the response tool messages
-                self.chat_history.add_ai_message(response_ai_msg)
-                for toolmsg in tool_responses:
-                    self.chat_history.add_tool_message(toolmsg)
+            log.debug("generate_response_langchain remaining_tool_turns=%d", remaining_tool_turns)
+            response_ai_msg = self.invoke_llm(self.build_context(), on_event)
+            tools_called = self.handle_tool_calls(response_ai_msg)
+            if not tools_called:
+                break
+
+        return self.finish_response(response_ai_msg, tools_called,
+                                    tool_turns=self.max_tool_turns - remaining_tool_turns)
+
+
+    def stream_response_langchain(self, content: str = None, chat_history: "ChatHistoryManager" = None,
+                                  on_event: Optional[EventCallback] = None) -> Iterator[str]:
+        """Stream a chat response using the Langchain API.
+        Same tool loop as generate_response_langchain, but uses chat_llm.stream() and yields
+        content deltas as soon as they arrive, so the UI can render tokens immediately.
+
+        Tool call chunks are assembled into a complete AIMessage before the tools are executed, except that
+        tools in tool_manager.prefetch_tools start as soon as their arguments are complete, see services.tool_prefetch.
+        Updates the chat_history with the response, maybe multiple times.
+
+        Args:
+            content: Content of the message to generate a response for. If None, the last message in the chat_history is used.
+            chat_history: history to use instead of self.chat_history, so one service can serve many chats concurrently.
+            on_event: called with each LLM retry and model fallback. Only failures before the first chunk are
+                retried, and streams are not hedged.
+        Yields:
+            str: Content deltas of the response text
+        """
+        chat_history = self.chat_history if chat_history is None else chat_history
+        if content:
+            chat_history.add_human_message(content)
+
+        remaining_tool_turns = self.max_tool_turns
+        while remaining_tool_turns > 0:
+            remaining_tool_turns -= 1
+            log.debug("stream_response_langchain remaining_tool_turns=%d", remaining_tool_turns)
+            context = self.build_context(chat_history)
+            tools = self.select_tools(context)
+            key = self.cache_key(context, tools)
+            prefetched = None
+            response_ai_msg = self.response_cache.get(key) if key else None
+            if response_ai_msg is not None:
+                # replayed from the cache, all the content arrives at once
+                if isinstance(response_ai_msg.content, str) and response_ai_msg.content:
+                    yield response_ai_msg.content
             else:
-                #max_tool_turns = 0
+                tokens = self.estimate_tokens(context)
+
+                def stream(model_id: str, llm) -> Iterator[AIMessageChunk]:
+                    if self.scheduler is not None:
+                        self.scheduler.acquire(tokens)
+                    return llm.stream(context)
+
+                model_id, chunks = self.resilience.open_stream(stream, self.model_chain(tools), on_event)
+                prefetcher = ToolCallPrefetcher(self.tool_manager) if self.tool_manager.prefetch_tools else None
+                response_chunk: Optional[AIMessageChunk] = None
+                for chunk in chunks:
+                    # AIMessageChunk supports "+", which merges content and tool_call_chunks by index
+                    response_chunk = chunk if response_chunk is None else response_chunk + chunk
+                    if prefetcher is not None and chunk.tool_call_chunks:
+                        prefetcher.update(response_chunk)
+                    if isinstance(chunk.content, str) and chunk.content:
+                        yield chunk.content
+                if response_chunk is None:
+                    response_chunk = AIMessageChunk(content="")
+                response_ai_msg = message_chunk_to_message(response_chunk)
+                if prefetcher is not None:
+                    prefetched = prefetcher.take(response_ai_msg)
+                self.settle_tokens(tokens, response_ai_msg)
+                if key and model_id == self.model_id:
+                    self.response_cache.put(key, response_ai_msg)
+            tools_called = self.handle_tool_calls(response_ai_msg, chat_history, prefetched)
+            if not tools_called:
                 break
 
-        self.chat_history.add_ai_message(response_ai_msg)
+        self.finish_response(response_ai_msg, tools_called, chat_history,
+                             tool_turns=self.max_tool_turns - remaining_tool_turns)
+
+
+    async def agenerate_response(self, content: str = None, chat_history: "ChatHistoryManager" = None,
+                                 on_event: Optional[EventCallback] = None) -> AIMessage:
+        """Async version of generate_response_langchain, uses chat_llm.ainvoke() and runs tools with
+        tool_manager.aexecute_tool_calls().
+
+        The LLM clients share one pooled HTTP client bound to the shared event loop (see services.async_runtime),
+        so await this on that loop, eg with run_coroutine(service.agenerate_response()) from a sync thread.
 
+        Args:
+            content: Content of the message to generate a response for. If None, the last message in the chat_history is used.
+            chat_history: history to use instead of self.chat_history, so one service can serve many chats concurrently.
+            on_event: called with each LLM retry, hedged request and model fallback, see services.resilience
+        Returns:
+            AIMessage: the final response from the AI
+        """
+        chat_history = self.chat_history if chat_history is None else chat_history
+        if content:
+            chat_history.add_human_message(content)
+
+        remaining_tool_turns = self.max_tool_turns
+        while remaining_tool_turns > 0:
+            remaining_tool_turns -= 1
+            log.debug("agenerate_response remaining_tool_turns=%d", remaining_tool_turns)
+            response_ai_msg = await self.ainvoke_llm(self.build_context(chat_history), on_event)
+            tool_responses = await self.tool_manager.aexecute_tool_calls(response_ai_msg)
+            tools_called = self.add_tool_responses(response_ai_msg, tool_responses, chat_history)
+            if not tools_called:
+                break
+
+        return self.finish_response(response_ai_msg, tools_called, chat_history,
+                                    tool_turns=self.max_tool_turns - remaining_tool_turns)
+
+
+    def handle_tool_calls(self, response_ai_msg: AIMessage, chat_history: "ChatHistoryManager" = None,
+                          prefetched: Optional[Dict[str, Future]] = None) -> bool:
+        """Execute any tool calls requested in response_ai_msg.
+        If tools were called, the AI message and the resulting tool messages are added to the chat_history.
+
+        Args:
+            response_ai_msg: complete AI message from the chat llm
+            chat_history: defaults to self.chat_history
+            prefetched: tool calls of response_ai_msg already started while it streamed, by tool call id
+        Returns:
+            bool: True if tools were called and the chat llm should be invoked again
+        """
+        tool_responses = []
         try:
-            dbg_important(f"CHAD: generate_response_langchain {len(self.chat_history.messages)} chat_history.messages: ")
-            pprint.pp(self.chat_history.messages)
-            print("\n", flush=True)
-        except:
-            dbg_important("CHAD: generate_response_langchain() printing chat_history.messages failed")
+            log.debug("handle_tool_calls() response_ai_msg: %s", lazy_pformat(response_ai_msg))
+            tool_responses = self.tool_manager.execute_tool_calls(response_ai_msg, prefetched)
+        except Exception as e:
+            log.error("execute_tool_calls failed. %r", e)
+            raise e
+        return self.add_tool_responses(response_ai_msg, tool_responses, chat_history)
+
+
+    def add_tool_responses(self, response_ai_msg: AIMessage, tool_responses: List[ToolMessage],
+                           chat_history: "ChatHistoryManager" = None) -> bool:
+        """Add the AI message with tool_calls and its tool messages to the chat history.
+        Returns False, adding nothing, if there are no tool responses."""
+        if not tool_responses:
+            return False
+        chat_history = self.chat_history if chat_history is None else chat_history
+        # add the AI message with tool_calls to the chat history before adding the response tool messages
+        chat_history.add_ai_message(response_ai_msg)
+        for toolmsg in tool_responses:
+            chat_history.add_tool_message(toolmsg)
+        return True
+
+
+    def finish_response(self, response_ai_msg: AIMessage, tools_called: bool,
+                        chat_history: "ChatHistoryManager" = None, tool_turns: Optional[int] = None) -> AIMessage:
+        """Add the final AI message to the chat_history, unless it was already added with its tool calls
+        because max_tool_turns ran out. tool_turns, the LLM calls used for this response, is recorded in metrics."""
+        chat_history = self.chat_history if chat_history is None else chat_history
+        if tool_turns is not None:
+            observe_tool_turns(tool_turns, self.max_tool_turns, exhausted=tools_called)
+        if not tools_called:
+            chat_history.add_ai_message(response_ai_msg)
+
+        # chat_history.messages is only read, and only pretty printed, if debug logging is on
+        log.debug("finish_response chat_history.messages: %s", Lazy(lambda: pprint.pformat(chat_history.messages)))
 
         return response_ai_msg
 
@@ -177,20 +469,24 @@ class ChatModelService:
 class MyCustomHandler(BaseCallbackHandler):
 
     def on_llm_new_token(self, token: str, **kwargs) -> None:
-        print(f"My custom handler, token: {token}")
+        log.debug("My custom handler, token: %r", token)
 
     def on_llm_start(self, serialized: dict[str, Any], prompts: list[str], *, run_id: UUID, 
                      parent_run_id: UUID | None = None, tags: list[str] | None = None, 
                      metadata: dict[str, Any] | None = None, **kwargs: Any) -> None:
         # ATTENTION: This method is called for non-chat models (regular LLMs). 
         # If you’re implementing a handler for a chat model, you should use on_chat_model_start instead.
-        dbg_important(f"CHAD: on_llm_start")
+        log.debug("on_llm_start")
 
     def on_chat_model_start(self, serialized: dict[str, Any], messages: list[list[BaseMessage]], *, run_id: UUID, 
                            parent_run_id: UUID | None = None, tags: list[str] | None = None, 
                            metadata: dict[str, Any] | None = None, **kwargs: Any) -> None:
         # ATTENTION: This method is called for chat models. 
         # If you’re implementing a handler for a non-chat model, you should use on_llm_start instead.
-        dbg_important(f"CHAD: on_chat_model_start {len(messages)}.{len(messages[0])} messages: {messages}")
+        log.debug("on_chat_model_start %d.%d messages: %s", len(messages), len(messages[0]), lazy_pformat(messages))
 
 
+# one handler for all clients, it tracks calls by run_id
+metrics_handler = MetricsCallbackHandler()
+# one registry per process, so every ChatModelService shares the same clients
+model_registry = ModelRegistry(default_callbacks=lambda: [MyCustomHandler(), metrics_handler])
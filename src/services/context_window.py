@@ -0,0 +1,120 @@
+from functools import lru_cache
+from typing import Callable, List, Optional
+import json
+import os
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, ToolMessage
+from services.model_registry import load_model_index
+
+
+# used if the model is not in docs/together-models.sorted.json
+DEFAULT_CONTEXT_LENGTH = 8192
+# tokens kept free for the bound tool schemas, which are sent with every request but are not messages
+TOOL_SCHEMA_RESERVE_TOKENS = 1024
+# per message tokens for role and separators, roughly what OpenAI compatible chat templates add
+MESSAGE_OVERHEAD_TOKENS = 4
+# tiktoken encoding used to count tokens. Llama has its own tokenizer, but counts are close enough for budgeting.
+TIKTOKEN_ENCODING = "cl100k_base"
+
+
+@lru_cache(maxsize=1)
+def get_tokenizer() -> Optional[Callable[[str], List[int]]]:
+    """Load the tokenizer once. Returns None if tiktoken or its encoding file is not available (eg offline)."""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(TIKTOKEN_ENCODING).encode
+    except Exception:
+        return None
+
+
+@lru_cache(maxsize=8192)
+def count_text_tokens(text: str) -> int:
+    """Count tokens in text. Cached, since the same history messages are counted on every LLM call."""
+    encode = get_tokenizer()
+    if encode is None:
+        # about 4 characters per token for english text
+        return (len(text) + 3) // 4
+    return len(encode(text, disallowed_special=()))
+
+
+def count_message_tokens(msg: BaseMessage) -> int:
+    content = msg.content if isinstance(msg.content, str) else json.dumps(msg.content)
+    tokens = MESSAGE_OVERHEAD_TOKENS + count_text_tokens(content)
+    if isinstance(msg, AIMessage) and msg.tool_calls:
+        tokens += count_text_tokens(json.dumps(msg.tool_calls, sort_keys=True))
+    return tokens
+
+
+def get_model_context_length(model_id: str) -> int:
+    """Context length of a Together model, from docs/together-models.sorted.json."""
+    info = load_model_index().get(model_id)
+    return info.context_length if info and info.context_length else DEFAULT_CONTEXT_LENGTH
+
+
+def group_messages(messages: List[BaseMessage]) -> List[List[BaseMessage]]:
+    """Group messages into units that are kept or dropped together.
+    An AIMessage with tool_calls and the ToolMessages after it are one unit, every other message is its own unit.
+    """
+    units: List[List[BaseMessage]] = []
+    for msg in messages:
+        if isinstance(msg, ToolMessage) and units and is_tool_exchange(units[-1]):
+            units[-1].append(msg)
+        else:
+            units.append([msg])
+    return units
+
+
+def is_tool_exchange(unit: List[BaseMessage]) -> bool:
+    return isinstance(unit[0], AIMessage) and bool(unit[0].tool_calls)
+
+
+class ContextWindowBuilder:
+    """Builds the list of messages sent to the LLM so the prompt fits a token budget.
+
+    System messages and the latest turn (the last human message and everything after it) are always kept.
+    If the history is over budget, older tool exchanges are dropped first, oldest first, since the AI answer
+    that followed them usually already has the information. If still over budget, the oldest turns are dropped.
+    An AIMessage with tool_calls is never separated from its ToolMessages.
+    """
+
+    def __init__(self, max_prompt_tokens: int):
+        self.max_prompt_tokens = max_prompt_tokens
+
+
+    @classmethod
+    def for_model(cls, model_id: str, max_completion_tokens: int) -> "ContextWindowBuilder":
+        """Budget is the model's context_length minus room for the completion and tool schemas.
+        The CONTEXT_TOKEN_BUDGET env variable can lower it further.
+        """
+        budget = get_model_context_length(model_id) - max_completion_tokens - TOOL_SCHEMA_RESERVE_TOKENS
+        env_budget = os.getenv("CONTEXT_TOKEN_BUDGET")
+        if env_budget:
+            budget = min(budget, int(env_budget))
+        return cls(budget)
+
+
+    def build(self, messages: List[BaseMessage]) -> List[BaseMessage]:
+        """Returns messages unchanged if they fit the budget, otherwise a trimmed copy of the list."""
+        units = group_messages(messages)
+        unit_tokens = [sum(count_message_tokens(m) for m in unit) for unit in units]
+        total = sum(unit_tokens)
+        if total <= self.max_prompt_tokens:
+            return messages
+
+        last_human = max((i for i, unit in enumerate(units) if isinstance(unit[0], HumanMessage)), default=len(units) - 1)
+        droppable = [i for i in range(last_human) if not isinstance(units[i][0], SystemMessage)]
+        dropped = set()
+        for i in droppable:
+            if total <= self.max_prompt_tokens:
+                break
+            if is_tool_exchange(units[i]):
+                dropped.add(i)
+                total -= unit_tokens[i]
+        # still over budget, drop whole turns, oldest first, so what is left starts with a human message
+        if total > self.max_prompt_tokens:
+            for i in droppable:
+                if total <= self.max_prompt_tokens and isinstance(units[i][0], HumanMessage):
+                    break
+                if i not in dropped:
+                    dropped.add(i)
+                    total -= unit_tokens[i]
+        return [m for i, unit in enumerate(units) if i not in dropped for m in unit]
@@ -0,0 +1,329 @@
+"""
+Record and replay of the HTTP traffic of the LLM clients, so a slow conversation can be captured once
+against the live Together API and profiled or benchmarked again, bit for bit, on an offline machine.
+
+Set in the environment, picked up by the shared HTTP clients in services/async_runtime.py:
+    HTTP_CASSETTE         cassette file, NDJSON with one exchange per line, gzipped if it ends in .gz
+    HTTP_CASSETTE_MODE    "record" to call the API and write every exchange to the cassette, replacing it,
+                          or "replay" to answer from the cassette without any network access
+    HTTP_CASSETTE_TIMING  in replay, "original" to wait as long as the recorded response took, for headers
+                          and for each streamed chunk, or "none" to answer at once. Defaults to "original".
+
+An exchange is the request's method, url and body, and the response's status, headers and body
+chunks, each with the seconds since the request was sent. Request headers are not recorded, so the
+API key never ends up in a cassette, and Set-Cookie response headers are dropped.
+
+Replayed requests are matched on method, url and body, JSON bodies compared with sorted keys.
+Identical requests get their recorded responses in order, starting over after the last one.
+A request that is not in the cassette gets a 404 response, which the openai client does not retry.
+"""
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+import asyncio
+import atexit
+import base64
+import gzip
+import json
+import os
+import threading
+import time
+import httpx
+from utils import get_logger
+
+
+log = get_logger(__name__)
+
+MODES = ("record", "replay")
+TIMINGS = ("original", "none")
+DROPPED_RESPONSE_HEADERS = frozenset({"set-cookie"})
+
+Chunk = Tuple[float, bytes]
+
+
+class Cassette:
+    """The exchanges of one cassette file. In record mode new exchanges are appended to the file
+    as their responses complete, in replay mode the file is read once."""
+
+    def __init__(self, path: str | Path, mode: str = "replay", timing: str = "original"):
+        """
+        Args:
+            path: cassette file, gzipped if it ends in .gz
+            mode: "record" or "replay"
+            timing: in replay, "original" to keep the recorded latencies or "none"
+
+        Raises:
+            ValueError: if mode or timing is not known
+            FileNotFoundError: in replay mode, if the cassette does not exist
+        """
+        if mode not in MODES:
+            raise ValueError(f"unknown cassette mode {mode!r}, expected one of {MODES}")
+        if timing not in TIMINGS:
+            raise ValueError(f"unknown cassette timing {timing!r}, expected one of {TIMINGS}")
+        self.path = Path(path)
+        self.mode = mode
+        self.timing = timing
+        self._lock = threading.Lock()
+        self._file = None
+        self._recorded = 0
+        self._exchanges: Dict[str, List[Dict[str, Any]]] = {}
+        self._next: Dict[str, int] = {}
+        if mode == "replay":
+            self._load()
+
+    @classmethod
+    def from_env(cls) -> Optional["Cassette"]:
+        path = os.getenv("HTTP_CASSETTE")
+        if not path:
+            return None
+        return cls(path, mode=os.getenv("HTTP_CASSETTE_MODE", "replay"),
+                   timing=os.getenv("HTTP_CASSETTE_TIMING", "original"))
+
+    def __len__(self) -> int:
+        return self._recorded if self.mode == "record" else sum(map(len, self._exchanges.values()))
+
+    def record(self, request: httpx.Request, response: httpx.Response, elapsed: float, chunks: List[Chunk]) -> None:
+        exchange = {
+            "request": {"method": request.method, "url": str(request.url), "body": encode_body(request.content)},
+            "status": response.status_code,
+            "headers": [[k, v] for k, v in response.headers.multi_items() if k.lower() not in DROPPED_RESPONSE_HEADERS],
+            "elapsed": round(elapsed, 6),
+            "chunks": [[round(t, 6), encode_body(chunk)] for t, chunk in chunks],
+        }
+        line = json.dumps(exchange, ensure_ascii=False, separators=(",", ":")) + "\n"
+        with self._lock:
+            if self._file is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._file = (gzip.open(self.path, "wt", encoding="utf-8") if self.path.suffix == ".gz"
+                              else open(self.path, "w", encoding="utf-8"))
+                # a gzip file is only complete once closed
+                atexit.register(self.close)
+            self._file.write(line)
+            self._file.flush()
+            self._recorded += 1
+
+    def next_exchange(self, request: httpx.Request) -> Optional[Dict[str, Any]]:
+        """The recorded exchange answering request, None if it is not in the cassette."""
+        key = request_key(request.method, str(request.url), request.content)
+        with self._lock:
+            exchanges = self._exchanges.get(key)
+            if not exchanges:
+                return None
+            i = self._next.get(key, 0)
+            self._next[key] = (i + 1) % len(exchanges)
+            return exchanges[i]
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _load(self) -> None:
+        opener = gzip.open if self.path.suffix == ".gz" else open
+        with opener(self.path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                exchange = json.loads(line)
+                req = exchange["request"]
+                key = request_key(req["method"], req["url"], decode_body(req["body"]))
+                self._exchanges.setdefault(key, []).append(exchange)
+        log.info("replaying %d HTTP exchanges from %s, timing=%s", len(self), self.path, self.timing)
+
+
+def encode_body(body: bytes) -> Any:
+    """body as text if it is utf-8, like JSON and server sent events, else {"b64": base64 text}."""
+    try:
+        return body.decode("utf-8")
+    except UnicodeDecodeError:
+        return {"b64": base64.b64encode(body).decode("ascii")}
+
+
+def decode_body(body: Any) -> bytes:
+    return base64.b64decode(body["b64"]) if isinstance(body, dict) else body.encode("utf-8")
+
+
+def request_key(method: str, url: str, body: bytes) -> str:
+    try:
+        canonical = json.dumps(json.loads(body), sort_keys=True, separators=(",", ":")) if body else ""
+    except ValueError:
+        canonical = body.decode("utf-8", "replace")
+    return f"{method.upper()} {url}\n{canonical}"
+
+
+def not_recorded_response(request: httpx.Request) -> httpx.Response:
+    message = f"{request.method} {request.url} with this body is not in the HTTP cassette"
+    log.error("%s, record it again with HTTP_CASSETTE_MODE=record", message)
+    return httpx.Response(404, json={"error": {"message": message, "type": "cassette_miss"}}, request=request)
+
+
+class RecordingStream(httpx.SyncByteStream):
+    """Passes a response body through, noting when each chunk arrived, and records the exchange when closed."""
+
+    def __init__(self, stream: httpx.SyncByteStream, start: float, on_close: Callable[[List[Chunk]], None]):
+        self._stream = stream
+        self._start = start
+        self._on_close: Optional[Callable[[List[Chunk]], None]] = on_close
+        self._chunks: List[Chunk] = []
+
+    def __iter__(self) -> Iterator[bytes]:
+        for chunk in self._stream:
+            self._chunks.append((time.perf_counter() - self._start, chunk))
+            yield chunk
+
+    def close(self) -> None:
+        try:
+            self._stream.close()
+        finally:
+            on_close, self._on_close = self._on_close, None
+            if on_close is not None:
+                on_close(self._chunks)
+
+
+class AsyncRecordingStream(httpx.AsyncByteStream):
+    """Async version of RecordingStream."""
+
+    def __init__(self, stream: httpx.AsyncByteStream, start: float, on_close: Callable[[List[Chunk]], None]):
+        self._stream = stream
+        self._start = start
+        self._on_close: Optional[Callable[[List[Chunk]], None]] = on_close
+        self._chunks: List[Chunk] = []
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self._stream:
+            self._chunks.append((time.perf_counter() - self._start, chunk))
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            on_close, self._on_close = self._on_close, None
+            if on_close is not None:
+                on_close(self._chunks)
+
+
+class RecordingTransport(httpx.BaseTransport):
+    """Sends requests with the wrapped transport and records every exchange to the cassette."""
+
+    def __init__(self, cassette: Cassette, transport: httpx.BaseTransport):
+        self.cassette = cassette
+        self.transport = transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        request.read()
+        start = time.perf_counter()
+        response = self.transport.handle_request(request)
+        elapsed = time.perf_counter() - start
+        stream = RecordingStream(response.stream, start,
+                                 lambda chunks: self.cassette.record(request, response, elapsed, chunks))
+        return httpx.Response(response.status_code, headers=response.headers, stream=stream,
+                              extensions=response.extensions)
+
+    def close(self) -> None:
+        self.transport.close()
+
+
+class AsyncRecordingTransport(httpx.AsyncBaseTransport):
+    """Async version of RecordingTransport."""
+
+    def __init__(self, cassette: Cassette, transport: httpx.AsyncBaseTransport):
+        self.cassette = cassette
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        start = time.perf_counter()
+        response = await self.transport.handle_async_request(request)
+        elapsed = time.perf_counter() - start
+        stream = AsyncRecordingStream(response.stream, start,
+                                      lambda chunks: self.cassette.record(request, response, elapsed, chunks))
+        return httpx.Response(response.status_code, headers=response.headers, stream=stream,
+                              extensions=response.extensions)
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+class ReplayStream(httpx.SyncByteStream):
+    def __init__(self, chunks: List[List[Any]], start: float, timed: bool):
+        self._chunks = chunks
+        self._start = start
+        self._timed = timed
+
+    def __iter__(self) -> Iterator[bytes]:
+        for t, body in self._chunks:
+            if self._timed:
+                time.sleep(max(0.0, self._start + t - time.perf_counter()))
+            yield decode_body(body)
+
+
+class AsyncReplayStream(httpx.AsyncByteStream):
+    def __init__(self, chunks: List[List[Any]], start: float, timed: bool):
+        self._chunks = chunks
+        self._start = start
+        self._timed = timed
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        for t, body in self._chunks:
+            if self._timed:
+                await asyncio.sleep(max(0.0, self._start + t - time.perf_counter()))
+            yield decode_body(body)
+
+
+class ReplayTransport(httpx.BaseTransport, httpx.AsyncBaseTransport):
+    """Answers requests from the cassette, sync and async, without any network access."""
+
+    def __init__(self, cassette: Cassette):
+        self.cassette = cassette
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        request.read()
+        exchange = self.cassette.next_exchange(request)
+        if exchange is None:
+            return not_recorded_response(request)
+        start = time.perf_counter()
+        timed = self.cassette.timing == "original"
+        if timed:
+            time.sleep(exchange["elapsed"])
+        return httpx.Response(exchange["status"], headers=exchange["headers"],
+                              stream=ReplayStream(exchange["chunks"], start, timed))
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        exchange = self.cassette.next_exchange(request)
+        if exchange is None:
+            return not_recorded_response(request)
+        start = time.perf_counter()
+        timed = self.cassette.timing == "original"
+        if timed:
+            await asyncio.sleep(exchange["elapsed"])
+        return httpx.Response(exchange["status"], headers=exchange["headers"],
+                              stream=AsyncReplayStream(exchange["chunks"], start, timed))
+
+
+@lru_cache(maxsize=1)
+def default_cassette() -> Optional[Cassette]:
+    """The cassette from env variables, shared by the sync and async clients. None if HTTP_CASSETTE is not set."""
+    return Cassette.from_env()
+
+
+def cassette_transport(limits: httpx.Limits) -> Optional[httpx.BaseTransport]:
+    """Transport for a sync client recording to or replaying from the cassette, None without one."""
+    cassette = default_cassette()
+    if cassette is None:
+        return None
+    if cassette.mode == "replay":
+        return ReplayTransport(cassette)
+    return RecordingTransport(cassette, httpx.HTTPTransport(limits=limits))
+
+
+def async_cassette_transport(limits: httpx.Limits) -> Optional[httpx.AsyncBaseTransport]:
+    """Transport for an async client recording to or replaying from the cassette, None without one."""
+    cassette = default_cassette()
+    if cassette is None:
+        return None
+    if cassette.mode == "replay":
+        return ReplayTransport(cassette)
+    return AsyncRecordingTransport(cassette, httpx.AsyncHTTPTransport(limits=limits))
@@ -0,0 +1,173 @@
+"""
+Compact storage for chat history messages, so many sessions can be kept in memory.
+
+A langchain message is a pydantic model with a dozen fields, most of them empty, and a few hundred
+bytes of overhead before its content. CompactMessageStore keeps the same messages as columns:
+    - a bytearray of message type codes
+    - a list of contents
+    - a list of the other fields that are set, None for most human and system messages
+Short strings, such as system prompts shared by every session, tool names and response metadata
+values, are interned so all sessions share one copy. Message objects are only built when read,
+eg when the context for an LLM request is built, and are not kept.
+"""
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, overload
+import sys
+import threading
+from langchain_core.messages import (AIMessage, BaseMessage, HumanMessage, SystemMessage, ToolMessage,
+                                     message_to_dict, messages_from_dict)
+
+
+# strings up to this long are interned, longer ones are rarely repeated
+INTERN_MAX_CHARS = 64
+# message type names by code, other types are added as they are seen
+TYPE_NAMES: List[str] = ["human", "ai", "system", "tool"]
+TYPE_CODES: Dict[str, int] = {name: code for code, name in enumerate(TYPE_NAMES)}
+MESSAGE_CLASSES = {"human": HumanMessage, "ai": AIMessage, "system": SystemMessage, "tool": ToolMessage}
+# field values that are the defaults, so are not stored
+DEFAULT_VALUES: Tuple[Any, ...] = (None, False, "", {}, [])
+
+_type_lock = threading.Lock()
+
+
+def type_code(type_name: str) -> int:
+    code = TYPE_CODES.get(type_name)
+    if code is None:
+        # sessions are written from many threads, two new types must not get the same code
+        with _type_lock:
+            code = TYPE_CODES.get(type_name)
+            if code is None:
+                TYPE_NAMES.append(type_name)
+                code = TYPE_CODES[type_name] = len(TYPE_NAMES) - 1
+    return code
+
+
+def share(value: Any) -> Any:
+    """value with short strings interned, recursing into dicts and lists."""
+    if isinstance(value, str):
+        return sys.intern(value) if len(value) <= INTERN_MAX_CHARS else value
+    if isinstance(value, dict):
+        return {sys.intern(k) if isinstance(k, str) else k: share(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [share(v) for v in value]
+    return value
+
+
+def approx_size(value: Any) -> int:
+    """Bytes used by value, including the dicts and lists in it. Shared strings are counted every time."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(approx_size(k) + approx_size(v) for k, v in value.items())
+    elif isinstance(value, list):
+        size += sum(approx_size(v) for v in value)
+    return size
+
+
+def unshare(value: Any) -> Any:
+    """Copy of the dicts and lists in value, so a message built from the store can be changed safely."""
+    if isinstance(value, dict):
+        return {k: unshare(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [unshare(v) for v in value]
+    return value
+
+
+def message_extras(msg: BaseMessage) -> Optional[Dict[str, Any]]:
+    """The fields of msg other than type and content that are not at their defaults, None if there are none."""
+    data = message_to_dict(msg)["data"]
+    extras = {k: v for k, v in data.items()
+              if k not in ("type", "content") and not any(v == d and type(v) is type(d) for d in DEFAULT_VALUES)}
+    if extras.get("status") == "success":
+        del extras["status"]
+    return share(extras) if extras else None
+
+
+class CompactMessageStore(Sequence[BaseMessage]):
+    """A list of messages stored as columns. Reading an item builds a new message object,
+    so changing a message read from the store does not change the stored message."""
+    __slots__ = ("_types", "_contents", "_extras", "_nbytes")
+
+    def __init__(self, messages: Iterable[BaseMessage] = ()):
+        self._types = bytearray()
+        self._contents: List[Any] = []
+        self._extras: List[Optional[Dict[str, Any]]] = []
+        self._nbytes = 0
+        self.extend(messages)
+
+    def append(self, msg: BaseMessage) -> None:
+        content = msg.content
+        if msg.type == "system" and isinstance(content, str):
+            # the same system prompt starts every session
+            content = sys.intern(content)
+        elif not isinstance(content, str):
+            content = share(content)
+        elif len(content) <= INTERN_MAX_CHARS:
+            content = sys.intern(content)
+        extras = message_extras(msg)
+        self._types.append(type_code(msg.type))
+        self._contents.append(content)
+        self._extras.append(extras)
+        # a type byte and two list slots, plus the content and extras
+        self._nbytes += 17 + approx_size(content) + (approx_size(extras) if extras else 0)
+
+    def extend(self, messages: Iterable[BaseMessage]) -> None:
+        for msg in messages:
+            self.append(msg)
+
+    def clear(self) -> None:
+        self._types = bytearray()
+        self._contents = []
+        self._extras = []
+        self._nbytes = 0
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory used by the messages, for memory limits."""
+        return self._nbytes
+
+    def __len__(self) -> int:
+        return len(self._types)
+
+    @overload
+    def __getitem__(self, index: int) -> BaseMessage: ...
+    @overload
+    def __getitem__(self, index: slice) -> List[BaseMessage]: ...
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._build(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("message index out of range")
+        return self._build(index)
+
+    def __iter__(self) -> Iterator[BaseMessage]:
+        for i in range(len(self)):
+            yield self._build(i)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, (CompactMessageStore, list, tuple)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    __hash__ = None  # mutable, like list
+
+    def __repr__(self) -> str:
+        return f"CompactMessageStore({list(self)!r})"
+
+    def type_at(self, index: int) -> str:
+        return TYPE_NAMES[self._types[index]]
+
+    def content_at(self, index: int) -> Any:
+        """Content of a message, without building the message."""
+        return self._contents[index]
+
+    def _build(self, index: int) -> BaseMessage:
+        type_name = TYPE_NAMES[self._types[index]]
+        content = self._contents[index]
+        fields = {"content": content if isinstance(content, str) else unshare(content),
+                  **unshare(self._extras[index] or {})}
+        cls = MESSAGE_CLASSES.get(type_name)
+        if cls is None:
+            return messages_from_dict([{"type": type_name, "data": fields}])[0]
+        return cls(**fields)
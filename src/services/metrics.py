@@ -0,0 +1,248 @@
+"""
+In-process metrics for the chat request path: LLM latency, time to first token, token counts,
+tool loop turns and per tool latency.
+
+Histograms use fixed buckets, so observe() is a bisect and a few increments under a lock,
+and memory does not grow with traffic. metrics.render_prometheus() returns the Prometheus
+text exposition format, metrics.summaries() the rows shown in the streamlit sidebar.
+"""
+from bisect import bisect_left
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from uuid import UUID
+import threading
+import time
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+
+# seconds, from a cached tool result up to a slow 405B completion
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 64, 256, 1024, 2048, 4096, 8192, 16384, 32768, 131072)
+TOOL_TURN_BUCKETS = (1, 2, 3, 4, 5, 10)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Counter:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value += amount
+
+
+class Gauge(Counter):
+    """A value that goes up and down, eg a queue length."""
+    __slots__ = ()
+
+    def set(self, value: float) -> None:
+        with self._lock:
+            self.value = value
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.inc(-amount)
+
+
+class Histogram:
+    """Counts of observations per bucket, where bucket i counts values <= buckets[i], plus a +Inf bucket."""
+    __slots__ = ("buckets", "counts", "sum", "count", "_lock")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimate the q quantile by linear interpolation inside its bucket, like Prometheus histogram_quantile."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, bucket_count in enumerate(self.counts):
+            if cumulative + bucket_count >= rank and bucket_count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.buckets[-1]
+
+
+class MetricsRegistry:
+    """Named counters, gauges and histograms, each with any number of label sets."""
+
+    def __init__(self):
+        self._metrics: Dict[str, Tuple[str, str, Dict[Labels, Counter | Histogram]]] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help_text: str, **labels: str) -> Counter:
+        return self._get(name, "counter", help_text, labels, None)
+
+    def gauge(self, name: str, help_text: str, **labels: str) -> Gauge:
+        return self._get(name, "gauge", help_text, labels, None)
+
+    def histogram(self, name: str, help_text: str, buckets: Sequence[float] = LATENCY_BUCKETS,
+                  **labels: str) -> Histogram:
+        return self._get(name, "histogram", help_text, labels, buckets)
+
+    def _get(self, name: str, kind: str, help_text: str, labels: Dict[str, str],
+             buckets: Optional[Sequence[float]]) -> Counter | Histogram:
+        key = tuple(sorted(labels.items()))
+        entry = self._metrics.get(name)
+        if entry is not None and key in entry[2]:
+            return entry[2][key]
+        with self._lock:
+            entry = self._metrics.setdefault(name, (kind, help_text, {}))
+            if entry[0] != kind:
+                raise ValueError(f"metric {name} is a {entry[0]}, not a {kind}")
+            children = entry[2]
+            if key not in children:
+                children[key] = Histogram(buckets) if kind == "histogram" else Gauge() if kind == "gauge" else Counter()
+            return children[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._metrics = {}
+
+    def render_prometheus(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            metrics = sorted((name, kind, help_text, list(children.items()))
+                             for name, (kind, help_text, children) in self._metrics.items())
+        for name, kind, help_text, children in metrics:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in sorted(children, key=lambda c: c[0]):
+                if isinstance(metric, Counter):  # and Gauge
+                    lines.append(f"{name}{format_labels(labels)} {format_value(metric.value)}")
+                    continue
+                with metric._lock:
+                    counts, total, count = list(metric.counts), metric.sum, metric.count
+                cumulative = 0
+                for bound, bucket_count in zip(metric.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else format_value(bound)
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {format_value(total)}")
+                lines.append(f"{name}_count{format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def summaries(self) -> List[Dict[str, Any]]:
+        """One row per metric and label set, with count, mean, p50 and p95 for histograms."""
+        rows = []
+        with self._lock:
+            metrics = sorted((name, list(children.items())) for name, (_, _, children) in self._metrics.items())
+        for name, children in metrics:
+            for labels, metric in children:
+                row = {"metric": name, "labels": ",".join(f"{k}={v}" for k, v in labels)}
+                if isinstance(metric, Counter):
+                    row.update(count=metric.value, mean=None, p50=None, p95=None)
+                else:
+                    row.update(count=metric.count, mean=metric.sum / metric.count if metric.count else None,
+                               p50=metric.quantile(0.5), p95=metric.quantile(0.95))
+                rows.append(row)
+        return rows
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{escape_label_value(v)}"' for k, v in labels) + "}"
+
+
+def escape_label_value(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+# one registry per process, shared by every ChatModelService and ToolManager
+metrics = MetricsRegistry()
+
+
+def observe_tool_call(tool_name: str, seconds: float, status: str) -> None:
+    metrics.histogram("toolchat7_tool_call_seconds", "Tool execution time, cache hits excluded",
+                      tool=tool_name, status=status).observe(seconds)
+
+
+def observe_tool_turns(turns: int, max_tool_turns: int, exhausted: bool) -> None:
+    """Record how many LLM calls one response used out of max_tool_turns."""
+    metrics.histogram("toolchat7_tool_turns", "LLM calls per response, including tool loop turns",
+                      TOOL_TURN_BUCKETS).observe(turns)
+    if exhausted:
+        metrics.counter("toolchat7_tool_turns_exhausted_total",
+                        "Responses that still requested tools after max_tool_turns",
+                        max_tool_turns=str(max_tool_turns)).inc()
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """Records per LLM call latency, time to first token and token usage in metrics.
+    One handler can be shared by all clients, calls are tracked by run_id.
+    Time to first token is only recorded for streamed calls, since invoke() gets no token callbacks.
+    """
+
+    def __init__(self, registry: MetricsRegistry = metrics):
+        self.registry = registry
+        # run_id -> [start time, model, first token seen]
+        self._runs: Dict[UUID, List[Any]] = {}
+
+    def on_chat_model_start(self, serialized: dict[str, Any], messages: list[list[Any]], *, run_id: UUID,
+                            metadata: dict[str, Any] | None = None, **kwargs: Any) -> None:
+        model = (metadata or {}).get("ls_model_name") or (serialized or {}).get("kwargs", {}).get("model") or "unknown"
+        self._runs[run_id] = [time.perf_counter(), model, False]
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> None:
+        run = self._runs.get(run_id)
+        if run is not None and not run[2]:
+            run[2] = True
+            self.registry.histogram("toolchat7_llm_time_to_first_token_seconds",
+                                    "Time from LLM request to first streamed token",
+                                    model=run[1]).observe(time.perf_counter() - run[0])
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        start, model, _ = run
+        self.registry.histogram("toolchat7_llm_call_seconds", "LLM call latency",
+                                model=model).observe(time.perf_counter() - start)
+        prompt_tokens, completion_tokens = token_usage(response)
+        if prompt_tokens is not None:
+            self.registry.histogram("toolchat7_llm_prompt_tokens", "Prompt tokens per LLM call",
+                                    TOKEN_BUCKETS, model=model).observe(prompt_tokens)
+        if completion_tokens is not None:
+            self.registry.histogram("toolchat7_llm_completion_tokens", "Completion tokens per LLM call",
+                                    TOKEN_BUCKETS, model=model).observe(completion_tokens)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        run = self._runs.pop(run_id, None)
+        model = run[1] if run else "unknown"
+        self.registry.counter("toolchat7_llm_errors_total", "LLM calls that raised",
+                              model=model, error=type(error).__name__).inc()
+
+
+def token_usage(response: LLMResult) -> Tuple[Optional[int], Optional[int]]:
+    """(prompt tokens, completion tokens) from the message usage_metadata, or the OpenAI style llm_output."""
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                return usage.get("input_tokens"), usage.get("output_tokens")
+    usage = (response.llm_output or {}).get("token_usage") or {}
+    return usage.get("prompt_tokens"), usage.get("completion_tokens")
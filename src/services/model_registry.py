@@ -0,0 +1,220 @@
+from bisect import bisect_left
+from dataclasses import dataclass, field
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple, TYPE_CHECKING
+import hashlib
+import json
+import os
+import pickle
+import threading
+from services.async_runtime import get_http_client, get_async_http_client
+
+if TYPE_CHECKING:
+    from langchain_together import ChatTogether
+
+
+TOGETHER_MODELS_JSON = Path(__file__).resolve().parents[2] / "docs" / "together-models.sorted.json"
+# parsed model index is cached here, set TOOLCHAT7_CACHE_DIR to change
+CACHE_DIR = Path(os.getenv("TOOLCHAT7_CACHE_DIR", Path.home() / ".cache" / "toolchat7"))
+# bump when ModelInfo or ModelIndex changes, so old pickles are ignored
+MODEL_INDEX_VERSION = 1
+
+# Mixtral 8x7B was deprecated 2024/11/30 according to https://docs.mistral.ai/getting-started/models/models_overview/
+TOGETHERAI_MIXTRAL_MODEL = "mistralai/Mixtral-8x7B-Instruct-v0.1"
+TOGETHERAI_LLAMA3_405B_MODEL = "meta-llama/Meta-Llama-3.1-405B-Instruct-Turbo"
+TOGETHERAI_LLAMA33_70B_MODEL = "meta-llama/Llama-3.3-70B-Instruct-Turbo"
+MIXTRAL_STOPS = ["</s>", "[INST]", "[/INST]"]
+LLAMA3_STOPS = ["<|eot_id|>"]
+
+# ChatTogether params used for every model, MODEL_PARAMS and get_client() params override these.
+DEFAULT_CHAT_PARAMS: Dict[str, Any] = {
+    "max_tokens": 1024,
+    "temperature": 0,
+    # retries are done by services/resilience.py, which backs off, reports them and falls back to other models
+    "max_retries": 0,
+}
+# Per model ChatTogether params. Models not listed here use the stop tokens from together-models.sorted.json.
+MODEL_PARAMS: Dict[str, Dict[str, Any]] = {
+    TOGETHERAI_MIXTRAL_MODEL: {"max_tokens": 512, "stop": MIXTRAL_STOPS, "top_p": 0.9},
+    TOGETHERAI_LLAMA3_405B_MODEL: {"stop": LLAMA3_STOPS},
+    TOGETHERAI_LLAMA33_70B_MODEL: {"stop": LLAMA3_STOPS},
+}
+
+
+@dataclass(frozen=True)
+class ModelInfo:
+    """The fields we use from one model in together-models.sorted.json"""
+    id: str
+    type: str
+    organization: str
+    display_name: str
+    context_length: int
+    input_price: float
+    output_price: float
+    stop: Tuple[str, ...] = ()
+
+    @property
+    def price(self) -> float:
+        return self.input_price + self.output_price
+
+    @classmethod
+    def from_json(cls, model: Dict[str, Any]) -> "ModelInfo":
+        pricing = model.get("pricing") or {}
+        config = model.get("config") or {}
+        return cls(
+            id=model["id"],
+            type=model.get("type") or "",
+            organization=model.get("organization") or "",
+            display_name=model.get("display_name") or model["id"],
+            context_length=model.get("context_length") or 0,
+            input_price=pricing.get("input") or 0.0,
+            output_price=pricing.get("output") or 0.0,
+            stop=tuple(config.get("stop") or ()),
+        )
+
+
+@dataclass
+class ModelIndex:
+    """Models indexed by id, type, organization, context length and price."""
+    by_id: Dict[str, ModelInfo] = field(default_factory=dict)
+    by_type: Dict[str, List[ModelInfo]] = field(default_factory=dict)
+    by_organization: Dict[str, List[ModelInfo]] = field(default_factory=dict)
+    # sorted ascending, with parallel key lists for bisect
+    by_context_length: List[ModelInfo] = field(default_factory=list)
+    context_lengths: List[int] = field(default_factory=list)
+    by_price: List[ModelInfo] = field(default_factory=list)
+
+    @classmethod
+    def from_models(cls, models: List[ModelInfo]) -> "ModelIndex":
+        index = cls()
+        for model in models:
+            index.by_id[model.id] = model
+            index.by_type.setdefault(model.type, []).append(model)
+            index.by_organization.setdefault(model.organization, []).append(model)
+        index.by_context_length = sorted(models, key=lambda m: (m.context_length, m.id))
+        index.context_lengths = [m.context_length for m in index.by_context_length]
+        index.by_price = sorted(models, key=lambda m: (m.price, m.id))
+        return index
+
+    def get(self, model_id: str) -> Optional[ModelInfo]:
+        return self.by_id.get(model_id)
+
+    def of_type(self, model_type: str) -> List[ModelInfo]:
+        return self.by_type.get(model_type, [])
+
+    def of_organization(self, organization: str) -> List[ModelInfo]:
+        return self.by_organization.get(organization, [])
+
+    def with_min_context(self, context_length: int, model_type: Optional[str] = None) -> List[ModelInfo]:
+        """Models with at least context_length tokens, smallest context first."""
+        models = self.by_context_length[bisect_left(self.context_lengths, context_length):]
+        return [m for m in models if model_type is None or m.type == model_type]
+
+    def cheapest(self, model_type: Optional[str] = None, min_context: int = 0) -> List[ModelInfo]:
+        """Models sorted by input + output price, cheapest first."""
+        return [m for m in self.by_price
+                if (model_type is None or m.type == model_type) and m.context_length >= min_context]
+
+
+@lru_cache(maxsize=None)
+def load_model_index(json_path: Path = TOGETHER_MODELS_JSON, cache_dir: Path = CACHE_DIR) -> ModelIndex:
+    """Load the model index once per process.
+    The parsed index is pickled in cache_dir, keyed on the json file's path, size and mtime,
+    so later process starts skip parsing the json.
+    """
+    stat = os.stat(json_path)
+    cache_key = f"{json_path}:{stat.st_size}:{stat.st_mtime_ns}:{MODEL_INDEX_VERSION}"
+    cache_file = Path(cache_dir) / f"model-index-{hashlib.sha1(cache_key.encode()).hexdigest()[:16]}.pickle"
+    try:
+        with open(cache_file, "rb") as f:
+            return pickle.load(f)
+    except Exception:
+        pass  # missing or stale cache, rebuild below
+
+    with open(json_path) as f:
+        index = ModelIndex.from_models([ModelInfo.from_json(m) for m in json.load(f)])
+    try:
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_file, "wb") as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        pass  # read-only home dir etc, just parse again next start
+    return index
+
+
+def freeze(value: Any) -> Hashable:
+    """Hashable version of a ChatTogether param, for memoizing clients."""
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return ("id", id(value))
+
+
+class ModelRegistry:
+    """Creates ChatTogether clients on first use and memoizes them per (model, api key, params),
+    so switching models or using several at once needs no code change and unused clients are never built.
+    """
+
+    def __init__(self, index: Optional[ModelIndex] = None,
+                 default_callbacks: Optional[Callable[[], List[Any]]] = None):
+        """
+        Args:
+            index: model index, defaults to load_model_index()
+            default_callbacks: returns the callbacks for each new client, eg lambda: [MyCustomHandler()]
+        """
+        self._index = index
+        self.default_callbacks = default_callbacks
+        self._clients: Dict[Hashable, "ChatTogether"] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def index(self) -> ModelIndex:
+        if self._index is None:
+            self._index = load_model_index()
+        return self._index
+
+    def get_params(self, model_id: str, **params) -> Dict[str, Any]:
+        """ChatTogether params for model_id: defaults, then MODEL_PARAMS or stops from the index, then params."""
+        merged = dict(DEFAULT_CHAT_PARAMS)
+        if model_id in MODEL_PARAMS:
+            merged.update(MODEL_PARAMS[model_id])
+        else:
+            info = self.index.get(model_id)
+            if info and info.stop:
+                merged["stop"] = list(info.stop)
+        merged.update(params)
+        return merged
+
+    def get_client(self, model_id: str, api_key: str, **params) -> "ChatTogether":
+        """Return the memoized ChatTogether client for model_id and params, creating it on first use."""
+        # imported here, langchain_together and openai are slow to import and only needed once a client is used
+        from langchain_together import ChatTogether
+        params = self.get_params(model_id, **params)
+        key = (model_id, api_key, freeze(params))
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                if "callbacks" not in params and self.default_callbacks:
+                    params["callbacks"] = self.default_callbacks()
+                client = ChatTogether(
+                    model=model_id,
+                    together_api_key=api_key,
+                    http_client=get_http_client(),
+                    http_async_client=get_async_http_client(),
+                    **params,
+                )
+                self._clients[key] = client
+            return client
+
+    def clients(self) -> List["ChatTogether"]:
+        """Clients created so far."""
+        with self._lock:
+            return list(self._clients.values())
@@ -0,0 +1,64 @@
+"""
+Request rate limiting shared by every caller in the process, eg all conversations of a batch run.
+"""
+from typing import Optional
+import asyncio
+import threading
+import time
+
+
+class RateLimiter:
+    """Token bucket allowing rate requests per second on average, and bursts of up to burst requests.
+
+    Callers reserve tokens and then wait outside the lock, so the same limiter can be used from threads
+    with acquire() and from coroutines with aacquire(), and waiters are served in order of arrival.
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        """
+        Args:
+            rate: tokens added per second
+            burst: bucket size, defaults to max(1, rate)
+        """
+        if rate <= 0:
+            raise ValueError(f"rate must be positive, got {rate}")
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, tokens: float = 1.0) -> float:
+        """Take tokens from the bucket, going into debt if needed. Returns the seconds to wait before using them."""
+        with self._lock:
+            self._refill()
+            self._tokens -= tokens
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def wait_time(self, tokens: float = 1.0) -> float:
+        """Seconds until tokens are available, without taking them."""
+        with self._lock:
+            self._refill()
+            return max(0.0, tokens - self._tokens) / self.rate
+
+    def refund(self, tokens: float) -> None:
+        """Return tokens that were reserved but not used, eg an estimate that was too high.
+        Negative tokens charge the bucket for an estimate that was too low."""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.burst, self._tokens + tokens)
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def aacquire(self, tokens: float = 1.0) -> None:
+        delay = self.reserve(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
@@ -0,0 +1,304 @@
+"""
+Retries, hedged requests and model fallback around LLM calls, to cut tail latency and failed turns.
+
+For each model in the chain, primary first:
+    - transient errors (timeouts, connection errors, 429 and 5xx) are retried with full jitter exponential backoff
+    - if hedging is on, a duplicate request is sent when the first has not answered by the hedge deadline,
+      by default the model's recent p95 latency, and whichever answers first is used
+    - when retries run out, the next model in the chain is tried
+    - a non transient error, eg a 400 bad request or a too long context, is raised at once, since every
+      model would be sent the same request
+Every retry, hedge and fallback is passed to the caller's on_event callback, logged and counted in metrics.
+
+Configured from env variables, see ResiliencePolicy.from_env():
+    LLM_MAX_RETRIES      retries per model on transient errors, defaults to 2
+    LLM_HEDGE            "p95" to hedge after the model's p95 latency, or seconds, off by default
+    LLM_FALLBACK_MODELS  comma separated model ids tried in order after the primary model
+"""
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from itertools import chain
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
+import asyncio
+import contextvars
+import os
+import random
+import threading
+import time
+from services.metrics import metrics
+from utils import get_logger
+
+
+log = get_logger(__name__)
+
+T = TypeVar("T")
+# (model id, client) pairs, primary model first
+ModelChain = Iterable[Tuple[str, Any]]
+EventCallback = Callable[["ResilienceEvent"], None]
+
+TRANSIENT_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504}
+# openai and httpx exceptions, matched by name so neither has to be imported here
+TRANSIENT_ERROR_NAMES = {
+    "APITimeoutError", "APIConnectionError", "RateLimitError", "InternalServerError",
+    "TimeoutException", "ConnectTimeout", "ReadTimeout", "WriteTimeout", "PoolTimeout",
+    "ConnectError", "ReadError", "RemoteProtocolError",
+}
+# latencies kept per model for the p95 hedge deadline, and how many are needed before hedging
+LATENCY_WINDOW = 200
+MIN_HEDGE_SAMPLES = 20
+# threads for hedged sync calls, the first attempt runs on one while the caller waits for the deadline
+HEDGE_WORKERS = 32
+
+
+def is_transient(error: BaseException) -> bool:
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    if status is not None:
+        return status in TRANSIENT_STATUS_CODES
+    return isinstance(error, (TimeoutError, ConnectionError)) or any(
+        cls.__name__ in TRANSIENT_ERROR_NAMES for cls in type(error).__mro__)
+
+
+@dataclass(frozen=True)
+class ResilienceEvent:
+    kind: str  # "retry", "hedge", "hedge_won" or "fallback"
+    model: str
+    attempt: int
+    detail: str = ""
+    delay: float = 0.0
+
+    def __str__(self) -> str:
+        if self.kind == "retry":
+            return f"Retrying {self.model} in {self.delay:.1f}s after {self.detail}"
+        if self.kind == "hedge":
+            return f"{self.model} slower than {self.delay:.1f}s, sent a second request"
+        if self.kind == "hedge_won":
+            return f"{self.model} second request answered first"
+        return f"Falling back to {self.model} after {self.detail}"
+
+
+@dataclass
+class ResiliencePolicy:
+    max_retries: int = 2
+    # seconds of the first backoff, doubled each retry up to max_delay, with full jitter
+    base_delay: float = 0.5
+    max_delay: float = 8.0
+    # None for no hedging, "p95" for the model's recent p95 latency, or a fixed number of seconds
+    hedge: Optional[str | float] = None
+    fallback_models: List[str] = field(default_factory=list)
+
+    @classmethod
+    def from_env(cls) -> "ResiliencePolicy":
+        hedge = os.getenv("LLM_HEDGE", "").strip().lower() or None
+        if hedge not in (None, "off", "p95"):
+            hedge = float(hedge)
+        return cls(
+            max_retries=int(os.getenv("LLM_MAX_RETRIES", "2")),
+            hedge=None if hedge == "off" else hedge,
+            fallback_models=[m.strip() for m in os.getenv("LLM_FALLBACK_MODELS", "").split(",") if m.strip()],
+        )
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class LatencyTracker:
+    """Recent successful call latencies of one model."""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._latencies: Deque[float] = deque(maxlen=window)
+
+    def add(self, seconds: float) -> None:
+        self._latencies.append(seconds)
+
+    def p95(self) -> Optional[float]:
+        if len(self._latencies) < MIN_HEDGE_SAMPLES:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[int(len(latencies) * 0.95)]
+
+
+class ResilientCaller:
+    """Runs one LLM request with retries, hedging and fallback along a model chain.
+
+    The request is given as a function of (model id, client), so the caller decides how each attempt is
+    made, eg client.invoke(messages) behind a rate limit.
+    """
+    _hedge_executor: Optional[ThreadPoolExecutor] = None
+    _hedge_executor_lock = threading.Lock()
+
+    def __init__(self, policy: Optional[ResiliencePolicy] = None):
+        self.policy = policy or ResiliencePolicy()
+        self.latencies: Dict[str, LatencyTracker] = {}
+
+    def hedge_delay(self, model: str) -> Optional[float]:
+        if self.policy.hedge is None:
+            return None
+        if self.policy.hedge == "p95":
+            return self.tracker(model).p95()
+        return float(self.policy.hedge)
+
+    def tracker(self, model: str) -> LatencyTracker:
+        tracker = self.latencies.get(model)
+        if tracker is None:
+            tracker = self.latencies.setdefault(model, LatencyTracker())
+        return tracker
+
+    def report(self, on_event: Optional[EventCallback], event: ResilienceEvent) -> None:
+        log.warning("%s", event)
+        metrics.counter("toolchat7_llm_resilience_events_total", "LLM retries, hedges and fallbacks",
+                        kind=event.kind, model=event.model).inc()
+        if on_event is not None:
+            try:
+                on_event(event)
+            except Exception as e:
+                log.warning("on_event callback failed: %r", e)
+
+    def call(self, attempt_fn: Callable[[str, Any], T], models: ModelChain,
+             on_event: Optional[EventCallback] = None, hedge: bool = True,
+             acquire: Optional[Callable[[], Any]] = None) -> Tuple[str, T]:
+        """Returns (model that answered, result of attempt_fn).
+        acquire is called before every request is sent, eg to wait for the scheduler. Its wait is not
+        latency of the model, so the hedge deadline and the p95 start once it returns.
+
+        Raises:
+            a non transient error at once, or the last error once every model in the chain has failed
+        """
+        last_error: Optional[BaseException] = None
+        for index, (model, client) in enumerate(models):
+            if index:
+                self.report(on_event, ResilienceEvent("fallback", model, 0, repr(last_error)))
+            for attempt in range(self.policy.max_retries + 1):
+                try:
+                    return model, self.call_hedged(attempt_fn, model, client, on_event, hedge, acquire)
+                except Exception as e:
+                    if not is_transient(e):
+                        raise
+                    last_error = e
+                    if attempt == self.policy.max_retries:
+                        break
+                    delay = self.policy.backoff(attempt)
+                    self.report(on_event, ResilienceEvent("retry", model, attempt + 1, repr(e), delay))
+                    time.sleep(delay)
+        raise last_error
+
+    async def acall(self, attempt_fn: Callable[[str, Any], Awaitable[T]], models: ModelChain,
+                    on_event: Optional[EventCallback] = None,
+                    acquire: Optional[Callable[[], Awaitable[Any]]] = None) -> Tuple[str, T]:
+        """Async version of call."""
+        last_error: Optional[BaseException] = None
+        for index, (model, client) in enumerate(models):
+            if index:
+                self.report(on_event, ResilienceEvent("fallback", model, 0, repr(last_error)))
+            for attempt in range(self.policy.max_retries + 1):
+                try:
+                    return model, await self.acall_hedged(attempt_fn, model, client, on_event, acquire)
+                except Exception as e:
+                    if not is_transient(e):
+                        raise
+                    last_error = e
+                    if attempt == self.policy.max_retries:
+                        break
+                    delay = self.policy.backoff(attempt)
+                    self.report(on_event, ResilienceEvent("retry", model, attempt + 1, repr(e), delay))
+                    await asyncio.sleep(delay)
+        raise last_error
+
+    def open_stream(self, stream_fn: Callable[[str, Any], Iterator[T]], models: ModelChain,
+                    on_event: Optional[EventCallback] = None) -> Tuple[str, Iterator[T]]:
+        """Start a streamed request, retrying and falling back until the first chunk arrives.
+        Returns (model, iterator of all chunks). Errors after the first chunk are raised to the caller,
+        since part of the answer has already been shown. Streams are not hedged."""
+        def first_chunk(model: str, client: Any) -> Iterator[T]:
+            chunks = iter(stream_fn(model, client))
+            try:
+                first = next(chunks)
+            except StopIteration:
+                return iter(())
+            return chain([first], chunks)
+
+        return self.call(first_chunk, models, on_event, hedge=False)
+
+    def call_hedged(self, attempt_fn: Callable[[str, Any], T], model: str, client: Any,
+                    on_event: Optional[EventCallback], hedge: bool = True,
+                    acquire: Optional[Callable[[], Any]] = None) -> T:
+        if acquire is not None:
+            acquire()
+        delay = self.hedge_delay(model) if hedge else None
+        start = time.perf_counter()
+        if delay is None:
+            result = attempt_fn(model, client)
+            if hedge:  # stream attempts only time the first chunk, and are kept out of the p95
+                self.tracker(model).add(time.perf_counter() - start)
+            return result
+
+        def hedge_attempt(model: str, client: Any) -> T:
+            if acquire is not None:
+                acquire()
+            return attempt_fn(model, client)
+
+        executor = self.get_hedge_executor()
+        # the attempts run on the hedge threads in a copy of the caller's context, so they keep its request_scope()
+        first = executor.submit(contextvars.copy_context().run, attempt_fn, model, client)
+        done, _ = wait([first], timeout=delay)
+        if done:
+            result = first.result()
+            self.tracker(model).add(time.perf_counter() - start)
+            return result
+        self.report(on_event, ResilienceEvent("hedge", model, 0, delay=delay))
+        second = executor.submit(contextvars.copy_context().run, hedge_attempt, model, client)
+        pending = {first, second}
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    # the other request keeps running on its thread, a sync call cannot be interrupted
+                    if future is second:
+                        self.report(on_event, ResilienceEvent("hedge_won", model, 0))
+                    self.tracker(model).add(time.perf_counter() - start)
+                    return future.result()
+                error = error or future.exception()
+        raise error
+
+    async def acall_hedged(self, attempt_fn: Callable[[str, Any], Awaitable[T]], model: str, client: Any,
+                           on_event: Optional[EventCallback],
+                           acquire: Optional[Callable[[], Awaitable[Any]]] = None) -> T:
+        async def hedge_attempt(model: str, client: Any) -> T:
+            if acquire is not None:
+                await acquire()
+            return await attempt_fn(model, client)
+
+        if acquire is not None:
+            await acquire()
+        delay = self.hedge_delay(model)
+        start = time.perf_counter()
+        first = asyncio.ensure_future(attempt_fn(model, client))
+        tasks = {first}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                self.report(on_event, ResilienceEvent("hedge", model, 0, delay=delay))
+                tasks.add(asyncio.ensure_future(hedge_attempt(model, client)))
+            error: Optional[BaseException] = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self.report(on_event, ResilienceEvent("hedge_won", model, 0))
+                        self.tracker(model).add(time.perf_counter() - start)
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @classmethod
+    def get_hedge_executor(cls) -> ThreadPoolExecutor:
+        with cls._hedge_executor_lock:
+            if cls._hedge_executor is None:
+                cls._hedge_executor = ThreadPoolExecutor(HEDGE_WORKERS, thread_name_prefix="toolchat7-hedge")
+            return cls._hedge_executor
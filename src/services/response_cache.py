@@ -0,0 +1,194 @@
+"""
+Opt-in cache of LLM responses, for clients with temperature=0 where the same request gives the same answer.
+
+Keyed on a sha256 of the model id, the sampling params, the bound tool schemas and the messages sent,
+so a cached AIMessage, tool_calls included, is only replayed for exactly the same request.
+Two tiers: an in-memory LRU, and optionally a directory of JSON files with size-based eviction
+that survives restarts and is shared by every process using the same directory.
+
+Configured from env variables, see ResponseCache.from_env():
+    RESPONSE_CACHE         True to enable the in-memory tier
+    RESPONSE_CACHE_DIR     directory for the on-disk tier, enables the cache
+    RESPONSE_CACHE_MAX_MB  max size of the on-disk tier, defaults to 64
+"""
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Sequence
+import hashlib
+import json
+import os
+import threading
+from langchain_core.messages import AIMessage, BaseMessage, message_to_dict, messages_from_dict
+from services.metrics import metrics
+from utils import get_logger
+
+
+log = get_logger(__name__)
+
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_MAX_DISK_BYTES = 64 * 1024 * 1024
+# when the disk tier is over its size, evict down to this fraction of it, so eviction runs rarely
+DISK_EVICT_TO = 0.9
+# responses cut short are not worth replaying
+CACHEABLE_FINISH_REASONS = {None, "stop", "tool_calls", "eos"}
+
+
+def request_fields(msg: BaseMessage) -> Dict[str, Any]:
+    """The parts of a message that are sent to the LLM. Ids, usage and response metadata vary between
+    identical requests, so they are left out of the cache key."""
+    fields: Dict[str, Any] = {"type": msg.type, "content": msg.content}
+    if isinstance(msg, AIMessage) and msg.tool_calls:
+        fields["tool_calls"] = [{"name": c["name"], "args": c["args"], "id": c["id"]} for c in msg.tool_calls]
+    for attr in ("tool_call_id", "name"):
+        value = getattr(msg, attr, None)
+        if value:
+            fields[attr] = value
+    return fields
+
+
+def stable_hash(obj: Any) -> str:
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, default=str, separators=(",", ":")).encode()).hexdigest()
+
+
+def is_cacheable(response: AIMessage) -> bool:
+    finish_reason = (response.response_metadata or {}).get("finish_reason")
+    return finish_reason in CACHEABLE_FINISH_REASONS and bool(response.content or response.tool_calls)
+
+
+class ResponseCache:
+    """LLM responses by request hash, in an LRU in memory and optionally in files under disk_dir."""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, disk_dir: Optional[str | Path] = None,
+                 max_disk_bytes: int = DEFAULT_MAX_DISK_BYTES):
+        """
+        Args:
+            max_entries: responses kept in memory
+            disk_dir: directory for the on-disk tier, None for memory only
+            max_disk_bytes: the least recently used files are deleted when the directory grows past this
+        """
+        self.max_entries = max_entries
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.max_disk_bytes = max_disk_bytes
+        self._memory: OrderedDict[str, Dict[str, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = 0
+        if self.disk_dir:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            self._disk_bytes = sum(f.stat().st_size for f in self.disk_dir.glob("*/*.json"))
+
+    @classmethod
+    def from_env(cls) -> Optional["ResponseCache"]:
+        """ResponseCache configured from RESPONSE_CACHE*, or None if the cache is not enabled."""
+        disk_dir = os.getenv("RESPONSE_CACHE_DIR")
+        enabled = os.getenv("RESPONSE_CACHE", "").lower() in ("1", "true", "yes")
+        if not (enabled or disk_dir):
+            return None
+        max_mb = float(os.getenv("RESPONSE_CACHE_MAX_MB", DEFAULT_MAX_DISK_BYTES / 1024 / 1024))
+        return cls(disk_dir=disk_dir, max_disk_bytes=int(max_mb * 1024 * 1024))
+
+    @staticmethod
+    def namespace(model_id: str, params: Dict[str, Any], tool_schemas: Sequence[Dict[str, Any]]) -> str:
+        """Hash of everything but the messages, computed once per client."""
+        return stable_hash({"model": model_id, "params": params, "tools": list(tool_schemas)})
+
+    @staticmethod
+    def make_key(namespace: str, messages: Sequence[BaseMessage]) -> str:
+        return stable_hash({"namespace": namespace, "messages": [request_fields(m) for m in messages]})
+
+    def get(self, key: str) -> Optional[AIMessage]:
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+        if data is not None:
+            self.count("memory_hit")
+            return messages_from_dict([data])[0]
+        data = self._read_disk(key)
+        if data is not None:
+            self._remember(key, data)
+            self.count("disk_hit")
+            return messages_from_dict([data])[0]
+        self.count("miss")
+        return None
+
+    def put(self, key: str, response: AIMessage) -> None:
+        if not is_cacheable(response):
+            return
+        data = message_to_dict(response)
+        self._remember(key, data)
+        self._write_disk(key, data)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+        if self.disk_dir:
+            for f in self.disk_dir.glob("*/*.json"):
+                f.unlink(missing_ok=True)
+            self._disk_bytes = 0
+
+    def count(self, result: str) -> None:
+        metrics.counter("toolchat7_response_cache_total", "LLM response cache lookups", result=result).inc()
+
+    def _remember(self, key: str, data: Dict[str, Any]) -> None:
+        with self._lock:
+            self._memory[key] = data
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def _path(self, key: str) -> Path:
+        return self.disk_dir / key[:2] / f"{key}.json"
+
+    def _read_disk(self, key: str) -> Optional[Dict[str, Any]]:
+        if not self.disk_dir:
+            return None
+        path = self._path(key)
+        try:
+            data = json.loads(path.read_bytes())
+            os.utime(path)  # mtime is the last use, for LRU eviction
+            return data
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            log.warning("ignoring unreadable response cache file %s: %r", path, e)
+            return None
+
+    def _write_disk(self, key: str, data: Dict[str, Any]) -> None:
+        if not self.disk_dir:
+            return
+        path = self._path(key)
+        encoded = json.dumps(data, default=str).encode()
+        try:
+            path.parent.mkdir(exist_ok=True)
+            tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp_path.write_bytes(encoded)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            log.warning("could not write response cache file %s: %r", path, e)
+            return
+        with self._lock:
+            self._disk_bytes += len(encoded)
+            over = self._disk_bytes > self.max_disk_bytes
+        if over:
+            self._evict_disk()
+
+    def _evict_disk(self) -> None:
+        """Delete the least recently used files until the directory is under DISK_EVICT_TO of max_disk_bytes.
+        Recounts the directory, since other processes may share it."""
+        files = []
+        for f in self.disk_dir.glob("*/*.json"):
+            try:
+                stat = f.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, f))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        target = self.max_disk_bytes * DISK_EVICT_TO
+        for _, size, f in files:
+            if total <= target:
+                break
+            f.unlink(missing_ok=True)
+            total -= size
+        with self._lock:
+            self._disk_bytes = total
@@ -0,0 +1,247 @@
+"""
+Process-wide scheduler for LLM requests, so bursts from many chats queue up instead of hitting
+Together's rate limits and failing with 429s.
+
+Requests wait in a fair queue until both token buckets allow them:
+    - requests per second
+    - tokens per minute, charged with an estimate before the request and corrected with the
+      actual usage after it, see settle()
+Higher priority requests go first. Within a priority, sessions take turns, so one chat sending many
+requests does not delay the others. A request that waits longer than its timeout raises QueueTimeout.
+Queue depth, wait time and timeouts are recorded in metrics.
+
+Callers say which session a request belongs to, and its priority and timeout, with request_scope(),
+which applies to every LLM request made inside it, including from coroutines started inside it.
+
+Configured from env variables, see LLMScheduler.from_env():
+    LLM_RPS            max LLM requests per second
+    LLM_TPM            max LLM tokens, prompt and completion, per minute
+    LLM_QUEUE_TIMEOUT  seconds a request may wait for its turn, defaults to 60
+"""
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Callable, Deque, Dict, Iterator, Optional
+import asyncio
+import os
+import threading
+import time
+from services.metrics import metrics
+from services.rate_limit import RateLimiter
+from utils import get_logger
+
+
+log = get_logger(__name__)
+
+DEFAULT_QUEUE_TIMEOUT = 60.0
+
+
+class QueueTimeout(Exception):
+    """An LLM request waited longer than its timeout for its turn."""
+
+
+@dataclass(frozen=True)
+class RequestScope:
+    session: str = "default"
+    # higher goes first
+    priority: int = 0
+    # seconds to wait for a turn, None for the scheduler's timeout
+    timeout: Optional[float] = None
+
+
+_scope: ContextVar[RequestScope] = ContextVar("llm_request_scope", default=RequestScope())
+
+
+@contextmanager
+def request_scope(session: Optional[str] = None, priority: Optional[int] = None,
+                  timeout: Optional[float] = None) -> Iterator[RequestScope]:
+    """Schedule LLM requests made inside the with block as session, at priority, waiting at most timeout.
+    Anything not given is inherited from the enclosing scope."""
+    outer = _scope.get()
+    scope = RequestScope(outer.session if session is None else str(session),
+                         outer.priority if priority is None else priority,
+                         outer.timeout if timeout is None else timeout)
+    token = _scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _scope.reset(token)
+
+
+@lru_cache(maxsize=1)
+def default_scheduler() -> Optional["LLMScheduler"]:
+    """The process-wide scheduler from env variables, shared by every ChatModelService. None if no limit is set."""
+    return LLMScheduler.from_env()
+
+
+class _Waiter:
+    __slots__ = ("scope", "tokens", "granted", "cancelled", "wake")
+
+    def __init__(self, scope: RequestScope, tokens: float, wake: Callable[[], None]):
+        self.scope = scope
+        self.tokens = tokens
+        self.granted = False
+        self.cancelled = False
+        self.wake = wake
+
+
+class LLMScheduler:
+    """Fair queue in front of the LLM clients, limited to rps requests per second and tpm tokens per minute.
+
+    A dispatcher thread admits waiters in order as the buckets refill, so threads waiting with acquire()
+    and coroutines waiting with aacquire() share the same queue and limits.
+    """
+
+    def __init__(self, rps: Optional[float] = None, tpm: Optional[float] = None,
+                 timeout: Optional[float] = DEFAULT_QUEUE_TIMEOUT):
+        """
+        Args:
+            rps: requests per second, None for no limit
+            tpm: tokens per minute, None for no limit. Up to a minute's worth can be used in a burst.
+            timeout: default seconds a request waits for its turn before QueueTimeout, None to wait as long as it takes
+        """
+        self.requests = RateLimiter(rps) if rps else None
+        self.tokens = RateLimiter(tpm / 60, burst=tpm) if tpm else None
+        self.timeout = timeout
+        # priority -> session -> waiters, sessions in the order they take turns
+        self._queues: Dict[int, OrderedDict[str, Deque[_Waiter]]] = {}
+        self._depth = 0
+        self._cond = threading.Condition()
+        self._dispatcher: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_env(cls) -> Optional["LLMScheduler"]:
+        """LLMScheduler configured from LLM_RPS, LLM_TPM and LLM_QUEUE_TIMEOUT, or None if neither limit is set."""
+        rps, tpm = os.getenv("LLM_RPS"), os.getenv("LLM_TPM")
+        if not (rps or tpm):
+            return None
+        return cls(float(rps) if rps else None, float(tpm) if tpm else None,
+                   float(os.getenv("LLM_QUEUE_TIMEOUT", DEFAULT_QUEUE_TIMEOUT)))
+
+    def depth(self) -> int:
+        return self._depth
+
+    def acquire(self, tokens: float = 1.0) -> float:
+        """Wait for a turn to send a request estimated at tokens. Returns the seconds waited.
+
+        Raises:
+            QueueTimeout: if the request waited longer than its timeout
+        """
+        event = threading.Event()
+        waiter = self._enqueue(tokens, event.set)
+        start = time.perf_counter()
+        event.wait(self._timeout(waiter))
+        return self._finish(waiter, start)
+
+    async def aacquire(self, tokens: float = 1.0) -> float:
+        """Async version of acquire."""
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def wake() -> None:
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        waiter = self._enqueue(tokens, wake)
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(granted, self._timeout(waiter))
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            self._cancel(waiter)
+            raise
+        return self._finish(waiter, start)
+
+    def settle(self, reserved: float, used: Optional[float]) -> None:
+        """Correct the tokens per minute bucket once a request's actual token usage is known."""
+        if self.tokens is not None and used is not None:
+            self.tokens.refund(min(reserved, self.tokens.burst) - used)
+
+    def _timeout(self, waiter: _Waiter) -> Optional[float]:
+        return self.timeout if waiter.scope.timeout is None else waiter.scope.timeout
+
+    def _enqueue(self, tokens: float, wake: Callable[[], None]) -> _Waiter:
+        waiter = _Waiter(_scope.get(), tokens, wake)
+        with self._cond:
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch, name="toolchat7-llm-scheduler", daemon=True)
+                self._dispatcher.start()
+            sessions = self._queues.setdefault(waiter.scope.priority, OrderedDict())
+            sessions.setdefault(waiter.scope.session, deque()).append(waiter)
+            self._set_depth(self._depth + 1)
+            self._cond.notify()
+        return waiter
+
+    def _finish(self, waiter: _Waiter, start: float) -> float:
+        waited = time.perf_counter() - start
+        if not self._cancel(waiter):
+            metrics.counter("toolchat7_llm_queue_timeouts_total", "LLM requests that timed out waiting for a turn",
+                            priority=str(waiter.scope.priority)).inc()
+            raise QueueTimeout(f"LLM request waited {waited:.1f}s for its turn, {self._depth} requests queued")
+        metrics.histogram("toolchat7_llm_queue_wait_seconds", "Time LLM requests waited in the scheduler queue",
+                          priority=str(waiter.scope.priority)).observe(waited)
+        if waited > 1:
+            log.info("LLM request for session %s waited %.1fs", waiter.scope.session, waited)
+        return waited
+
+    def _cancel(self, waiter: _Waiter) -> bool:
+        """Take waiter out of the queue if it is still waiting. Returns True if it had already been granted."""
+        with self._cond:
+            if waiter.granted:
+                return True
+            if not waiter.cancelled:
+                waiter.cancelled = True
+                self._set_depth(self._depth - 1)
+                # the dispatcher drops cancelled waiters when they reach the head of their session's queue
+                self._cond.notify()
+            return False
+
+    def _set_depth(self, depth: int) -> None:
+        self._depth = depth
+        metrics.gauge("toolchat7_llm_queue_depth", "LLM requests waiting for a turn").set(depth)
+
+    def _head(self) -> Optional[_Waiter]:
+        """The next waiter: highest priority, then the session whose turn it is. Called with _cond held."""
+        for priority in sorted(self._queues, reverse=True):
+            sessions = self._queues[priority]
+            while sessions:
+                session, waiters = next(iter(sessions.items()))
+                while waiters and waiters[0].cancelled:
+                    waiters.popleft()
+                if waiters:
+                    return waiters[0]
+                del sessions[session]
+            del self._queues[priority]
+        return None
+
+    def _delay(self, waiter: _Waiter) -> float:
+        delay = self.requests.wait_time() if self.requests else 0.0
+        if self.tokens is not None:
+            delay = max(delay, self.tokens.wait_time(min(waiter.tokens, self.tokens.burst)))
+        return delay
+
+    def _dispatch(self) -> None:
+        with self._cond:
+            while True:
+                waiter = self._head()
+                if waiter is None:
+                    self._cond.wait()
+                    continue
+                delay = self._delay(waiter)
+                if delay > 0:
+                    # woken early if a waiter is added or cancelled, the head may have changed
+                    self._cond.wait(delay)
+                    continue
+                if self.requests:
+                    self.requests.reserve()
+                if self.tokens:
+                    self.tokens.reserve(min(waiter.tokens, self.tokens.burst))
+                sessions = self._queues[waiter.scope.priority]
+                sessions[waiter.scope.session].popleft()
+                # this session's next request goes behind the other sessions
+                sessions.move_to_end(waiter.scope.session)
+                waiter.granted = True
+                self._set_depth(self._depth - 1)
+                waiter.wake()
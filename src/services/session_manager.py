@@ -0,0 +1,330 @@
+"""
+Process-wide manager of in-memory chat sessions, so abandoned sessions do not hold memory until the
+server restarts.
+
+Every session's history is a ManagedChatHistoryManager, an in-memory history whose messages the
+manager can spill to a gzipped NDJSON file and drop from memory:
+    - sessions not used for SESSION_IDLE_SECONDS
+    - the least recently used sessions, while all sessions in memory use more than SESSION_MAX_RESIDENT_MB
+Using a spilled session reloads it from its file, so spilling is invisible to its users. A session
+that was not changed since it was reloaded is dropped without writing it again. Spill files not used
+for SESSION_SPILL_TTL_DAYS are deleted.
+
+The manager checks its limits at most every SWEEP_INTERVAL seconds, when a session is used, so
+there is no background thread. Resident and spilled session counts are in counts() and metrics.
+
+Configured from env variables, see SessionManager.from_env():
+    SESSION_IDLE_SECONDS     seconds before an unused session is spilled, defaults to 1800
+    SESSION_MAX_RESIDENT_MB  memory for all sessions' messages, defaults to 512
+    SESSION_SPILL_DIR        directory of spill files, defaults to toolchat7_sessions in the temp directory
+    SESSION_SPILL_TTL_DAYS   days before an unused spill file is deleted, defaults to 7
+"""
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+import gzip
+import os
+import re
+import tempfile
+import threading
+import time
+from langchain_core.messages import BaseMessage, message_to_dict
+from services.chat_history import InMemoryChatHistoryManager, dict_to_message, json_dumps, json_loads
+from services.message_store import CompactMessageStore
+from services.metrics import metrics
+from utils import get_logger
+
+
+log = get_logger(__name__)
+
+DEFAULT_IDLE_SECONDS = 1800.0
+DEFAULT_MAX_RESIDENT_MB = 512.0
+DEFAULT_SPILL_TTL_DAYS = 7.0
+# seconds between checks of the idle and memory limits
+SWEEP_INTERVAL = 30.0
+# session ids are used as file names
+UNSAFE_FILE_CHARS_RE = re.compile(r"[^\w.-]")
+
+
+class ManagedChatHistoryManager(InMemoryChatHistoryManager):
+    """In-memory chat history of one session, spilled to disk by its SessionManager when idle,
+    and reloaded on next use. Get one with SessionManager.history()."""
+
+    def __init__(self, session_id: str, manager: "SessionManager", spilled: bool = False):
+        self.session_id = session_id
+        self.manager = manager
+        # held while messages are changed or spilled, so no message is added to a store being spilled
+        self.lock = threading.RLock()
+        self.last_used = time.monotonic()
+        self._store: Optional[CompactMessageStore] = None if spilled else CompactMessageStore()
+        # True if the spill file is missing or older than the messages in memory
+        self._dirty = not spilled
+        self.init_display_view()
+
+    @property
+    def resident(self) -> bool:
+        return self._store is not None
+
+    @property
+    def nbytes(self) -> int:
+        store = self._store
+        return store.nbytes if store is not None else 0
+
+    @property
+    def messages(self) -> CompactMessageStore:
+        with self.lock:
+            store = self._store
+            if store is None:
+                store = self._store = self.manager.reload(self)
+                self._dirty = False
+        self.manager.touch(self)
+        return store
+
+    @messages.setter
+    def messages(self, value: Iterable[BaseMessage]) -> None:
+        with self.lock:
+            self._store = value if isinstance(value, CompactMessageStore) else CompactMessageStore(value)
+            self._dirty = True
+        self.manager.touch(self)
+
+    def add_message(self, message: BaseMessage) -> None:
+        with self.lock:
+            self.messages.append(message)
+            self._dirty = True
+            self._sync_display_messages()
+
+    def add_messages(self, messages: Iterable[BaseMessage]) -> None:
+        with self.lock:
+            self.messages.extend(messages)
+            self._dirty = True
+            self._sync_display_messages()
+
+    def clear(self) -> None:
+        with self.lock:
+            self._store = CompactMessageStore()
+            self._dirty = True
+            self.init_display_view()
+            self.manager.delete_spill_file(self.session_id)
+        self.manager.touch(self)
+
+    def spill(self) -> bool:
+        """Write the messages to the spill file if changed, and drop them and the display view from memory.
+        Returns False if the session is in use by another thread, or already spilled."""
+        if not self.lock.acquire(blocking=False):
+            return False
+        try:
+            store = self._store
+            if store is None:
+                return False
+            if not store:
+                self.manager.delete_spill_file(self.session_id)
+            elif self._dirty:
+                self.manager.write_spill_file(self.session_id, store)
+            self._store = None
+            self._dirty = False
+            self.init_display_view()
+            return True
+        finally:
+            self.lock.release()
+
+
+class SessionManager:
+    """Chat histories by session id, spilling idle sessions to disk past the idle and memory limits."""
+
+    def __init__(self, spill_dir: Optional[str | Path] = None, idle_seconds: float = DEFAULT_IDLE_SECONDS,
+                 max_resident_bytes: float = DEFAULT_MAX_RESIDENT_MB * 1024 * 1024,
+                 spill_ttl: float = DEFAULT_SPILL_TTL_DAYS * 86400, sweep_interval: float = SWEEP_INTERVAL):
+        """
+        Args:
+            spill_dir: directory of spill files, created if needed
+            idle_seconds: seconds before an unused session is spilled
+            max_resident_bytes: memory for all sessions' messages, least recently used are spilled past it
+            spill_ttl: seconds before an unused spill file, and its session, are deleted
+            sweep_interval: seconds between checks of the limits
+        """
+        self.spill_dir = Path(spill_dir or Path(tempfile.gettempdir()) / "toolchat7_sessions")
+        self.idle_seconds = idle_seconds
+        self.max_resident_bytes = max_resident_bytes
+        self.spill_ttl = spill_ttl
+        self.sweep_interval = sweep_interval
+        self._sessions: Dict[str, ManagedChatHistoryManager] = {}
+        self._lock = threading.Lock()
+        self._sweep_lock = threading.Lock()
+        self._next_sweep = time.monotonic() + sweep_interval
+        self._resident_gauge = metrics.gauge("toolchat7_sessions_resident", "Chat sessions with messages in memory")
+        self._spilled_gauge = metrics.gauge("toolchat7_sessions_spilled", "Chat sessions spilled to disk")
+        self._bytes_gauge = metrics.gauge("toolchat7_sessions_resident_bytes",
+                                          "Approximate memory used by the messages of resident chat sessions")
+
+    @classmethod
+    def from_env(cls) -> "SessionManager":
+        return cls(spill_dir=os.getenv("SESSION_SPILL_DIR") or None,
+                   idle_seconds=float(os.getenv("SESSION_IDLE_SECONDS", DEFAULT_IDLE_SECONDS)),
+                   max_resident_bytes=float(os.getenv("SESSION_MAX_RESIDENT_MB", DEFAULT_MAX_RESIDENT_MB)) * 1024 * 1024,
+                   spill_ttl=float(os.getenv("SESSION_SPILL_TTL_DAYS", DEFAULT_SPILL_TTL_DAYS)) * 86400)
+
+    def history(self, session_id: str) -> ManagedChatHistoryManager:
+        """The session's chat history. A session spilled by this or an earlier process is reloaded when used."""
+        with self._lock:
+            history = self._sessions.get(session_id)
+            if history is None:
+                history = ManagedChatHistoryManager(session_id, self, spilled=self.spill_path(session_id).exists())
+                self._sessions[session_id] = history
+        self.touch(history)
+        return history
+
+    def find(self, session_id: str) -> Optional[ManagedChatHistoryManager]:
+        """The session's chat history if it is in memory or spilled, None for an unknown session, without adding it."""
+        with self._lock:
+            history = self._sessions.get(session_id)
+        if history is None:
+            return self.history(session_id) if self.spill_path(session_id).exists() else None
+        self.touch(history)
+        return history
+
+    def forget(self, session_id: str) -> None:
+        """Drop the session from memory and delete its spill file."""
+        with self._lock:
+            self._sessions.pop(session_id, None)
+        self.delete_spill_file(session_id)
+
+    def counts(self) -> Dict[str, int]:
+        """Number of resident and spilled sessions, and the approximate bytes used by resident sessions."""
+        sessions = list(self._sessions.values())
+        resident = [h for h in sessions if h.resident]
+        counts = {"resident": len(resident), "spilled": len(sessions) - len(resident),
+                  "resident_bytes": sum(h.nbytes for h in resident)}
+        self._resident_gauge.set(counts["resident"])
+        self._spilled_gauge.set(counts["spilled"])
+        self._bytes_gauge.set(counts["resident_bytes"])
+        return counts
+
+    def touch(self, history: ManagedChatHistoryManager) -> None:
+        now = time.monotonic()
+        history.last_used = now
+        if now >= self._next_sweep:
+            # history may be in the middle of a write on this thread, holding its lock, which would not stop spill()
+            self.sweep(keep=history)
+
+    def sweep(self, keep: Optional[ManagedChatHistoryManager] = None) -> int:
+        """Spill sessions past the idle and memory limits, except keep, and delete expired spill files.
+        Returns the number of sessions spilled. Skipped if another thread is sweeping."""
+        if not self._sweep_lock.acquire(blocking=False):
+            return 0
+        try:
+            now = time.monotonic()
+            self._next_sweep = now + self.sweep_interval
+            resident = sorted((h for h in list(self._sessions.values()) if h.resident and h is not keep),
+                              key=lambda h: h.last_used)
+            total = sum(h.nbytes for h in resident)
+            spilled = 0
+            for history in resident:
+                idle = now - history.last_used >= self.idle_seconds
+                if not idle and total <= self.max_resident_bytes:
+                    break  # the rest were used more recently
+                nbytes = history.nbytes
+                if self._spill(history):
+                    total -= nbytes
+                    spilled += 1
+            self._delete_expired_spill_files()
+            counts = self.counts()
+            if spilled:
+                log.info("spilled %d sessions to %s, %d resident using %d bytes, %d spilled",
+                         spilled, self.spill_dir, counts["resident"], counts["resident_bytes"], counts["spilled"])
+            return spilled
+        finally:
+            self._sweep_lock.release()
+
+    def spill_path(self, session_id: str) -> Path:
+        return self.spill_dir / f"{UNSAFE_FILE_CHARS_RE.sub('_', session_id)}.ndjson.gz"
+
+    def write_spill_file(self, session_id: str, messages: Iterable[BaseMessage]) -> None:
+        """Write messages as gzipped NDJSON, one message_to_dict() per line, replacing the file atomically."""
+        path = self.spill_path(session_id)
+        self.spill_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=6) as f:
+            for msg in messages:
+                f.write(json_dumps(message_to_dict(msg)) + "\n")
+        os.replace(tmp_path, path)
+
+    def reload(self, history: ManagedChatHistoryManager) -> CompactMessageStore:
+        """Read a spilled session's messages back. A missing or unreadable file gives an empty history."""
+        path = self.spill_path(history.session_id)
+        start = time.perf_counter()
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                store = CompactMessageStore(dict_to_message(json_loads(line)) for line in f if line.strip())
+            os.utime(path)  # keep it from expiring while in use
+        except FileNotFoundError:
+            # an empty session is spilled without a file
+            return CompactMessageStore()
+        except (OSError, EOFError, ValueError) as e:
+            log.error("could not reload session %s from %s, starting an empty history: %r",
+                      history.session_id, path, e)
+            return CompactMessageStore()
+        metrics.counter("toolchat7_session_reloads_total", "Chat sessions reloaded from their spill file").inc()
+        log.debug("reloaded session %s, %d messages in %.3fs", history.session_id, len(store),
+                  time.perf_counter() - start)
+        return store
+
+    def delete_spill_file(self, session_id: str) -> None:
+        try:
+            self.spill_path(session_id).unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            log.warning("could not delete spill file of session %s: %r", session_id, e)
+
+    def _spill(self, history: ManagedChatHistoryManager) -> bool:
+        try:
+            if not history.spill():
+                return False
+        except OSError as e:
+            log.error("could not spill session %s to %s: %r", history.session_id, self.spill_dir, e)
+            return False
+        metrics.counter("toolchat7_session_spills_total", "Chat sessions spilled to disk").inc()
+        return True
+
+    def _delete_expired_spill_files(self) -> None:
+        """Delete spill files, and forget spilled sessions, not used for spill_ttl."""
+        idle_cutoff = time.monotonic() - self.spill_ttl
+        with self._lock:
+            for session_id, history in list(self._sessions.items()):
+                if not history.resident and history.last_used < idle_cutoff:
+                    del self._sessions[session_id]
+        if not self.spill_dir.is_dir():
+            return
+        expired: List[str] = []
+        cutoff = time.time() - self.spill_ttl
+        with os.scandir(self.spill_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(".ndjson.gz") and entry.stat().st_mtime < cutoff:
+                    expired.append(entry.path)
+        if not expired:
+            return
+        with self._lock:
+            # unsafe characters in session ids are replaced in file names, so ids cannot be read back from them
+            ids_by_path: Dict[str, List[str]] = {}
+            for session_id in self._sessions:
+                ids_by_path.setdefault(str(self.spill_path(session_id)), []).append(session_id)
+            deletable = []
+            for path in expired:
+                session_ids = ids_by_path.get(path, [])
+                if any(self._sessions[session_id].resident for session_id in session_ids):
+                    continue  # in use again, its file is rewritten when it is next spilled
+                for session_id in session_ids:
+                    del self._sessions[session_id]
+                deletable.append(path)
+        for path in deletable:
+            try:
+                os.unlink(path)
+                log.debug("deleted expired spill file %s", path)
+            except OSError as e:
+                log.warning("could not delete expired spill file %s: %r", path, e)
+
+
+@lru_cache(maxsize=1)
+def default_session_manager() -> SessionManager:
+    """The process-wide session manager from env variables."""
+    return SessionManager.from_env()
@@ -0,0 +1,242 @@
+from collections import deque
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, TYPE_CHECKING
+import sqlite3
+import threading
+import time
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
+from services.chat_history import (ChatHistoryMixin, DisplayMessage, dict_to_message, json_dumps, json_loads,
+                                   to_display_message)
+from services.context_window import count_message_tokens
+from utils import get_logger
+
+if TYPE_CHECKING:
+    from services.context_window import ContextWindowBuilder
+
+
+log = get_logger(__name__)
+
+# messages read from the database per query
+PAGE_SIZE = 200
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    session_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    data TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (session_id, seq)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS messages_session_type ON messages (session_id, type, seq);
+"""
+
+Row = Tuple[int, str, str]
+
+
+class SQLiteMessageStore:
+    """Append-only table of messages for all sessions in one SQLite file.
+
+    Uses WAL mode, so appends are cheap and readers never block the writer.
+    sqlite3 connections cannot be shared between threads, so each thread gets its own connection.
+    """
+    _stores: Dict[str, "SQLiteMessageStore"] = {}
+    _stores_lock = threading.Lock()
+
+    @classmethod
+    def open(cls, db_path: str | Path) -> "SQLiteMessageStore":
+        """One store per database file per process."""
+        key = str(Path(db_path).resolve())
+        with cls._stores_lock:
+            if key not in cls._stores:
+                cls._stores[key] = cls(key)
+            return cls._stores[key]
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.connection().executescript(SCHEMA)
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # with WAL, NORMAL only risks the last transactions on power loss, never corruption
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def append(self, session_id: str, messages: Sequence[BaseMessage]) -> int:
+        """Append messages after the session's last message, returns the seq of the first one.
+        The seqs are allocated in the insert transaction, so any number of writers can share a session."""
+        now = time.time()
+        with self.connection() as conn:
+            # take the write lock before reading MAX(seq), so no other writer can take the same seqs
+            conn.execute("BEGIN IMMEDIATE")
+            first_seq = conn.execute(
+                "SELECT COALESCE(MAX(seq), 0) + 1 FROM messages WHERE session_id = ?", (session_id,)).fetchone()[0]
+            conn.executemany(
+                "INSERT INTO messages (session_id, seq, type, data, created_at) VALUES (?, ?, ?, ?, ?)",
+                [(session_id, first_seq + i, msg.type, json_dumps(message_to_dict(msg)["data"]), now)
+                 for i, msg in enumerate(messages)])
+        return first_seq
+
+    def count(self, session_id: str) -> int:
+        return self.connection().execute(
+            "SELECT COUNT(*) FROM messages WHERE session_id = ?", (session_id,)).fetchone()[0]
+
+    def page(self, session_id: str, after_seq: int, limit: int, types: Optional[Sequence[str]] = None) -> List[Row]:
+        """Up to limit rows with seq > after_seq, oldest first."""
+        sql, params = "SELECT seq, type, data FROM messages WHERE session_id = ? AND seq > ?", [session_id, after_seq]
+        if types:
+            sql += f" AND type IN ({','.join('?' * len(types))})"
+            params += types
+        return self.connection().execute(sql + " ORDER BY seq LIMIT ?", (*params, limit)).fetchall()
+
+    def page_before(self, session_id: str, before_seq: Optional[int], limit: int, exclude_type: str) -> List[Row]:
+        """Up to limit rows with seq < before_seq, or the newest rows if before_seq is None, newest first."""
+        sql, params = "SELECT seq, type, data FROM messages WHERE session_id = ? AND type != ?", [session_id, exclude_type]
+        if before_seq is not None:
+            sql += " AND seq < ?"
+            params.append(before_seq)
+        return self.connection().execute(sql + " ORDER BY seq DESC LIMIT ?", (*params, limit)).fetchall()
+
+    def delete_session(self, session_id: str) -> None:
+        with self.connection() as conn:
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+
+
+def row_to_message(row: Row) -> BaseMessage:
+    _, msg_type, data = row
+    return messages_from_dict([{"type": msg_type, "data": json_loads(data)}])[0]
+
+
+class SQLiteChatHistoryManager(ChatHistoryMixin, BaseChatMessageHistory):
+    """Chat history persisted in SQLite, keyed by session id, survives server restarts.
+
+    Messages are not held in memory. They are appended to the store as they are added
+    and read back in pages, so memory per process does not grow with conversation length.
+    The messages property still loads the whole history, as langchain requires, so prefer
+    iter_messages(), recent_messages() and get_context_messages().
+    Several managers, in one process or several, can share a session: seqs are allocated by the database.
+    """
+
+    def __init__(self, session_id: str, db_path: str | Path, page_size: int = PAGE_SIZE):
+        self.session_id = session_id
+        self.page_size = page_size
+        self.store = SQLiteMessageStore.open(db_path)
+        # display view, loaded on first use, then only rows after _display_seq are read
+        self._display_messages: List[DisplayMessage] = []
+        self._display_seq = 0
+        log.debug("SQLiteChatHistoryManager init complete. session_id=%s db_path=%s", session_id, db_path)
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        return list(self.iter_messages())
+
+    @property
+    def message_count(self) -> int:
+        return self.store.count(self.session_id)
+
+    def add_message(self, message: BaseMessage) -> None:
+        self.add_messages([message])
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        """Append messages in one transaction."""
+        messages = list(messages)
+        if not messages:
+            return
+        first_seq = self.store.append(self.session_id, messages)
+        if self._display_seq and first_seq == self._display_seq + 1:
+            # nothing was written by anyone else since the view was synced, extend it without a query
+            self._display_messages.extend(filter(None, map(to_display_message, messages)))
+            self._display_seq = first_seq + len(messages) - 1
+
+    def clear(self) -> None:
+        self.store.delete_session(self.session_id)
+        self._reset_display_view()
+
+    def _reset_display_view(self) -> None:
+        self._display_messages = []
+        self._display_seq = 0
+
+    def iter_rows(self, types: Optional[Sequence[str]] = None, after_seq: int = 0) -> Iterator[Row]:
+        """Rows with seq > after_seq, oldest first, read a page at a time."""
+        while True:
+            rows = self.store.page(self.session_id, after_seq, self.page_size, types)
+            yield from rows
+            if len(rows) < self.page_size:
+                return
+            after_seq = rows[-1][0]
+
+    def iter_messages(self) -> Iterator[BaseMessage]:
+        """All messages, oldest first, loaded a page at a time."""
+        return map(row_to_message, self.iter_rows())
+
+    def recent_messages(self, limit: int) -> List[BaseMessage]:
+        """The newest limit messages, oldest first, skipping system messages."""
+        rows = self.store.page_before(self.session_id, None, limit, exclude_type="system")
+        return [row_to_message(row) for row in reversed(rows)]
+
+    def get_just_ai_human_message(self) -> List[DisplayMessage]:
+        """The display view, loaded from the database once and then kept up to date by add_messages(),
+        plus any rows another manager added since, so a streamlit rerun reads only new rows.
+
+        Returns:
+            List[DisplayMessage]: the display view, do not modify it
+        """
+        for row in self.iter_rows(types=("ai", "human"), after_seq=self._display_seq):
+            display_msg = to_display_message(row_to_message(row))
+            if display_msg:
+                self._display_messages.append(display_msg)
+            self._display_seq = row[0]
+        return self._display_messages
+
+    def get_context_messages(self, context_builder: "ContextWindowBuilder") -> List[BaseMessage]:
+        """Load system messages plus just enough recent pages to fill the context window, then trim.
+        Pages are loaded newest first until the budget is exceeded at a turn boundary (a human message),
+        so no AIMessage with tool_calls is cut off from its ToolMessages.
+        """
+        system = [row_to_message(row) for row in self.iter_rows(types=("system",))]
+        tokens = sum(count_message_tokens(m) for m in system)
+        loaded = deque()
+        before_seq = None
+        while True:
+            rows = self.store.page_before(self.session_id, before_seq, self.page_size, exclude_type="system")
+            for row in rows:
+                msg = row_to_message(row)
+                loaded.appendleft(msg)
+                tokens += count_message_tokens(msg)
+            if len(rows) < self.page_size:
+                break
+            before_seq = rows[-1][0]
+            if tokens > context_builder.max_prompt_tokens and loaded[0].type == "human":
+                break
+        return context_builder.build(system + list(loaded))
+
+    def import_ndjson(self, lines: Iterable[str | bytes]) -> None:
+        """Import chat history from newline delimited JSON in one transaction, replacing the current history.
+
+        Raises:
+            ValueError: If a line is not a valid message, the previous history is kept
+        """
+        conn = self.store.connection()
+        seq = 0
+        with conn:
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (self.session_id,))
+            now = time.time()
+            for line_number, line in enumerate(lines, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    msg = dict_to_message(json_loads(line))
+                except ValueError as e:
+                    raise ValueError(f"Invalid message on line {line_number}: {e}") from e
+                seq += 1
+                conn.execute(
+                    "INSERT INTO messages (session_id, seq, type, data, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (self.session_id, seq, msg.type, json_dumps(message_to_dict(msg)["data"]), now))
+        self._reset_display_view()
@@ -0,0 +1,193 @@
+from collections import OrderedDict, Counter
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+import asyncio
+import json
+import threading
+import time
+from langchain_core.messages import ToolMessage
+from langchain_core.messages.tool import ToolCall
+
+
+@dataclass(frozen=True)
+class ToolCachePolicy:
+    """How results of one tool are cached.
+
+    Attributes:
+        ttl: seconds a cached result stays valid
+        maxsize: max number of results kept for the tool, least recently used are evicted first
+        casefold: if True, string arguments are case-folded before building the cache key,
+            so "SF" and "sf" share a result. Only opt in when the tool ignores case.
+    """
+    ttl: float
+    maxsize: int = 128
+    casefold: bool = False
+
+
+@dataclass(frozen=True)
+class CachedResult:
+    content: Any
+    artifact: Any
+    expires_at: float
+
+
+class ToolResultCache:
+    """TTL + LRU cache of tool results, keyed on tool name plus normalized arguments.
+
+    Only tools with a ToolCachePolicy are cached, and only successful results are stored.
+    Identical calls that arrive while the first one is still running wait for that result
+    instead of running the tool again (single-flight).
+    A cached result is returned as a new ToolMessage with the tool_call_id of the current call,
+    so the chat history stays valid.
+    """
+
+    def __init__(self, policies: Dict[str, ToolCachePolicy]):
+        self.policies = policies
+        self._entries: Dict[str, OrderedDict[str, CachedResult]] = {name: OrderedDict() for name in policies}
+        self._in_flight: Dict[Tuple[str, str], Future] = {}
+        self._lock = threading.Lock()
+        self.hits = Counter()
+        self.misses = Counter()
+        self.coalesced = Counter()
+        self.evictions = Counter()
+
+
+    def is_cached(self, tool_name: str) -> bool:
+        return tool_name in self.policies
+
+
+    def make_key(self, tool_name: str, args: Dict[str, Any]) -> str:
+        """Cache key for the tool arguments, sorted JSON so argument order does not matter."""
+        if self.policies[tool_name].casefold:
+            args = casefold_strings(args)
+        return json.dumps(args, sort_keys=True, separators=(",", ":"), default=str)
+
+
+    def get_or_run(self, tool_call: ToolCall, run: Callable[[ToolCall], ToolMessage]) -> ToolMessage:
+        """Return the cached result for tool_call, or run it and cache the result.
+
+        Args:
+            tool_call: tool call from the AIMessage
+            run: function that executes the tool call, only called on a cache miss
+        """
+        name = tool_call["name"]
+        key = self.make_key(name, tool_call["args"])
+        cached, in_flight = self._lookup(name, key)
+        if cached is not None:
+            return to_tool_message(tool_call, cached)
+        if in_flight is not None:
+            return to_tool_message(tool_call, in_flight.result())
+        return self._run_leader(name, key, tool_call, run)
+
+
+    async def aget_or_run(self, tool_call: ToolCall, arun: Callable[[ToolCall], Awaitable[ToolMessage]]) -> ToolMessage:
+        """Async version of get_or_run, shares cache entries and in-flight calls with it."""
+        name = tool_call["name"]
+        key = self.make_key(name, tool_call["args"])
+        cached, in_flight = self._lookup(name, key)
+        if cached is not None:
+            return to_tool_message(tool_call, cached)
+        if in_flight is not None:
+            return to_tool_message(tool_call, await asyncio.wrap_future(in_flight))
+        leader = self._in_flight[(name, key)]
+        try:
+            toolmsg = await arun(tool_call)
+        except BaseException as e:
+            # includes CancelledError, waiters must not hang on a cancelled leader
+            self._finish(name, key, leader, None, e)
+            raise
+        self._finish(name, key, leader, toolmsg, None)
+        return toolmsg
+
+
+    def _lookup(self, name: str, key: str) -> Tuple[Optional[CachedResult], Optional[Future]]:
+        """Returns (cached result, None) on a hit, (None, future) if the same call is in flight.
+        Returns (None, None) on a miss, after registering the caller as the leader for key."""
+        with self._lock:
+            entries = self._entries[name]
+            cached = entries.get(key)
+            if cached is not None:
+                if cached.expires_at > time.monotonic():
+                    entries.move_to_end(key)
+                    self.hits[name] += 1
+                    return cached, None
+                del entries[key]
+            in_flight = self._in_flight.get((name, key))
+            if in_flight is not None:
+                self.coalesced[name] += 1
+                return None, in_flight
+            self.misses[name] += 1
+            self._in_flight[(name, key)] = Future()
+            return None, None
+
+
+    def _run_leader(self, name: str, key: str, tool_call: ToolCall, run: Callable[[ToolCall], ToolMessage]) -> ToolMessage:
+        leader = self._in_flight[(name, key)]
+        try:
+            toolmsg = run(tool_call)
+        except BaseException as e:
+            self._finish(name, key, leader, None, e)
+            raise
+        self._finish(name, key, leader, toolmsg, None)
+        return toolmsg
+
+
+    def _finish(self, name: str, key: str, leader: Future, toolmsg: Optional[ToolMessage], exc: Optional[BaseException]) -> None:
+        """Store a successful result and wake up any callers waiting on the same call."""
+        with self._lock:
+            del self._in_flight[(name, key)]
+            if toolmsg is not None and toolmsg.status == "success":
+                policy = self.policies[name]
+                entries = self._entries[name]
+                entries[key] = CachedResult(toolmsg.content, toolmsg.artifact, time.monotonic() + policy.ttl)
+                entries.move_to_end(key)
+                while len(entries) > policy.maxsize:
+                    entries.popitem(last=False)
+                    self.evictions[name] += 1
+        if exc is not None:
+            leader.set_exception(exc if isinstance(exc, Exception) else RuntimeError(f"Tool call {name} cancelled"))
+        else:
+            leader.set_result(CachedResult(toolmsg.content, toolmsg.artifact, 0.0) if toolmsg.status == "success"
+                              else toolmsg)
+
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Hit/miss counters per cached tool."""
+        with self._lock:
+            return {name: {
+                "hits": self.hits[name],
+                "misses": self.misses[name],
+                "coalesced": self.coalesced[name],
+                "evictions": self.evictions[name],
+                "size": len(self._entries[name]),
+            } for name in self.policies}
+
+
+    def clear(self) -> None:
+        with self._lock:
+            for entries in self._entries.values():
+                entries.clear()
+
+
+def to_tool_message(tool_call: ToolCall, result: CachedResult | ToolMessage) -> ToolMessage:
+    """Build the ToolMessage answering tool_call from a cached or shared result."""
+    if isinstance(result, ToolMessage):
+        # a failed leader result is shared with waiters but never cached
+        return result.model_copy(update={"tool_call_id": tool_call["id"]})
+    return ToolMessage(
+        content=result.content,
+        artifact=result.artifact,
+        name=tool_call["name"],
+        tool_call_id=tool_call["id"],
+    )
+
+
+def casefold_strings(value: Any) -> Any:
+    if isinstance(value, str):
+        return value.casefold()
+    if isinstance(value, dict):
+        return {k: casefold_strings(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [casefold_strings(v) for v in value]
+    return value
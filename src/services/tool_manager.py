@@ -1,8 +1,39 @@
-from typing import List, Dict
+from typing import Iterable, List, Dict, Optional
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from functools import lru_cache, partial
+import asyncio
+import os
+import sys
+import threading
+import time
 from langchain_core.messages import  ToolMessage, AIMessage
-from langchain_core.tools import tool
-from langgraph.prebuilt import ToolNode
-import pprint
+from langchain_core.messages.tool import ToolCall
+from langchain_core.tools import tool, BaseTool
+from services.metrics import observe_tool_call
+from services.tool_cache import ToolCachePolicy, ToolResultCache
+from services.tool_output import ToolOutputLimiter, ToolOutputPolicy
+from services.tool_registry import ToolRegistry
+from services.tool_sandbox import (WORKER_EXIT_TIMEOUT, WORKER_START_TIMEOUT, ToolSandbox, ToolSandboxError,
+                                   ToolSandboxTimeout, default_tool_sandbox)
+from utils import get_logger, lazy_pformat
+
+
+log = get_logger(__name__)
+
+
+# Tool calls from one AIMessage run concurrently on a bounded thread pool.
+DEFAULT_MAX_TOOL_WORKERS = 8
+# seconds a single tool call may run before it is reported to the LLM as timed out.
+DEFAULT_TOOL_TIMEOUT = 30.0
+# same wording langgraph's ToolNode uses, so the LLM sees familiar errors.
+TOOL_CALL_ERROR_TEMPLATE = "Error: {error}\n Please fix your mistakes."
+# tools listed here have their results cached, see ToolResultCache
+DEFAULT_TOOL_CACHE_POLICIES = {
+    "get_weather": ToolCachePolicy(ttl=600, maxsize=256),
+    "get_coolest_cities": ToolCachePolicy(ttl=3600, maxsize=1),
+}
+# per tool limits on the output sent to the LLM, tools not listed get ToolOutputPolicy(), see ToolOutputLimiter
+DEFAULT_TOOL_OUTPUT_POLICIES: Dict[str, ToolOutputPolicy] = {}
 
 
 @tool
@@ -20,27 +51,281 @@ def get_coolest_cities():
     return "nyc, sf"
 
 
+@lru_cache(maxsize=1)
+def default_tool_registry() -> ToolRegistry:
+    """The built in tools, plugin tools and TOOLCHAT7_TOOLS, see services.tool_registry."""
+    registry = ToolRegistry(schema_cache_path=os.getenv("TOOL_SCHEMA_CACHE"))
+    registry.register(get_weather, keywords=["temperature", "forecast", "sunny", "foggy"])
+    registry.register(get_coolest_cities, keywords=["cool", "best", "town"])
+    registry.discover()
+    registry.register_targets(os.getenv("TOOLCHAT7_TOOLS", ""))
+    return registry
+
+
 class ToolManager:
-    def __init__(self):
-        self.working_tools = [get_weather, get_coolest_cities]
-        self.tool_node = ToolNode(self.working_tools)
-        print(f"CHAD: ToolManager init complete.")
+    def __init__(self, max_workers: int = DEFAULT_MAX_TOOL_WORKERS,
+                 tool_timeouts: Optional[Dict[str, float]] = None,
+                 default_timeout: float = DEFAULT_TOOL_TIMEOUT,
+                 cache_policies: Optional[Dict[str, ToolCachePolicy]] = None,
+                 registry: Optional[ToolRegistry] = None,
+                 output_policies: Optional[Dict[str, ToolOutputPolicy]] = None,
+                 sandboxed_tools: Optional[Iterable[str]] = None,
+                 sandbox: Optional[ToolSandbox] = None,
+                 prefetch_tools: Optional[Iterable[str]] = None):
+        """
+        Args:
+            max_workers: max number of sync tool calls running at the same time
+            tool_timeouts: per tool name timeout in seconds, overrides default_timeout
+            default_timeout: timeout in seconds for tools not in tool_timeouts
+            cache_policies: per tool name result caching, defaults to DEFAULT_TOOL_CACHE_POLICIES. Pass {} to disable.
+            registry: the tools that can be called, defaults to default_tool_registry()
+            output_policies: per tool name limits on the output sent to the LLM, defaults to DEFAULT_TOOL_OUTPUT_POLICIES
+            sandboxed_tools: names of tools run in worker processes, defaults to the TOOL_SANDBOX env variable
+            sandbox: the worker processes, defaults to default_tool_sandbox()
+            prefetch_tools: names of tools that may start while the LLM response is still streaming, see
+                services.tool_prefetch. Only list tools without side effects. Defaults to the TOOL_PREFETCH env variable.
+        """
+        self.registry = default_tool_registry() if registry is None else registry
+        # tools already imported from the registry, by name
+        self.tools_by_name: Dict[str, BaseTool] = {}
+        self.tool_timeouts = tool_timeouts or {}
+        self.default_timeout = default_timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="toolchat7-tool")
+        self.tool_cache = ToolResultCache(DEFAULT_TOOL_CACHE_POLICIES if cache_policies is None else cache_policies)
+        self.output_limiter = ToolOutputLimiter(
+            DEFAULT_TOOL_OUTPUT_POLICIES if output_policies is None else output_policies)
+        self.sandboxed_tools = frozenset(tool_names_from_env("TOOL_SANDBOX") if sandboxed_tools is None
+                                         else sandboxed_tools)
+        self.prefetch_tools = frozenset(tool_names_from_env("TOOL_PREFETCH") if prefetch_tools is None
+                                        else prefetch_tools)
+        self._sandbox = sandbox
+        if self.sandboxed_tools:
+            # start the worker processes in the background, so the first sandboxed call does not wait for them
+            threading.Thread(target=self.sandbox.warm, name="toolchat7-sandbox-warm", daemon=True).start()
+        log.debug("ToolManager init complete.")
+
+
+    @property
+    def sandbox(self) -> ToolSandbox:
+        if self._sandbox is None:
+            self._sandbox = default_tool_sandbox()
+        return self._sandbox
+
 
+    @property
+    def working_tools(self) -> List[BaseTool]:
+        """Every registered tool, importing any not imported yet."""
+        return self.registry.tools()
 
-    def execute_tool_calls(self, response_ai_msg: AIMessage) -> List[ToolMessage]:
+
+    def get_tool(self, tool_name: str) -> Optional[BaseTool]:
+        tool = self.tools_by_name.get(tool_name)
+        if tool is None and tool_name in self.registry:
+            tool = self.tools_by_name[tool_name] = self.registry.get(tool_name)
+        return tool
+
+
+    def get_timeout(self, tool_name: str) -> float:
+        return self.tool_timeouts.get(tool_name, self.default_timeout)
+
+
+    def execute_tool_calls(self, response_ai_msg: AIMessage,
+                           prefetched: Optional[Dict[str, Future]] = None) -> List[ToolMessage]:
         """Execute tool calls based on the parsed responses from the LLM.
+        Independent tool calls run in parallel on the thread pool, so the total latency is
+        the slowest tool instead of the sum of all tools.
+
+        Args:
+            response_ai_msg (AIMessage): The response from the chat llm
+            prefetched: tool calls already started with prefetch_tool_call(), by tool call id, used instead of
+                starting them again. Only pass calls matching response_ai_msg.tool_calls, see ToolCallPrefetcher.
+
+        Returns:
+            List[ToolMessage]: Results of executing each tool call, in the same order as response_ai_msg.tool_calls.
+                A tool call that fails or times out returns a ToolMessage with status="error".
+        """
+        tool_calls = response_ai_msg.tool_calls
+        if not tool_calls:
+            return []
+        start = time.monotonic()
+        prefetched = prefetched or {}
+        deadlines = [start + self.get_timeout(tool_call["name"]) for tool_call in tool_calls]
+        futures = [prefetched.get(tool_call["id"]) or self.executor.submit(self.run_tool_call, tool_call, deadline)
+                   for tool_call, deadline in zip(tool_calls, deadlines)]
+        tool_responses = []
+        for tool_call, future, deadline in zip(tool_calls, futures, deadlines):
+            timeout = self.get_timeout(tool_call["name"])
+            wait_until = deadline
+            if tool_call["name"] in self.sandboxed_tools:
+                # the sandbox times out the call by the same deadline, moved back by the time a new worker took
+                # to start, and answers first. This only covers the start and killing the worker.
+                wait_until += WORKER_START_TIMEOUT + WORKER_EXIT_TIMEOUT
+            try:
+                tool_responses.append(future.result(timeout=max(0.0, wait_until - time.monotonic())))
+            except FutureTimeoutError:
+                # cancel() only stops calls still waiting for a worker, a running thread cannot be interrupted.
+                future.cancel()
+                tool_responses.append(self.error_message(tool_call, f"Tool {tool_call['name']} timed out after {timeout} seconds"))
+        log.debug("execute_tool_calls() ai_message.tool_calls, tool_responses: %s", lazy_pformat([tool_calls, tool_responses]))
+        return tool_responses
+
+
+    async def aexecute_tool_calls(self, response_ai_msg: AIMessage) -> List[ToolMessage]:
+        """Async version of execute_tool_calls.
+        Async tools run natively on the event loop, sync tools run on the thread pool.
+        A tool call that times out is cancelled.
 
         Args:
-            response_ai_msg (AIMessage): The response from the chat llm 
+            response_ai_msg (AIMessage): The response from the chat llm
 
         Returns:
-            List[ToolMessage]: Results of executing each tool call
+            List[ToolMessage]: Results of executing each tool call, in the same order as response_ai_msg.tool_calls.
         """
-        # https://langchain-ai.github.io/langgraph/how-tos/tool-calling/#using-with-chat-models
-        tool_responses = self.tool_node.invoke({"messages": [response_ai_msg]})
-        print("CHAD execute_tool_calls() ai_message.tool_calls, tool_responses: ")
-        pprint.pp([response_ai_msg.tool_calls, tool_responses])
-        print("\n\n")
-        return tool_responses['messages'] if tool_responses and 'messages' in tool_responses else []
+        tool_calls = response_ai_msg.tool_calls
+        if not tool_calls:
+            return []
+        return list(await asyncio.gather(*(self.arun_tool_call(tool_call) for tool_call in tool_calls)))
+
+
+    def prefetch_tool_call(self, tool_call: ToolCall) -> Future:
+        """Start a tool call on the thread pool before the LLM response is complete, see execute_tool_calls()."""
+        deadline = time.monotonic() + self.get_timeout(tool_call["name"])
+        return self.executor.submit(self.run_tool_call, tool_call, deadline)
+
+
+    def run_tool_call(self, tool_call: ToolCall, deadline: Optional[float] = None) -> ToolMessage:
+        """Run one tool call, or return its cached result. deadline is passed to invoke_tool_call()."""
+        if self.tool_cache.is_cached(tool_call["name"]):
+            return self.tool_cache.get_or_run(tool_call, partial(self.invoke_tool_call, deadline=deadline))
+        return self.invoke_tool_call(tool_call, deadline)
+
+
+    async def arun_tool_call(self, tool_call: ToolCall) -> ToolMessage:
+        """Async version of run_tool_call."""
+        if self.tool_cache.is_cached(tool_call["name"]):
+            return await self.tool_cache.aget_or_run(tool_call, self.ainvoke_tool_call)
+        return await self.ainvoke_tool_call(tool_call)
+
+
+    def invoke_tool_call(self, tool_call: ToolCall, deadline: Optional[float] = None) -> ToolMessage:
+        """Invoke the tool, converting any exception to an error ToolMessage.
+        The result is cut down to the tool's ToolOutputPolicy, with the full output kept in its artifact.
+        deadline, a time.monotonic(), only applies to sandboxed tools, see invoke_sandboxed_tool_call()."""
+        if tool_call["name"] in self.sandboxed_tools:
+            return self.invoke_sandboxed_tool_call(tool_call, deadline)
+        tool = self.get_tool(tool_call["name"])
+        if tool is None:
+            return self.unknown_tool_message(tool_call)
+        start = time.perf_counter()
+        try:
+            if is_async_tool(tool):
+                result = asyncio.run(tool.ainvoke(as_tool_call(tool_call)))
+            else:
+                result = tool.invoke(as_tool_call(tool_call))
+        except Exception as e:
+            result = self.error_message(tool_call, repr(e))
+        observe_tool_call(tool_call["name"], time.perf_counter() - start, result.status)
+        return self.output_limiter.limit(result)
+
+
+    def invoke_sandboxed_tool_call(self, tool_call: ToolCall, deadline: Optional[float] = None) -> ToolMessage:
+        """Invoke the tool in a worker process, which is killed if the call runs past deadline, a time.monotonic().
+        Defaults to the tool's timeout from now, pass the time the caller started waiting plus the timeout."""
+        target = self.sandbox_target(tool_call["name"])
+        if target is None:
+            if tool_call["name"] not in self.registry and tool_call["name"] not in self.tools_by_name:
+                return self.unknown_tool_message(tool_call)
+            return self.error_message(tool_call, f"Tool {tool_call['name']} cannot run in a worker process, "
+                                                 "it is not importable as module:attr")
+        start = time.perf_counter()
+        status = None
+        try:
+            result = self.sandbox.call(target, as_tool_call(tool_call), self.get_timeout(tool_call["name"]), deadline)
+        except ToolSandboxError as e:
+            status = "timeout" if isinstance(e, ToolSandboxTimeout) else None
+            result = self.error_message(tool_call, str(e))
+        observe_tool_call(tool_call["name"], time.perf_counter() - start, status or result.status)
+        return self.output_limiter.limit(result)
+
+
+    def sandbox_target(self, tool_name: str) -> Optional[str]:
+        """The "module:attr" a worker process imports the tool from, None if the tool cannot be imported that way,
+        eg a tool created inside a function."""
+        target = self.registry.target(tool_name)
+        if target is not None:
+            return target
+        tool = self.get_tool(tool_name)
+        func = getattr(tool, "func", None) or getattr(tool, "coroutine", None)
+        if func is None:
+            return None
+        # @tool replaces the module level function with the tool, so the tool is importable by the function's name
+        if getattr(sys.modules.get(func.__module__), func.__name__, None) is not tool:
+            return None
+        return f"{func.__module__}:{func.__name__}"
+
+
+    async def ainvoke_tool_call(self, tool_call: ToolCall) -> ToolMessage:
+        """Invoke the tool on the event loop, converting any exception or timeout to an error ToolMessage."""
+        if tool_call["name"] in self.sandboxed_tools:
+            # the worker process enforces the timeout, and is killed if it runs over
+            deadline = time.monotonic() + self.get_timeout(tool_call["name"])
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.invoke_sandboxed_tool_call, tool_call, deadline)
+        tool = self.get_tool(tool_call["name"])
+        if tool is None:
+            return self.unknown_tool_message(tool_call)
+        timeout = self.get_timeout(tool_call["name"])
+        start = time.perf_counter()
+        status = None
+        try:
+            if is_async_tool(tool):
+                awaitable = tool.ainvoke(as_tool_call(tool_call))
+            else:
+                awaitable = asyncio.get_running_loop().run_in_executor(
+                    self.executor, tool.invoke, as_tool_call(tool_call))
+            result = await asyncio.wait_for(awaitable, timeout)
+        except asyncio.TimeoutError:
+            status = "timeout"
+            result = self.error_message(tool_call, f"Tool {tool_call['name']} timed out after {timeout} seconds")
+        except Exception as e:
+            result = self.error_message(tool_call, repr(e))
+        observe_tool_call(tool_call["name"], time.perf_counter() - start, status or result.status)
+        if self.output_limiter.policy(tool_call["name"]).summarize is not None:
+            # summarizing may be slow, eg an LLM call, keep it off the event loop
+            return await asyncio.get_running_loop().run_in_executor(self.executor, self.output_limiter.limit, result)
+        return self.output_limiter.limit(result)
+
+
+    def unknown_tool_message(self, tool_call: ToolCall) -> ToolMessage:
+        names = dict.fromkeys([*self.registry.names(), *self.tools_by_name])
+        return self.error_message(tool_call,
+            f"{tool_call['name']} is not a valid tool, try one of [{', '.join(names)}].")
+
+
+    def error_message(self, tool_call: ToolCall, error: str) -> ToolMessage:
+        return ToolMessage(
+            content=TOOL_CALL_ERROR_TEMPLATE.format(error=error),
+            name=tool_call["name"],
+            tool_call_id=tool_call["id"],
+            status="error",
+        )
+
+
+    def shutdown(self, wait: bool = False) -> None:
+        """Stop the thread pool. Queued tool calls are cancelled."""
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+
+
+def is_async_tool(tool: BaseTool) -> bool:
+    """True if the tool was created from an async function, eg @tool on an async def."""
+    return getattr(tool, "coroutine", None) is not None and getattr(tool, "func", None) is None
+
+
+def tool_names_from_env(name: str) -> List[str]:
+    """Tool names in the comma separated env variable name."""
+    return [t.strip() for t in os.getenv(name, "").split(",") if t.strip()]
 
 
+def as_tool_call(tool_call: ToolCall) -> ToolCall:
+    """Invoking a tool with a ToolCall (type="tool_call") makes it return a ToolMessage with the right tool_call_id."""
+    return {**tool_call, "type": "tool_call"}
@@ -0,0 +1,193 @@
+"""
+Size limits for tool results, applied before a ToolMessage is added to the chat history.
+
+A ToolMessage is sent to the LLM with every later request of the conversation, so one large tool
+result multiplies the prompt tokens, cost and latency of the rest of the session. ToolOutputLimiter
+cuts the content sent to the LLM down to the tool's ToolOutputPolicy:
+    - JSON results are projected first, keeping only the policy's fields and the first max_items of lists
+    - JSON results still over max_chars keep fewer list items, as many as fit
+    - other results over max_chars are replaced by the policy's summary, if it has a summarize function,
+      or cut at max_chars
+A note telling the LLM what was left out is appended to cut content. The full original content is
+kept out of band, in the ToolMessage's artifact, which is exported with the history but never sent
+to the LLM, see full_content().
+"""
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional, Tuple
+import json
+import os
+from langchain_core.messages import ToolMessage
+from services.metrics import metrics
+from utils import get_logger
+
+
+log = get_logger(__name__)
+
+# about 2000 tokens
+DEFAULT_MAX_CHARS = int(os.getenv("TOOL_OUTPUT_MAX_CHARS", "8000"))
+TRUNCATED_NOTE = "\n[Tool output shortened to fit: {detail}. Ask for something narrower if you need the rest.]"
+# used instead when TRUNCATED_NOTE would take up more than half of max_chars
+SHORT_TRUNCATED_NOTE = "\n[Tool output shortened: {detail}]"
+
+
+@dataclass(frozen=True)
+class ToolOutputPolicy:
+    """How the output of one tool is cut down before it is sent to the LLM.
+
+    Attributes:
+        max_chars: max characters of content sent to the LLM, including the note about what was left out
+        max_items: keep only the first max_items items of every JSON list, None for no limit
+        fields: keep only these keys of JSON objects that have any of them, eg list items, None keeps every key
+        summarize: returns a short summary of the full content, sent instead of content cut at max_chars
+            when the content is not JSON. Called on the tool thread, so it may be slow, eg an LLM call.
+    """
+    max_chars: int = DEFAULT_MAX_CHARS
+    max_items: Optional[int] = None
+    fields: Optional[Tuple[str, ...]] = None
+    summarize: Optional[Callable[[str], str]] = None
+
+
+class ToolOutputLimiter:
+    """Applies per tool ToolOutputPolicy limits to ToolMessages, tools without a policy get default_policy."""
+
+    def __init__(self, policies: Dict[str, ToolOutputPolicy], default_policy: Optional[ToolOutputPolicy] = None):
+        self.policies = policies
+        self.default_policy = ToolOutputPolicy() if default_policy is None else default_policy
+
+    def policy(self, tool_name: str) -> ToolOutputPolicy:
+        return self.policies.get(tool_name, self.default_policy)
+
+    def limit(self, toolmsg: ToolMessage) -> ToolMessage:
+        """toolmsg, or a copy with its content cut down to its tool's policy and the full content in artifact."""
+        content = toolmsg.content
+        if not isinstance(content, str):
+            return toolmsg  # content blocks, eg images, are left to the model's own limits
+        policy = self.policy(toolmsg.name)
+        projects = policy.fields is not None or policy.max_items is not None
+        if len(content) <= policy.max_chars and not projects:
+            return toolmsg
+        value = parse_json(content) if toolmsg.status != "error" else None
+        if value is not None:
+            limited, detail = limit_json(value, policy)
+            if not detail and len(content) <= policy.max_chars:
+                return toolmsg
+        elif len(content) <= policy.max_chars:
+            return toolmsg
+        else:
+            limited, detail = limit_text(content, policy)
+        metrics.counter("toolchat7_tool_output_limited_total", "Tool results cut down before being sent to the LLM",
+                        tool=toolmsg.name or "").inc()
+        log.debug("limited %s output from %d to %d chars, %s", toolmsg.name, len(content), len(limited), detail)
+        if toolmsg.artifact is None:
+            update = {"content": limited, "artifact": {"full_content": content}}
+        else:
+            # keep the tool's own artifact, the full content goes next to it
+            update = {"content": limited, "artifact": {"full_content": content, "artifact": toolmsg.artifact}}
+        return toolmsg.model_copy(update=update)
+
+
+def full_content(toolmsg: ToolMessage) -> Any:
+    """The content the tool returned, before ToolOutputLimiter cut it down."""
+    artifact = toolmsg.artifact
+    if isinstance(artifact, dict) and "full_content" in artifact:
+        return artifact["full_content"]
+    return toolmsg.content
+
+
+def parse_json(content: str) -> Any:
+    """The JSON object or list in content, None if content is not one."""
+    if not content.lstrip().startswith(("{", "[")):
+        return None
+    try:
+        return json.loads(content)
+    except ValueError:
+        return None
+
+
+def limit_json(value: Any, policy: ToolOutputPolicy) -> Tuple[str, str]:
+    """(compact JSON of value projected to the policy and fitting max_chars, what was left out)."""
+    projected = project(value, policy.fields, policy.max_items)
+    text = dumps(projected)
+    items = count_items(value)
+    if len(text) > policy.max_chars:
+        # binary search for the most list items that fit, with room for the note
+        budget = policy.max_chars - len(note_template(policy.max_chars)) - 64
+        low, high, best = 0, max_list_len(projected), None
+        while low <= high:
+            mid = (low + high) // 2
+            candidate = dumps(project(projected, None, mid))
+            if len(candidate) <= budget:
+                best, low = candidate, mid + 1
+            else:
+                high = mid - 1
+        if best is None:
+            # even without list items it is too long, eg one huge string
+            return limit_text(text, policy)
+        text = best
+        projected = json.loads(best)
+    kept = count_items(projected)
+    details = []
+    if kept < items:
+        details.append(f"kept {kept} of {items} list items")
+    if policy.fields is not None:
+        details.append(f"kept fields {', '.join(policy.fields)}")
+    if not details:
+        return text, ""
+    detail = "; ".join(details)
+    return text + note_template(policy.max_chars).format(detail=detail), detail
+
+
+def limit_text(content: str, policy: ToolOutputPolicy) -> Tuple[str, str]:
+    """(content summarized or cut to fit max_chars, what was left out)."""
+    template = note_template(policy.max_chars)
+    if policy.summarize is not None:
+        try:
+            summary = policy.summarize(content)
+            detail = f"summary of {len(content)} chars"
+            note = template.format(detail=detail)
+            return summary[:max(policy.max_chars - len(note), 0)] + note, detail
+        except Exception as e:
+            log.warning("summarize failed, cutting the tool output instead: %r", e)
+    note = template.format(detail=f"first {policy.max_chars} of {len(content)} chars")
+    keep = max(policy.max_chars - len(note), 0)
+    detail = f"first {keep} of {len(content)} chars"
+    return content[:keep] + template.format(detail=detail), detail
+
+
+def note_template(max_chars: int) -> str:
+    """TRUNCATED_NOTE, or SHORT_TRUNCATED_NOTE if max_chars is too small for it to leave room for content."""
+    # 40 chars is about the longest detail, eg "first 12345 of 1234567 chars"
+    return TRUNCATED_NOTE if len(TRUNCATED_NOTE) + 40 <= max_chars // 2 else SHORT_TRUNCATED_NOTE
+
+
+def project(value: Any, fields: Optional[Tuple[str, ...]], max_items: Optional[int]) -> Any:
+    """value with only fields kept in the dicts that have any of them, and lists cut to max_items."""
+    if isinstance(value, list):
+        items = value if max_items is None else value[:max_items]
+        return [project(item, fields, max_items) for item in items]
+    if isinstance(value, dict):
+        if fields is not None and any(f in value for f in fields):
+            return {k: project(value[k], fields, max_items) for k in fields if k in value}
+        return {k: project(v, fields, max_items) for k, v in value.items()}
+    return value
+
+
+def count_items(value: Any) -> int:
+    """Number of list items in value, at any depth."""
+    if isinstance(value, list):
+        return len(value) + sum(count_items(item) for item in value)
+    if isinstance(value, dict):
+        return sum(count_items(v) for v in value.values())
+    return 0
+
+
+def max_list_len(value: Any) -> int:
+    if isinstance(value, list):
+        return max([len(value), *(max_list_len(item) for item in value)])
+    if isinstance(value, dict):
+        return max([0, *(max_list_len(v) for v in value.values())])
+    return 0
+
+
+def dumps(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str)
@@ -0,0 +1,80 @@
+"""
+Starts tool calls while the LLM response is still streaming, so tool latency overlaps with the rest of
+the generation instead of adding to it.
+
+stream_response_langchain() passes the merged AIMessageChunk to ToolCallPrefetcher.update() after each
+chunk. A tool call chunk with a name, an id and arguments that parse as a complete JSON object is started
+at once on the ToolManager's thread pool. When the stream ends, take() reconciles the started calls with
+the final message's tool_calls: a call with the same id, name and args is used as is, any other is
+discarded and its result ignored. Final tool calls that were not started early run as usual.
+
+A discarded call has still run, so only the tools in ToolManager.prefetch_tools, set with the TOOL_PREFETCH
+env variable, are started early. List tools without side effects, eg lookups.
+"""
+from concurrent.futures import Future
+from typing import Any, Dict, Optional, Tuple, TYPE_CHECKING
+import json
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.messages.tool import ToolCall
+from services.metrics import metrics
+from utils import get_logger
+
+if TYPE_CHECKING:
+    from services.tool_manager import ToolManager
+
+
+log = get_logger(__name__)
+
+
+class ToolCallPrefetcher:
+    """Tool calls of one streamed AI message started before the message is complete, see the module docstring."""
+
+    def __init__(self, tool_manager: "ToolManager"):
+        self.tool_manager = tool_manager
+        # started tool calls and their results, by tool call chunk index
+        self._started: Dict[int, Tuple[ToolCall, Future]] = {}
+
+    def update(self, message: AIMessageChunk) -> None:
+        """Start the tool calls of message, the chunks streamed so far merged, whose arguments are complete."""
+        for chunk in message.tool_call_chunks:
+            index, name = chunk.get("index"), chunk.get("name")
+            if index is None or index in self._started or name not in self.tool_manager.prefetch_tools:
+                continue
+            args = complete_args(chunk.get("args"))
+            if args is None or not chunk.get("id"):
+                continue
+            tool_call = ToolCall(name=name, args=args, id=chunk["id"], type="tool_call")
+            log.debug("prefetching tool call %s", tool_call)
+            self._started[index] = (tool_call, self.tool_manager.prefetch_tool_call(tool_call))
+
+    def take(self, response_ai_msg: AIMessage) -> Dict[str, Future]:
+        """Results of the started tool calls that match a tool call of the complete response_ai_msg, by
+        tool call id, for ToolManager.execute_tool_calls(). The other started calls are discarded."""
+        final = {tool_call["id"]: tool_call for tool_call in response_ai_msg.tool_calls}
+        matched: Dict[str, Future] = {}
+        for tool_call, future in self._started.values():
+            other = final.get(tool_call["id"])
+            used = (other is not None and tool_call["id"] not in matched and other["name"] == tool_call["name"]
+                    and other["args"] == tool_call["args"])
+            if used:
+                matched[tool_call["id"]] = future
+            else:
+                # only stops a call still waiting for a thread, a running call finishes and is ignored
+                future.cancel()
+                log.info("discarded prefetched tool call %s, it is not in the final message", tool_call)
+            metrics.counter("toolchat7_tool_prefetches_total", "Tool calls started before the LLM response was complete",
+                            tool=tool_call["name"], outcome="used" if used else "discarded").inc()
+        self._started = {}
+        return matched
+
+
+def complete_args(args: Optional[str]) -> Optional[Dict[str, Any]]:
+    """The streamed tool call arguments as a dict if they are a complete JSON object, else None.
+    An object is complete once its closing brace arrived, later chunks could only make it invalid."""
+    if not args or not args.rstrip().endswith("}"):
+        return None
+    try:
+        value = json.loads(args)
+    except ValueError:
+        return None
+    return value if isinstance(value, dict) else None
@@ -0,0 +1,262 @@
+"""
+Registry of the tools the LLM can call, with plugin discovery, lazy imports and per request tool selection.
+
+Tools come from:
+    - ToolRegistry.register(), with a tool object or a lazy "module:attr" target
+    - plugins, any installed package declaring a "toolchat7.tools" entry point, eg in its pyproject.toml:
+          [project.entry-points."toolchat7.tools"]
+          lookup_stock = "my_package.tools:lookup_stock"
+    - the TOOLCHAT7_TOOLS env variable, comma separated "module:attr" targets
+A lazy tool's module is imported when the tool is first called, or when its schema is first needed.
+
+Every tool schema is sent with every LLM request, so with many tools the registry selects the ones
+relevant to the request: those whose name, description or keywords match recent human messages,
+those called earlier in the conversation, and those registered with always=True. With
+TOOL_SELECT_ABOVE or fewer tools every tool is sent, since selection would save little.
+Serialized schemas are cached, in memory and optionally in the TOOL_SCHEMA_CACHE json file, so
+selecting tools does not import plugin modules. bind_tools() is memoized per client and tool set.
+"""
+from importlib import import_module, metadata
+from importlib.util import find_spec
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+import json
+import math
+import os
+import re
+import threading
+from langchain_core.messages import AIMessage, BaseMessage
+from utils import get_logger
+
+
+log = get_logger(__name__)
+
+ENTRY_POINT_GROUP = "toolchat7.tools"
+# with this many tools or fewer, every tool is sent with every request
+TOOL_SELECT_ABOVE = int(os.getenv("TOOL_SELECT_ABOVE", "8"))
+# most tools selected by keyword for one request, tools called earlier and always tools come on top
+TOOL_SELECT_MAX = int(os.getenv("TOOL_SELECT_MAX", "5"))
+# recent human messages used as the query to select tools, so follow ups keep their tools
+SELECT_QUERY_MESSAGES = 3
+STOP_WORDS = frozenset(
+    "a an and are as at be by call can do for from get how i in is it me my of on or please "
+    "the this to use what when where which who with you your".split())
+
+
+def tokenize(text: str) -> List[str]:
+    """Lower case words with a crude plural stemming, eg "Cities?" -> ["city"]."""
+    words = []
+    for word in re.findall(r"[a-z0-9]+", text.lower()):
+        if word in STOP_WORDS:
+            continue
+        if len(word) > 4 and word.endswith("ies"):
+            word = word[:-3] + "y"
+        elif len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        words.append(word)
+    return words
+
+
+class ToolSpec:
+    """One registered tool, the tool object itself or a "module:attr" target imported on first use."""
+    __slots__ = ("name", "target", "keywords", "always", "_tool")
+
+    def __init__(self, name: str, target: Any, keywords: Sequence[str] = (), always: bool = False):
+        self.name = name
+        self.target = target if isinstance(target, str) else None
+        self.keywords = tuple(keywords)
+        self.always = always
+        self._tool = None if isinstance(target, str) else target
+
+    def load(self) -> Any:
+        if self._tool is None:
+            module_name, _, attr = self.target.partition(":")
+            self._tool = getattr(import_module(module_name), attr)
+            log.debug("imported tool %s from %s", self.name, self.target)
+        return self._tool
+
+    def fingerprint(self) -> Optional[str]:
+        """Identifies this version of a lazy tool's source, for the on-disk schema cache. None if unknown."""
+        if self.target is None:
+            return None
+        try:
+            spec = find_spec(self.target.partition(":")[0])
+            origin = spec.origin if spec else None
+            return f"{self.target}@{os.stat(origin).st_mtime_ns}" if origin else None
+        except (ImportError, OSError, ValueError):
+            return None
+
+
+class ToolRegistry:
+    """Tools by name, in registration order."""
+
+    def __init__(self, schema_cache_path: Optional[str | Path] = None):
+        """
+        Args:
+            schema_cache_path: json file caching lazy tools' schemas between runs, None for memory only
+        """
+        self.schema_cache_path = Path(schema_cache_path) if schema_cache_path else None
+        self._specs: Dict[str, ToolSpec] = {}
+        self._schemas: Dict[str, Dict[str, Any]] = {}
+        self._disk_schemas: Dict[str, Dict[str, Any]] = self._read_schema_cache()
+        # term -> {tool name: weight}, rebuilt when tools are registered
+        self._index: Optional[Dict[str, Dict[str, float]]] = None
+        # (id(llm), tool names) -> (llm, bound llm), llm is kept so its id is not reused
+        self._bound: Dict[Tuple[int, Tuple[str, ...]], Tuple[Any, Any]] = {}
+        self._lock = threading.Lock()
+
+    def register(self, tool: Any, name: Optional[str] = None, keywords: Sequence[str] = (),
+                 always: bool = False) -> None:
+        """Register a tool object, or a "module:attr" target imported when first needed.
+
+        Args:
+            tool: a langchain tool, or "module:attr" naming one
+            name: defaults to the tool's name, or attr for a target. Must match the tool's name.
+            keywords: extra words that select this tool, besides its name and description
+            always: send this tool with every request
+        """
+        if name is None:
+            name = tool.partition(":")[2] if isinstance(tool, str) else tool.name
+        with self._lock:
+            self._specs[name] = ToolSpec(name, tool, keywords, always)
+            self._schemas.pop(name, None)
+            self._index = None
+            self._bound.clear()
+
+    def discover(self, group: str = ENTRY_POINT_GROUP) -> int:
+        """Register the tools declared by installed plugins as entry points, without importing them.
+        Returns the number registered."""
+        entry_points = metadata.entry_points(group=group)
+        for entry_point in entry_points:
+            self.register(entry_point.value, name=entry_point.name)
+        return len(entry_points)
+
+    def register_targets(self, targets: str) -> None:
+        """Register comma separated "module:attr" targets, eg from TOOLCHAT7_TOOLS."""
+        for target in filter(None, (t.strip() for t in targets.split(","))):
+            self.register(target)
+
+    def names(self) -> List[str]:
+        return list(self._specs)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._specs
+
+    def __len__(self) -> int:
+        return len(self._specs)
+
+    def get(self, name: str) -> Optional[Any]:
+        """The tool, imported if needed, or None if there is no such tool."""
+        spec = self._specs.get(name)
+        return spec.load() if spec is not None else None
+
+    def target(self, name: str) -> Optional[str]:
+        """The "module:attr" a lazy tool is imported from, None for a tool registered as an object."""
+        spec = self._specs.get(name)
+        return spec.target if spec is not None else None
+
+    def tools(self, names: Optional[Iterable[str]] = None) -> List[Any]:
+        """Tools in names, or all tools, imported if needed."""
+        return [self._specs[name].load() for name in (self._specs if names is None else names)]
+
+    def schemas(self, names: Optional[Iterable[str]] = None) -> List[Dict[str, Any]]:
+        """OpenAI format schemas of the tools in names, or of all tools."""
+        return [self.schema(name) for name in (self._specs if names is None else names)]
+
+    def schema(self, name: str) -> Dict[str, Any]:
+        schema = self._schemas.get(name)
+        if schema is not None:
+            return schema
+        spec = self._specs[name]
+        fingerprint = spec.fingerprint()
+        cached = self._disk_schemas.get(name)
+        if fingerprint and cached and cached.get("fingerprint") == fingerprint:
+            schema = cached["schema"]
+        else:
+            from langchain_core.utils.function_calling import convert_to_openai_tool
+            schema = convert_to_openai_tool(spec.load())
+            if fingerprint:
+                self._disk_schemas[name] = {"fingerprint": fingerprint, "schema": schema}
+                self._write_schema_cache()
+        self._schemas[name] = schema
+        return schema
+
+    def select(self, query: str, limit: int = TOOL_SELECT_MAX) -> List[str]:
+        """Up to limit tool names matching words in query, best match first."""
+        index = self._get_index()
+        scores: Dict[str, float] = {}
+        for term in set(tokenize(query)):
+            for name, weight in index.get(term, {}).items():
+                scores[name] = scores.get(name, 0.0) + weight
+        return sorted(scores, key=lambda name: -scores[name])[:limit]
+
+    def select_for_messages(self, messages: Sequence[BaseMessage]) -> Optional[Tuple[str, ...]]:
+        """Names of the tools to send with a request for messages, in registration order,
+        or None for all tools, if there are TOOL_SELECT_ABOVE or fewer."""
+        if len(self._specs) <= TOOL_SELECT_ABOVE:
+            return None
+        selected: Set[str] = {name for name, spec in self._specs.items() if spec.always}
+        human = []
+        for msg in reversed(messages):
+            if isinstance(msg, AIMessage):
+                selected.update(c["name"] for c in msg.tool_calls if c["name"] in self._specs)
+            elif msg.type == "human" and len(human) < SELECT_QUERY_MESSAGES:
+                human.append(msg.content if isinstance(msg.content, str) else json.dumps(msg.content))
+        selected.update(self.select(" ".join(human)))
+        return tuple(name for name in self._specs if name in selected)
+
+    def bind(self, llm: Any, names: Optional[Tuple[str, ...]] = None) -> Any:
+        """llm.bind_tools() with the tools in names, or all tools, memoized per llm and tool set.
+        Selected tools are bound with their cached schemas, so binding does not import them."""
+        key = (id(llm), names)
+        bound = self._bound.get(key)
+        if bound is None:
+            tools = self.tools() if names is None else self.schemas(names)
+            with self._lock:
+                bound = self._bound.setdefault(key, (llm, llm.bind_tools(tools)))
+        return bound[1]
+
+    def _get_index(self) -> Dict[str, Dict[str, float]]:
+        """Inverted index of the words in each tool's name, description, parameters and keywords.
+        Words shared by many tools weigh less, like idf."""
+        index = self._index
+        if index is not None:
+            return index
+        terms_by_tool = {}
+        for name, spec in list(self._specs.items()):
+            function = self.schema(name).get("function", {})
+            text = " ".join([name.replace("_", " "), function.get("description", ""), *spec.keywords,
+                             *function.get("parameters", {}).get("properties", {})])
+            terms_by_tool[name] = set(tokenize(text))
+        index = {}
+        for name, terms in terms_by_tool.items():
+            for term in terms:
+                index.setdefault(term, {})[name] = 0.0
+        for term, names in index.items():
+            weight = math.log(1 + len(terms_by_tool) / len(names))
+            for name in names:
+                names[name] = weight
+        self._index = index
+        return index
+
+    def _read_schema_cache(self) -> Dict[str, Dict[str, Any]]:
+        if not self.schema_cache_path:
+            return {}
+        try:
+            return json.loads(self.schema_cache_path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            log.warning("ignoring unreadable tool schema cache %s: %r", self.schema_cache_path, e)
+            return {}
+
+    def _write_schema_cache(self) -> None:
+        if not self.schema_cache_path:
+            return
+        try:
+            self.schema_cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.schema_cache_path.with_suffix(f".{os.getpid()}.tmp")
+            tmp_path.write_text(json.dumps(self._disk_schemas, sort_keys=True), encoding="utf-8")
+            os.replace(tmp_path, self.schema_cache_path)
+        except OSError as e:
+            log.warning("could not write tool schema cache %s: %r", self.schema_cache_path, e)
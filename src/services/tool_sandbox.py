@@ -0,0 +1,258 @@
+"""
+Runs CPU heavy or blocking tools in a pool of worker processes, so they cannot hold the GIL
+against every other session, and a hung tool can be killed.
+
+ToolManager runs the tools named in TOOL_SANDBOX, or in its sandboxed_tools argument, with
+ToolSandbox.call(). A call is sent to an idle worker process as the tool's "module:attr" target and
+the tool call, and the worker imports the tool, once per process, invokes it and sends back the
+ToolMessage. Both are pickled, so a sandboxed tool's arguments and results must be picklable.
+    - workers are started with the "spawn" method, so they do not inherit the threads and locks
+      of the server process, and stay up between calls
+    - at most max_workers calls run at once, more wait for a worker
+    - a call has one deadline, its timeout from when the caller started it, for both the wait for a
+      free worker and the run. The time a new worker takes to start and import the tool is not
+      counted, up to WORKER_START_TIMEOUT
+    - a call running past its deadline has its worker killed, and a new worker is started in the
+      background, so the next call does not wait for one
+    - a worker is replaced after max_calls_per_worker calls, so leaks in tools do not build up
+
+Configured from env variables, see ToolSandbox.from_env():
+    TOOL_SANDBOX              comma separated tool names to run in worker processes
+    TOOL_SANDBOX_WORKERS      worker processes, defaults to the number of CPUs, at most 4
+    TOOL_SANDBOX_MAX_CALLS    calls before a worker is replaced, defaults to 200
+"""
+from functools import lru_cache
+from importlib import import_module
+from typing import Any, Dict, List, Optional
+import asyncio
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from langchain_core.messages import ToolMessage
+from langchain_core.messages.tool import ToolCall
+from services.metrics import metrics
+from utils import get_logger
+
+
+log = get_logger(__name__)
+
+DEFAULT_MAX_WORKERS = min(4, os.cpu_count() or 1)
+DEFAULT_MAX_CALLS_PER_WORKER = 200
+# seconds a worker gets to start and import a tool, before the tool's own timeout starts
+WORKER_START_TIMEOUT = 30.0
+# seconds a worker gets to exit by itself before it is killed
+WORKER_EXIT_TIMEOUT = 2.0
+
+
+class ToolSandboxError(Exception):
+    """A sandboxed tool call failed: the tool raised, timed out, or its worker died. str() is the reason."""
+
+
+class ToolSandboxTimeout(ToolSandboxError):
+    pass
+
+
+def worker_main(conn: Any) -> None:
+    """Worker process loop: receive (target, tool_call), send ("started", None) once the tool is imported,
+    then ("ok", ToolMessage) or ("error", reason). Exits when the connection is closed or None is received."""
+    # Ctrl-C is for the server process, which stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    tools: Dict[str, Any] = {}
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            return
+        if request is None:
+            return
+        target, tool_call = request
+        try:
+            tool = tools.get(target)
+            if tool is None:
+                module_name, _, attr = target.partition(":")
+                tool = tools[target] = getattr(import_module(module_name), attr)
+            conn.send(("started", None))
+            if getattr(tool, "func", None) is None and getattr(tool, "coroutine", None) is not None:
+                result = asyncio.run(tool.ainvoke(tool_call))
+            else:
+                result = tool.invoke(tool_call)
+            conn.send(("ok", result))
+        except Exception as e:
+            # also a result that cannot be pickled, send() pickles before writing anything
+            conn.send(("error", repr(e)))
+
+
+class _Worker:
+    __slots__ = ("process", "conn", "calls")
+
+    def __init__(self, process: Any, conn: Any):
+        self.process = process
+        self.conn = conn
+        self.calls = 0
+
+
+class ToolSandbox:
+    """Bounded pool of warm worker processes running tool calls, see the module docstring."""
+
+    def __init__(self, max_workers: int = DEFAULT_MAX_WORKERS,
+                 max_calls_per_worker: int = DEFAULT_MAX_CALLS_PER_WORKER, start_method: str = "spawn"):
+        """
+        Args:
+            max_workers: worker processes, and so calls running at once
+            max_calls_per_worker: calls before a worker is replaced by a new one
+            start_method: multiprocessing start method, "fork" is faster to start but unsafe with threads
+        """
+        self.max_workers = max_workers
+        self.max_calls_per_worker = max_calls_per_worker
+        self._context = multiprocessing.get_context(start_method)
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._idle: List[_Worker] = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @classmethod
+    def from_env(cls) -> "ToolSandbox":
+        return cls(max_workers=int(os.getenv("TOOL_SANDBOX_WORKERS", DEFAULT_MAX_WORKERS)),
+                   max_calls_per_worker=int(os.getenv("TOOL_SANDBOX_MAX_CALLS", DEFAULT_MAX_CALLS_PER_WORKER)))
+
+    def warm(self, count: Optional[int] = None) -> None:
+        """Start idle workers, up to count or max_workers, so the first calls do not wait for a process to start."""
+        count = self.max_workers if count is None else min(count, self.max_workers)
+        while True:
+            with self._lock:
+                if self._closed or len(self._idle) >= count:
+                    return
+            worker = self._spawn()
+            with self._lock:
+                self._idle.append(worker)
+
+    def idle_workers(self) -> int:
+        with self._lock:
+            return len(self._idle)
+
+    def call(self, target: str, tool_call: ToolCall, timeout: float, deadline: Optional[float] = None) -> ToolMessage:
+        """Run the tool call in a worker process.
+
+        Args:
+            target: "module:attr" of the tool, imported by the worker
+            tool_call: the tool call, with type="tool_call" so the tool returns a ToolMessage
+            timeout: the tool's timeout in seconds, for error messages and the default deadline
+            deadline: time.monotonic() by which the wait for a free worker and the tool's run must be done,
+                before the worker is killed. Defaults to timeout from now, pass the time the caller started
+                waiting plus timeout so both agree. A new worker starting and importing the tool moves the
+                deadline back by the time it took, see WORKER_START_TIMEOUT.
+
+        Raises:
+            ToolSandboxTimeout: the tool, or the wait for a worker, ran past the deadline
+            ToolSandboxError: the tool raised, or its worker died or did not start
+        """
+        if deadline is None:
+            deadline = time.monotonic() + timeout
+        if not self._slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            raise ToolSandboxTimeout(f"Tool {tool_call['name']} timed out after {timeout} seconds waiting for a worker")
+        try:
+            worker = self._take()
+            try:
+                sent = time.monotonic()
+                worker.conn.send((target, tool_call))
+                status, value = worker.conn.recv() if worker.conn.poll(WORKER_START_TIMEOUT) else ("start", None)
+                if status == "started":
+                    deadline += time.monotonic() - sent
+                    remaining = max(0.0, deadline - time.monotonic())
+                    status, value = worker.conn.recv() if worker.conn.poll(remaining) else (None, None)
+            except (EOFError, OSError) as e:
+                self._stop(worker, "crash")
+                raise ToolSandboxError(f"Tool {tool_call['name']} worker process died, exit code "
+                                       f"{worker.process.exitcode}: {e!r}") from e
+            if status == "start":
+                self._replace(worker, "timeout")
+                raise ToolSandboxError(f"Tool {tool_call['name']} worker process did not start "
+                                       f"in {WORKER_START_TIMEOUT} seconds")
+            if status is None:
+                self._replace(worker, "timeout")
+                raise ToolSandboxTimeout(f"Tool {tool_call['name']} timed out after {timeout} seconds")
+            worker.calls += 1
+            if worker.calls >= self.max_calls_per_worker:
+                self._replace(worker, "recycle")
+            else:
+                with self._lock:
+                    closed = self._closed
+                    if not closed:
+                        self._idle.append(worker)
+                if closed:
+                    self._stop(worker, None)
+            if status == "error":
+                raise ToolSandboxError(value)
+            return value
+        finally:
+            self._slots.release()
+
+    def shutdown(self) -> None:
+        """Stop the idle workers. Calls still running finish, then their workers are stopped too."""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            self._stop(worker, None)
+
+    def _take(self) -> _Worker:
+        while True:
+            with self._lock:
+                worker = self._idle.pop() if self._idle else None
+            if worker is None:
+                return self._spawn()
+            if worker.process.is_alive():
+                return worker
+            self._stop(worker, "crash")
+
+    def _spawn(self) -> _Worker:
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=worker_main, args=(child_conn,), name="toolchat7-tool-worker",
+                                        daemon=True)
+        process.start()
+        child_conn.close()
+        log.debug("started tool worker pid=%s", process.pid)
+        return _Worker(process, parent_conn)
+
+    def _replace(self, worker: _Worker, reason: str) -> None:
+        """Stop a worker and start a new idle one in the background, so the caller does not wait for either."""
+        threading.Thread(target=self._respawn, args=(worker, reason), name="toolchat7-sandbox-respawn",
+                         daemon=True).start()
+
+    def _respawn(self, worker: _Worker, reason: str) -> None:
+        self._stop(worker, reason)
+        with self._lock:
+            if self._closed or len(self._idle) >= self.max_workers:
+                return
+        new_worker = self._spawn()
+        with self._lock:
+            if not self._closed and len(self._idle) < self.max_workers:
+                self._idle.append(new_worker)
+                return
+        self._stop(new_worker, None)
+
+    def _stop(self, worker: _Worker, reason: Optional[str]) -> None:
+        """Stop a worker, asking it to exit unless it timed out or crashed, killing it if it does not."""
+        if reason in (None, "recycle"):
+            try:
+                worker.conn.send(None)
+                worker.process.join(WORKER_EXIT_TIMEOUT)
+            except OSError:
+                pass
+        if worker.process.is_alive():
+            worker.process.kill()
+            worker.process.join(WORKER_EXIT_TIMEOUT)
+        worker.conn.close()
+        if reason is not None:
+            metrics.counter("toolchat7_tool_worker_restarts_total", "Tool worker processes replaced",
+                            reason=reason).inc()
+            if reason != "recycle":
+                log.warning("tool worker pid=%s stopped, %s", worker.process.pid, reason)
+
+
+@lru_cache(maxsize=1)
+def default_tool_sandbox() -> ToolSandbox:
+    """The process-wide tool sandbox from env variables, shared by every ToolManager. Workers start on first use."""
+    return ToolSandbox.from_env()
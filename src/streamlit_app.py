@@ -4,29 +4,52 @@ Main Streamlit application for the chatbot interface.
 import os
 import streamlit as st
 from datetime import datetime
-from io import StringIO
 from typing import Optional
 from dotenv import load_dotenv
-import traceback
+from uuid import uuid4
 
 from services.chat_model import ChatModelService
-from services.chat_history import ChatHistoryManager
+from services.chat_history import DisplayMessage
+from services.metrics import metrics
+from services.scheduler import request_scope
+from services.session_manager import ManagedChatHistoryManager, default_session_manager
+from services.sqlite_chat_history import SQLiteChatHistoryManager
 from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
-from langchain.globals import set_verbose, set_debug
+from langchain_core.globals import set_verbose, set_debug
+from utils import get_logger
+
+
+log = get_logger("streamlit_app")
 
 
 
 
 def dbg(msg):
-    if st.session_state.dbg_print:
-        print(f"{datetime.now().strftime('%H:%M:%S.%f')} {msg}", flush=True)
+    # DEBUG_PRINT=True turns on debug level logging, see utils/log.py
+    log.debug("%s", msg)
+
+def new_chat_history() -> ManagedChatHistoryManager | SQLiteChatHistoryManager:
+    """Chat history for this browser session, keyed by the "session" query param,
+    so reloading the page with the same URL resumes the conversation.
+    If CHAT_HISTORY_DB is set, history is persisted there, even across server restarts.
+    Otherwise it is kept by the session manager, which spills idle sessions to disk, see services/session_manager.py.
+    """
+    session_id = st.query_params.get("session") or uuid4().hex
+    st.query_params["session"] = session_id
+    db_path = os.getenv("CHAT_HISTORY_DB")
+    if not db_path:
+        return default_session_manager().history(session_id)
+    return SQLiteChatHistoryManager(session_id, db_path)
 
 def init_session_state() -> None:
     """Initialize session state variables."""
     if "initialized" in st.session_state:
         return
     if "chat_history" not in st.session_state:
-        st.session_state.chat_history = ChatHistoryManager()
+        st.session_state.chat_history = new_chat_history()
+    if "session_id" not in st.session_state:
+        # identifies this browser session's LLM requests in the scheduler queue
+        st.session_state.session_id = uuid4().hex
     if "dbg_print" not in st.session_state:
         st.session_state.dbg_print = os.getenv('DEBUG_PRINT')
     # Setting the verbose flag will print out inputs and outputs in a slightly more readable format 
@@ -93,7 +116,7 @@ def download_messages() -> None:
     now = datetime.now()
     fn = f"toolchat7_messages_{now.strftime('%Y-%m-%d')}_{int(now.timestamp())}.json"
     messages_json = st.session_state.chat_history.export_json()
-    dbg(f"messages_json now {len(messages_json)} bytes, {len(st.session_state.chat_history.messages)} messages")
+    dbg(f"messages_json now {len(messages_json)} bytes")
     st.markdown("Save chat messages by downloading.  \nClick twice to get latest (bug).")
     st.download_button(
         label="Download Messages as JSON",
@@ -102,13 +125,20 @@ def download_messages() -> None:
         file_name=fn,
         mime="application/json"
     )
+    st.download_button(
+        label="Download Messages as NDJSON",
+        data="".join(st.session_state.chat_history.export_ndjson()),
+        on_click=lambda: dbg("NDJSON download button clicked"),
+        file_name=fn.replace(".json", ".ndjson"),
+        mime="application/x-ndjson"
+    )
     dbg(f"Initialized download_button {len(messages_json)} bytes for file_name={fn}")
 
 
 def upload_messages() -> None:
-    """Handle file upload to restore previous chat messages from JSON file.
+    """Handle file upload to restore previous chat messages from JSON or NDJSON file.
     
-    Allows users to upload a previously saved chat history JSON file.
+    Allows users to upload a previously saved chat history JSON or NDJSON file.
     Updates st.session_state.messages with the uploaded content if successful.
     Displays error message if JSON parsing fails or format is invalid.
     """
@@ -119,34 +149,52 @@ def upload_messages() -> None:
     uploaded_file = st.file_uploader(
         "Restore Saved Chat Messages.\nChoose a File",
         key=st.session_state.uploader_key,
-        type="json")    
+        type=["json", "ndjson", "jsonl"])
     if uploaded_file is not None:
         try:
             dbg(f"Uploaded {uploaded_file.size} bytes from {uploaded_file.name}")
-            stringio = StringIO(uploaded_file.getvalue().decode("utf-8"))
-            string_data = stringio.read()
-            st.session_state.chat_history.import_json(string_data)
+            if uploaded_file.name.endswith((".ndjson", ".jsonl")):
+                # uploaded_file is a BytesIO, iterate it line by line instead of decoding a copy
+                st.session_state.chat_history.import_ndjson(uploaded_file)
+            else:
+                st.session_state.chat_history.import_json(uploaded_file.getvalue())
             uploaded_file = None
             st.session_state.uploader_key += 1
         except Exception as e:
             st.error("Error parsing JSON file. Please ensure the file is in the correct format.", icon="🚨")
             st.exception(e)
 
-def render_message(msg: BaseMessage):
+def render_message(msg: BaseMessage | DisplayMessage):
     with st.chat_message(msg.type):
         #st.write(msg.content)
         st.markdown(msg.content)
         #if isinstance(msg, TimeMessage):
         #    st.caption(f"{msg.time.strftime(readable_time_format)}")
 
+def show_metrics() -> None:
+    """Latency, token and tool metrics for this server process, shown if SHOW_METRICS=True."""
+    with st.expander("Metrics"):
+        counts = default_session_manager().counts()
+        st.caption(f"{counts['resident']} sessions in memory using {counts['resident_bytes'] / 1e6:.1f} MB, "
+                   f"{counts['spilled']} spilled to disk")
+        rows = metrics.summaries()
+        if not rows:
+            st.caption("No LLM calls yet.")
+            return
+        st.dataframe(rows, hide_index=True)
+        st.code(metrics.render_prometheus(), language="text")
+
 def setup_sidebar() -> None:
     """Configure and display sidebar elements."""
     with st.sidebar:
         download_messages()
         upload_messages()
+        if os.getenv("SHOW_METRICS", "").lower() in ("1", "true", "yes"):
+            show_metrics()
 
 def display_chat_history() -> None:
-    """Display all messages in the chat history."""
+    """Display all messages in the chat history.
+    Uses the display view kept by the chat history, so a rerun does not rebuild or copy any messages."""
     for msg in st.session_state.chat_history.get_just_ai_human_message():
         render_message(msg)
 
@@ -160,17 +208,16 @@ def handle_user_input(chat_model: ChatModelService) -> None:
     if prompt := st.chat_input("What can I answer for you today?"):
         # Add user message
         st.session_state.chat_history.add_human_message(prompt)
-        render_message(st.session_state.chat_history.messages[-1])        
-        # Generate and display response
+        render_message(DisplayMessage("human", prompt))
+        # Generate and display response, rendering tokens as they arrive
         try:
-            st.session_state.chat_model.generate_response_langchain()
-            dbg(f"CHAD: generate_response_langchain returned")
-            render_message(st.session_state.chat_history.messages[-1])
+            with st.chat_message("ai"), request_scope(session=st.session_state.session_id):
+                st.write_stream(st.session_state.chat_model.stream_response_langchain(
+                    chat_history=st.session_state.chat_history,
+                    on_event=lambda event: st.toast(str(event), icon="🔁")))
+            dbg(f"CHAD: stream_response_langchain returned")
         except Exception as e:
-            print(f"CHAD: generate_response_langchain failed. {type(e)} Exception:\n{e}\n{repr(e)}\n")
-            print(f"CHAD: generate_response_langchain traceback:")
-            print(traceback.format_exc())
-            print("\n\n")
+            log.exception("stream_response_langchain failed. %s Exception: %r", type(e), e)
             st.error(f"Error generating response: {str(e)}", icon="🚨")
 
 
@@ -187,14 +234,13 @@ def main() -> None:
         try:
             if "chat_model" not in st.session_state:
                 st.session_state.chat_model = get_chat_model(st.session_state.api_key)
-                st.session_state.chat_model.set_chat_history(st.session_state.chat_history)
+                # a resumed conversation already starts with the system message
+                resumed = next(st.session_state.chat_history.iter_messages(), None) is not None
+                st.session_state.chat_model.set_chat_history(st.session_state.chat_history, skip_system_message=resumed)
             display_chat_history()
             handle_user_input(st.session_state.chat_model)
         except Exception as e:
-            print(f"CHAD: main() {type(e)} Exception:\n{e}\n{repr(e)}\n")
-            print(f"CHAD: main() traceback:")
-            print(traceback.format_exc())
-            print("\n\n")
+            log.exception("main() %s Exception: %r", type(e), e)
 
 if __name__ == "__main__":
     main()
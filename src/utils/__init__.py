@@ -1,3 +1,4 @@
 from utils.utils import warn, error, success, dbg_important
+from utils.log import get_logger, setup_logging, lazy_pformat, Lazy
 
-__all__ = ["warn", "error", "success", "dbg_important"]
+__all__ = ["warn", "error", "success", "dbg_important", "get_logger", "setup_logging", "lazy_pformat", "Lazy"]
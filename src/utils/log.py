@@ -0,0 +1,134 @@
+"""
+Leveled logging for toolchat7, colored by level on the console.
+
+Configured from env variables:
+    LOG_LEVEL        DEBUG, INFO, WARNING or ERROR. Defaults to DEBUG if DEBUG_PRINT=True, otherwise INFO.
+    LOG_FORMAT       "color" (default) for the console, "json" for one structured JSON object per line.
+    LOG_SAMPLE_RATE  0.0 - 1.0, fraction of DEBUG records kept, defaults to 1.0
+
+Pass values as arguments instead of f-strings, log.debug("got %d messages: %s", n, lazy_pformat(messages)),
+so nothing is formatted unless the record is emitted. A disabled level costs one cached level check.
+"""
+from typing import Any, Callable, Optional, TextIO
+import json
+import logging
+import os
+import pprint
+import random
+import sys
+import threading
+
+
+ROOT_LOGGER_NAME = "toolchat7"
+# ANSI terminal colors: DEBUG cyan, INFO green, WARNING yellow, ERROR red
+LEVEL_COLORS = {
+    logging.DEBUG: "\033[96m",
+    logging.INFO: "\033[92m",
+    logging.WARNING: "\033[93m",
+    logging.ERROR: "\033[91m",
+    logging.CRITICAL: "\033[91m",
+}
+END_COLOR = "\033[0m"
+# attributes every LogRecord has, anything else was passed with extra={...} and goes into json output
+STANDARD_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_setup_lock = threading.Lock()
+_configured = False
+
+
+class Lazy:
+    """Calls func(*args) only when the log record is formatted, eg Lazy(lambda: len(chat_history.messages))."""
+    __slots__ = ("func", "args")
+
+    def __init__(self, func: Callable[..., Any], *args: Any):
+        self.func = func
+        self.args = args
+
+    def __str__(self) -> str:
+        return str(self.func(*self.args))
+
+    __repr__ = __str__
+
+
+def lazy_pformat(obj: Any) -> Lazy:
+    """pprint obj, but only if the record is emitted."""
+    return Lazy(pprint.pformat, obj)
+
+
+class ColorFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        return f"{LEVEL_COLORS.get(record.levelno, '')}{super().format(record)}{END_COLOR}"
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with any extra={...} fields as top level keys."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in STANDARD_RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps only sample_rate of the DEBUG records, INFO and above are always kept."""
+
+    def __init__(self, sample_rate: float):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > logging.DEBUG or random.random() < self.sample_rate
+
+
+def default_level() -> str:
+    level = os.getenv("LOG_LEVEL")
+    if level:
+        return level.upper()
+    return "DEBUG" if os.getenv("DEBUG_PRINT", "").lower() in ("1", "true", "yes") else "INFO"
+
+
+def setup_logging(level: Optional[str | int] = None, fmt: Optional[str] = None,
+                  sample_rate: Optional[float] = None, stream: Optional[TextIO] = None,
+                  force: bool = False) -> logging.Logger:
+    """Configure the toolchat7 logger. Arguments default to the env variables described above.
+    Only the first call configures logging, unless force=True.
+    """
+    global _configured
+    logger = logging.getLogger(ROOT_LOGGER_NAME)
+    with _setup_lock:
+        if _configured and not force:
+            return logger
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+
+        handler = logging.StreamHandler(stream or sys.stdout)
+        fmt = fmt or os.getenv("LOG_FORMAT", "color")
+        handler.setFormatter(JsonFormatter() if fmt == "json" else ColorFormatter())
+        logger.addHandler(handler)
+        logger.setLevel(level or default_level())
+        sample_rate = float(os.getenv("LOG_SAMPLE_RATE", "1.0")) if sample_rate is None else sample_rate
+        if sample_rate < 1.0:
+            # on the handler, logger filters do not apply to records from child loggers
+            handler.addFilter(SamplingFilter(sample_rate))
+        # toolchat7 records are handled here only, not again by the root logger
+        logger.propagate = False
+        _configured = True
+    return logger
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Logger for a module, eg log = get_logger(__name__)"""
+    setup_logging()
+    return logging.getLogger(f"{ROOT_LOGGER_NAME}.{name}")
@@ -0,0 +1,16 @@
+from langchain_core.messages import AIMessage
+from langchain_core.tools import BaseTool
+from services.tool_manager import ToolManager
+
+
+def make_tool_manager(*tools: BaseTool, **kwargs) -> ToolManager:
+    """ToolManager(**kwargs) that also knows the test's own tools, next to the built in ones."""
+    manager = ToolManager(**kwargs)
+    for t in tools:
+        manager.tools_by_name[t.name] = t
+    return manager
+
+def ai_message_with_calls(*calls) -> AIMessage:
+    """AIMessage calling each (tool name, args) in calls, with ids call_0, call_1, ..."""
+    return AIMessage(content="", tool_calls=[
+        {"name": name, "args": args, "id": f"call_{i}"} for i, (name, args) in enumerate(calls)])
@@ -0,0 +1,103 @@
+import asyncio
+import json
+from langchain_core.messages import AIMessage
+from api_server import ChatAPI
+from services.chat_history import InMemoryChatHistoryManager
+from services.resilience import ResilienceEvent
+from services.session_manager import SessionManager
+
+
+class FakeService:
+    """Answers with the number of human messages in the session, so tests can tell sessions apart."""
+
+    def get_system_message(self):
+        return "be helpful"
+
+    async def agenerate_response(self, content, chat_history, on_event=None):
+        chat_history.add_human_message(content)
+        answer = AIMessage(content=f"answer {sum(m.type == 'human' for m in chat_history.messages)}")
+        chat_history.add_ai_message(answer)
+        return answer
+
+    def stream_response_langchain(self, content, chat_history, on_event=None):
+        chat_history.add_human_message(content)
+        on_event(ResilienceEvent("retry", "m", 1, "ReadTimeout()", 0.2))
+        for word in ("It ", "is ", "foggy."):
+            yield word
+        chat_history.add_ai_message("It is foggy.")
+
+
+def make_app(**kwargs) -> ChatAPI:
+    return ChatAPI(service_factory=FakeService, history_factory=lambda session_id: InMemoryChatHistoryManager(),
+                   **kwargs)
+
+async def call(app, method, path, body=None, query=b""):
+    requests = [{"type": "http.request", "body": json.dumps(body).encode() if body is not None else b""}]
+    sent = []
+
+    async def receive():
+        return requests.pop(0) if requests else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    await app({"type": "http", "method": method, "path": path, "query_string": query}, receive, send)
+    return sent[0]["status"], b"".join(m.get("body", b"") for m in sent[1:])
+
+
+def test_chat_keeps_history_per_session():
+    async def run():
+        app = make_app()
+        assert (await call(app, "POST", "/v1/sessions/a/chat", {"content": "hi"}))[1].count(b"answer 1")
+        status, body = await call(app, "POST", "/v1/sessions/a/chat", {"content": "again"})
+        assert status == 200
+        assert json.loads(body)["content"] == "answer 2"
+        assert json.loads((await call(app, "POST", "/v1/sessions/b/chat", {"content": "hi"}))[1])["content"] == "answer 1"
+        status, body = await call(app, "GET", "/v1/sessions/a/history")
+        assert [m["type"] for m in json.loads(body)["messages"]] == ["system", "human", "ai", "human", "ai"]
+        assert (await call(app, "DELETE", "/v1/sessions/a"))[0] == 204
+        assert (await call(app, "GET", "/v1/sessions/a/history"))[0] == 404
+    asyncio.run(run())
+
+def test_stream_sends_deltas_as_server_sent_events():
+    async def run():
+        app = make_app()
+        status, body = await call(app, "POST", "/v1/sessions/s/stream", {"content": "weather?"})
+        assert status == 200
+        events = [e for e in body.decode().split("\n\n") if e]
+        assert events[0].startswith("event: resilience\n")
+        assert json.loads(events[0].partition("data: ")[2])["message"] == "Retrying m in 0.2s after ReadTimeout()"
+        deltas = [json.loads(e.removeprefix("data: "))["delta"] for e in events[1:-1]]
+        assert "".join(deltas) == "It is foggy."
+        assert events[-1].startswith("event: done")
+        status, body = await call(app, "GET", "/v1/sessions/s/history", query=b"format=ndjson")
+        assert [json.loads(line)["type"] for line in body.decode().splitlines()] == ["system", "human", "ai"]
+    asyncio.run(run())
+
+def test_rejects_bad_requests_and_overload():
+    async def run():
+        app = make_app(max_concurrency=1, max_waiting=0)
+        assert (await call(app, "POST", "/v1/sessions/a/chat", {"text": "hi"}))[0] == 400
+        assert (await call(app, "GET", "/v1/nope"))[0] == 404
+        assert (await call(app, "GET", "/v1/sessions/a/chat"))[0] == 405
+        async with app.turn_slot():
+            assert (await call(app, "POST", "/v1/sessions/a/chat", {"content": "hi"}))[0] == 503
+    asyncio.run(run())
+
+def test_evicted_session_is_still_served_and_deleted(tmp_path):
+    async def run():
+        manager = SessionManager(spill_dir=tmp_path)
+        app = ChatAPI(service_factory=FakeService, max_sessions=1, history_factory=manager.history,
+                      history_lookup=manager.find)
+        await call(app, "POST", "/v1/sessions/a/chat", {"content": "hi"})
+        await call(app, "POST", "/v1/sessions/b/chat", {"content": "hi"})
+        assert list(app.sessions) == ["b"]
+        status, body = await call(app, "GET", "/v1/sessions/a/history")
+        assert status == 200 and len(json.loads(body)["messages"]) == 3
+        assert (await call(app, "DELETE", "/v1/sessions/a"))[0] == 204
+        assert (await call(app, "GET", "/v1/sessions/a/history"))[0] == 404
+        # unknown ids are not added to the session manager
+        assert (await call(app, "GET", "/v1/sessions/never-used/history"))[0] == 404
+        assert (await call(app, "DELETE", "/v1/sessions/never-used"))[0] == 204
+        assert manager.counts()["resident"] + manager.counts()["spilled"] == 1
+    asyncio.run(run())
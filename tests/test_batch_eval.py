@@ -0,0 +1,63 @@
+import asyncio
+from pathlib import Path
+from langchain_core.messages import AIMessage
+from batch_eval import completed_ids, load_conversations, open_results, parse_conversation, run_batch
+
+
+CONVERSATIONS_DIR = Path(__file__).parent / "conversations"
+
+
+class FakeService:
+    def __init__(self):
+        self.calls = 0
+
+    def get_system_message(self):
+        return "be helpful"
+
+    async def agenerate_response(self, content, chat_history):
+        self.calls += 1
+        chat_history.add_human_message(content)
+        if "boom" in content:
+            raise RuntimeError("LLM down")
+        answer = AIMessage(content="It's 60 degrees and foggy." if "San Francisco" in content else "No idea.")
+        chat_history.add_ai_message(answer)
+        return answer
+
+
+def test_parse_conversation():
+    conversation = parse_conversation("weather.tsv", (CONVERSATIONS_DIR / "weather.tsv").read_text().splitlines())
+    assert [t.human for t in conversation.turns] == ["What is the weather in San Francisco?", "What about in Chicago?"]
+    assert conversation.turns[0].expect == ["foggy"]
+    multiline = parse_conversation("x", ["human\tline one\\nline two", "ai\tok"])
+    assert multiline.turns[0].human == "line one\nline two"
+    assert multiline.turns[0].reference == "ok"
+
+def test_run_batch_writes_results_and_resume_skips_them(tmp_path):
+    conversations = [
+        parse_conversation("weather.tsv", (CONVERSATIONS_DIR / "weather.tsv").read_text().splitlines()),
+        parse_conversation("error.tsv", ["human\tboom"]),
+    ]
+    out_path = tmp_path / "results.jsonl"
+    with open(out_path, "w") as out:
+        results = asyncio.run(run_batch(FakeService(), conversations, out, workers=2))
+    by_id = {r["conversation"]: r for r in results}
+    assert by_id["weather.tsv"]["status"] == "ok"
+    assert [t["passed"] for t in by_id["weather.tsv"]["turns"]] == [True, False]
+    assert by_id["error.tsv"]["status"] == "error"
+
+    with open(out_path, "a") as out:
+        out.write('{"status": "ok"}\n')  # not a result
+        out.write('{"conversation": "partial')  # interrupted mid line
+    assert completed_ids(out_path, retry_errors=False) == {"weather.tsv", "error.tsv"}
+    assert completed_ids(out_path, retry_errors=True) == {"weather.tsv"}
+    with open_results(out_path, restart=False) as out:
+        out.write('{"conversation": "next.tsv"}\n')
+    assert "next.tsv" in completed_ids(out_path, retry_errors=False)
+
+def test_malformed_file_is_an_error_result(tmp_path):
+    (tmp_path / "good.tsv").write_text("human\thi\n")
+    (tmp_path / "bad.tsv").write_text("expect\tfoggy\nhuman\thi\n")
+    conversations, errors = load_conversations(sorted(tmp_path.glob("*.tsv")), done=set())
+    assert [c.turns[0].human for c in conversations] == ["hi"]
+    assert len(errors) == 1 and errors[0]["status"] == "error" and not errors[0]["passed"]
+    assert errors[0]["error"].endswith("line 1: expect before the first human message")
@@ -1,6 +1,7 @@
 import pytest
 from services.chat_history import ChatHistoryManager
 import json
+from langchain_core.messages import AIMessage, ToolMessage
 
 def test_append_valid_message():
     manager = ChatHistoryManager()
@@ -17,21 +18,69 @@ def test_append_invalid_message():
     with pytest.raises(ValueError):
         manager.append_message({"role": "user"})  # missing content
         
+def make_tool_conversation(manager: ChatHistoryManager) -> None:
+    manager.clear()
+    manager.add_system_message("system prompt")
+    manager.add_human_message("Hello")
+    manager.add_ai_message(AIMessage(content="", tool_calls=[{"name": "get_weather", "args": {"location": "SF"}, "id": "call_1"}]))
+    manager.add_tool_message(ToolMessage(content="foggy", name="get_weather", tool_call_id="call_1"))
+    manager.add_ai_message("It is foggy.")
+
 def test_export_import_json():
     manager = ChatHistoryManager()
-    message = {"role": "user", "content": "Hello"}
-    manager.append_message(message)
+    make_tool_conversation(manager)
+    original = list(manager.messages)
     
     json_str = manager.export_json()
     
     new_manager = ChatHistoryManager()
     new_manager.import_json(json_str)
     
-    assert len(new_manager.messages) == 1
-    assert new_manager.messages[0]["role"] == "user"
-    assert new_manager.messages[0]["content"] == "Hello"
+    assert new_manager.messages == original
+    assert new_manager.messages[2].tool_calls[0]["args"] == {"location": "SF"}
+    assert new_manager.messages[3].tool_call_id == "call_1"
+
+def test_export_import_ndjson():
+    manager = ChatHistoryManager()
+    make_tool_conversation(manager)
+    original = list(manager.messages)
+    lines = list(manager.export_ndjson())
+    assert len(lines) == len(original)
+
+    manager.import_ndjson(line.encode() for line in lines)
+    assert manager.messages == original
+    assert [m.type for m in manager.get_just_ai_human_message()] == ["human", "ai"]
+
+def test_import_ndjson_invalid_line_keeps_history():
+    manager = ChatHistoryManager()
+    make_tool_conversation(manager)
+    original = list(manager.messages)
+    with pytest.raises(ValueError):
+        manager.import_ndjson(['{"type": "human", "content": "hi"}\n', '{"no type": 1}\n'])
+    assert manager.messages == original
+
+def test_import_legacy_json():
+    manager = ChatHistoryManager()
+    manager.import_json('[{"type": "human", "content": "Hello"}, {"type": "ai", "content": "Hi"}]')
+    assert [(m.type, m.content) for m in manager.messages] == [("human", "Hello"), ("ai", "Hi")]
 
 def test_import_invalid_json():
     manager = ChatHistoryManager()
     with pytest.raises(ValueError):
-        manager.import_json('{"not": "a list"}') 
\ No newline at end of file
+        manager.import_json('{"not": "a list"}')
+
+def test_display_view_is_incremental():
+    manager = ChatHistoryManager()
+    manager.clear()
+    manager.add_system_message("system prompt")
+    manager.add_human_message("Hello")
+    view = manager.get_just_ai_human_message()
+    assert view == [("human", "Hello")]
+    manager.add_ai_message(AIMessage(content="", tool_calls=[{"name": "get_coolest_cities", "args": {}, "id": "1"}]))
+    manager.add_tool_message(ToolMessage(content="nyc, sf", tool_call_id="1"))
+    manager.add_ai_message("NYC and SF")
+    assert manager.get_just_ai_human_message() is view
+    assert [m.type for m in view] == ["human", "ai"]
+    manager.clear()
+    manager.add_human_message("Again")
+    assert manager.get_just_ai_human_message() == [("human", "Again")]
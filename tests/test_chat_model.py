@@ -1,6 +1,10 @@
+import asyncio
 import pytest
 from services.chat_model import ChatModelService
-from unittest.mock import Mock, patch
+from unittest.mock import AsyncMock, Mock, patch
+from langchain_core.messages import AIMessage, AIMessageChunk, ToolMessage
+from services.chat_history import ChatHistoryManager
+from services.response_cache import ResponseCache
 
 def test_chat_model_initialization():
     service = ChatModelService("fake-api-key")
@@ -30,4 +34,75 @@ def test_generate_response_real():
     messages = [{"role": "user", "content": "Hello"}]
     response = service.generate_response(messages)
     assert isinstance(response, str)
-    assert len(response) > 0 
\ No newline at end of file
+    assert len(response) > 0 
+
+
+def make_service_with_mock_llm() -> ChatModelService:
+    service = ChatModelService("fake-api-key")
+    service.chat_llm = Mock()
+    # the history lives in st.session_state, shared by every test in the process
+    history = ChatHistoryManager()
+    history.clear()
+    service.set_chat_history(history)
+    return service
+
+def test_stream_response_yields_deltas_and_runs_tools():
+    service = make_service_with_mock_llm()
+    tool_call_chunks = [
+        AIMessageChunk(content="", tool_call_chunks=[
+            {"name": "get_weather", "args": '{"locat', "id": "call_1", "index": 0}]),
+        AIMessageChunk(content="", tool_call_chunks=[
+            {"name": None, "args": 'ion": "SF"}', "id": None, "index": 0}]),
+    ]
+    text_chunks = [AIMessageChunk(content="It is "), AIMessageChunk(content="foggy.")]
+    service.chat_llm.stream.side_effect = [iter(tool_call_chunks), iter(text_chunks)]
+
+    deltas = list(service.stream_response_langchain("What is the weather in SF?"))
+
+    assert deltas == ["It is ", "foggy."]
+    assert service.chat_llm.stream.call_count == 2
+    messages = service.chat_history.messages
+    assert [m.type for m in messages] == ["system", "human", "ai", "tool", "ai"]
+    assert messages[2].tool_calls[0]["args"] == {"location": "SF"}
+    assert isinstance(messages[3], ToolMessage)
+    assert messages[3].tool_call_id == "call_1"
+    assert type(messages[4]) is AIMessage  # not an AIMessageChunk
+    assert messages[4].content == "It is foggy."
+
+
+def test_agenerate_response_runs_async_tool_loop():
+    service = make_service_with_mock_llm()
+    service.chat_llm.ainvoke = AsyncMock(side_effect=[
+        AIMessage(content="", tool_calls=[{"name": "get_coolest_cities", "args": {}, "id": "call_1"}]),
+        AIMessage(content="NYC and SF."),
+    ])
+    other_history = ChatHistoryManager()
+    other_history.clear()
+
+    response = asyncio.run(service.agenerate_response("Coolest cities?", chat_history=other_history))
+
+    assert response.content == "NYC and SF."
+    assert [m.type for m in other_history.messages] == ["human", "ai", "tool", "ai"]
+    assert other_history.messages[2].content == "nyc, sf"
+
+def test_response_cache_replays_tool_loop_without_llm_calls():
+    service = make_service_with_mock_llm()
+    service.set_response_cache(ResponseCache())
+    tool_call_msg = AIMessage(content="", tool_calls=[{"name": "get_weather", "args": {"location": "SF"}, "id": "call_1"}])
+    service.chat_llm.invoke.side_effect = [tool_call_msg, AIMessage(content="It is foggy.")]
+    assert service.generate_response_langchain("Weather in SF?").content == "It is foggy."
+
+    service.set_chat_history(ChatHistoryManager())
+    service.chat_history.clear()
+    service.chat_history.add_system_message(service.get_system_message())
+    assert service.generate_response_langchain("Weather in SF?").content == "It is foggy."
+    assert service.chat_llm.invoke.call_count == 2
+    assert [m.type for m in service.chat_history.messages] == ["system", "human", "ai", "tool", "ai"]
+
+def test_construction_defers_client_and_bind_tools():
+    with patch.object(ChatModelService, "get_model") as get_model:
+        service = ChatModelService("fake-api-key")
+        get_model.assert_not_called()
+        service.chat_llm
+        get_model.assert_called_once()
+        get_model.return_value.bind_tools.assert_called_once_with(service.tool_manager.working_tools)
@@ -0,0 +1,36 @@
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+from services.context_window import ContextWindowBuilder, count_message_tokens, get_model_context_length
+
+
+def tool_turn(i: int, size: int = 400):
+    return [
+        HumanMessage(content=f"question {i}"),
+        AIMessage(content="", tool_calls=[{"name": "get_weather", "args": {"location": str(i)}, "id": f"call_{i}"}]),
+        ToolMessage(content="x" * size, tool_call_id=f"call_{i}", name="get_weather"),
+        AIMessage(content=f"answer {i}"),
+    ]
+
+def test_fits_budget_returns_messages_unchanged():
+    messages = [SystemMessage(content="sys")] + tool_turn(1)
+    assert ContextWindowBuilder(100000).build(messages) is messages
+
+def test_drops_old_tool_exchanges_first():
+    messages = [SystemMessage(content="sys")] + tool_turn(1) + tool_turn(2) + [HumanMessage(content="latest")]
+    budget = sum(count_message_tokens(m) for m in messages) - 1
+    context = ContextWindowBuilder(budget).build(messages)
+    assert context[0].type == "system"
+    assert [m.content for m in context if m.type in ("human", "ai") and m.content] == \
+        ["question 1", "answer 1", "question 2", "answer 2", "latest"]
+    # dropped exactly one tool exchange, and never split an AIMessage from its ToolMessage
+    assert [m.type for m in context].count("tool") == 1
+    tool_idx = [m.type for m in context].index("tool")
+    assert context[tool_idx - 1].tool_calls[0]["id"] == context[tool_idx].tool_call_id
+
+def test_drops_oldest_turns_when_needed():
+    messages = [SystemMessage(content="sys")] + tool_turn(1) + tool_turn(2) + tool_turn(3)
+    keep = [messages[0]] + messages[-4:]
+    context = ContextWindowBuilder(sum(count_message_tokens(m) for m in keep)).build(messages)
+    assert context == keep
+
+def test_model_context_length_from_docs():
+    assert get_model_context_length("meta-llama/Llama-3.3-70B-Instruct-Turbo") == 131072
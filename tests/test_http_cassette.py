@@ -0,0 +1,78 @@
+import asyncio
+import json
+import time
+import httpx
+from services.http_cassette import (AsyncRecordingTransport, Cassette, RecordingTransport, ReplayTransport,
+                                    async_cassette_transport)
+
+
+def streaming_api(request: httpx.Request) -> httpx.Response:
+    """Answers a chat completion with server sent events, a chunk every 50ms."""
+    body = json.loads(request.content)
+    def events():
+        for word in ["It", "is", body["messages"][-1]["content"]]:
+            time.sleep(0.05)
+            yield f"data: {json.dumps({'delta': word})}\n\n".encode()
+        yield b"data: [DONE]\n\n"
+    return httpx.Response(200, headers={"content-type": "text/event-stream", "set-cookie": "secret"},
+                          content=events())
+
+def chat(client, text, **body):
+    payload = {"model": "m", "messages": [{"role": "user", "content": text}], **body}
+    with client.stream("POST", "https://api.together.xyz/v1/chat/completions", json=payload,
+                       headers={"authorization": "Bearer key"}) as response:
+        return response.status_code, list(response.iter_lines())
+
+def test_record_then_replay_with_original_or_no_timing(tmp_path):
+    path = tmp_path / "chat.ndjson.gz"
+    recorder = Cassette(path, mode="record")
+    with httpx.Client(transport=RecordingTransport(recorder, httpx.MockTransport(streaming_api))) as client:
+        live = chat(client, "foggy", temperature=0)
+        chat(client, "sunny")
+    recorder.close()
+    text = path.read_bytes()
+    assert b"Bearer" not in text and b"secret" not in text
+
+    for timing, slowest in (("original", None), ("none", 0.05)):
+        with httpx.Client(transport=ReplayTransport(Cassette(path, timing=timing))) as client:
+            start = time.perf_counter()
+            # JSON bodies match whatever their key order
+            replayed = chat(client, "foggy", **{"temperature": 0})
+            elapsed = time.perf_counter() - start
+        assert replayed == live
+        if slowest is None:
+            assert elapsed >= 0.15
+        else:
+            assert elapsed < slowest
+
+def test_not_recorded_request_gets_404(tmp_path):
+    path = tmp_path / "chat.ndjson"
+    path.write_text("")
+    with httpx.Client(transport=ReplayTransport(Cassette(path))) as client:
+        status, lines = chat(client, "hail")
+    assert status == 404 and "not in the HTTP cassette" in lines[0]
+
+def test_async_record_and_replay(tmp_path, monkeypatch):
+    path = tmp_path / "chat.ndjson"
+
+    async def api(request):
+        return httpx.Response(200, json={"answer": json.loads(request.content)["q"]})
+
+    async def ask(transport, questions):
+        async with httpx.AsyncClient(transport=transport) as client:
+            return [(await client.post("https://example.com/ask", json={"q": q})).json() for q in questions]
+
+    recorder = Cassette(path, mode="record")
+    assert asyncio.run(ask(AsyncRecordingTransport(recorder, httpx.MockTransport(api)), ["a", "b"])) == [
+        {"answer": "a"}, {"answer": "b"}]
+    recorder.close()
+
+    monkeypatch.setenv("HTTP_CASSETTE", str(path))
+    monkeypatch.setenv("HTTP_CASSETTE_TIMING", "none")
+    from services import http_cassette
+    http_cassette.default_cassette.cache_clear()
+    try:
+        assert asyncio.run(ask(async_cassette_transport(httpx.Limits()), ["b", "a", "b"])) == [
+            {"answer": "b"}, {"answer": "a"}, {"answer": "b"}]
+    finally:
+        http_cassette.default_cassette.cache_clear()
@@ -0,0 +1,36 @@
+import io
+import json
+import logging
+from utils import Lazy, get_logger, setup_logging
+
+
+def test_lazy_args_not_evaluated_when_level_disabled():
+    stream = io.StringIO()
+    setup_logging("INFO", fmt="color", stream=stream, force=True)
+    calls = []
+    log = get_logger("test")
+    log.debug("history: %s", Lazy(lambda: calls.append("formatted")))
+    assert calls == []
+    assert stream.getvalue() == ""
+    log.info("history: %s", Lazy(lambda: calls.append("formatted") or "ok"))
+    assert calls == ["formatted"]
+    assert "history: ok" in stream.getvalue()
+
+def test_json_format_includes_extra_fields():
+    stream = io.StringIO()
+    setup_logging("DEBUG", fmt="json", stream=stream, force=True)
+    get_logger("test").debug("tool %s done", "get_weather", extra={"duration_ms": 12})
+    entry = json.loads(stream.getvalue())
+    assert entry["level"] == "DEBUG"
+    assert entry["logger"] == "toolchat7.test"
+    assert entry["msg"] == "tool get_weather done"
+    assert entry["duration_ms"] == 12
+
+def test_sample_rate_zero_drops_debug_but_keeps_warnings():
+    stream = io.StringIO()
+    setup_logging(logging.DEBUG, fmt="json", sample_rate=0.0, stream=stream, force=True)
+    log = get_logger("test")
+    log.debug("dropped")
+    log.warning("kept")
+    lines = stream.getvalue().splitlines()
+    assert [json.loads(line)["msg"] for line in lines] == ["kept"]
@@ -0,0 +1,44 @@
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+from services.chat_history import InMemoryChatHistoryManager
+from services.message_store import CompactMessageStore
+
+
+def conversation(system_prompt="You are a helpful assistant."):
+    return [
+        SystemMessage(content=system_prompt),
+        HumanMessage(content="Weather in SF?"),
+        AIMessage(content="", tool_calls=[{"name": "get_weather", "args": {"location": "SF"}, "id": "call_1"}],
+                  response_metadata={"finish_reason": "tool_calls"}),
+        ToolMessage(content="foggy", name="get_weather", tool_call_id="call_1"),
+        AIMessage(content="It is foggy."),
+    ]
+
+def test_round_trips_messages_and_reads_build_copies():
+    messages = conversation()
+    store = CompactMessageStore(messages)
+    assert store == messages and list(store) == messages
+    assert store[-1] == messages[-1] and store[1:3] == messages[1:3]
+    assert store[2].tool_calls[0]["args"] == {"location": "SF"}
+    assert [store.type_at(i) for i in range(len(store))] == ["system", "human", "ai", "tool", "ai"]
+
+    store[2].tool_calls[0]["args"]["location"] = "NYC"
+    assert store[2].tool_calls[0]["args"] == {"location": "SF"}
+    store.clear()
+    assert len(store) == 0
+
+def test_sessions_share_the_system_prompt():
+    prompt = " ".join(["You are a helpful assistant"] * 20)
+    copy = " ".join(prompt.split())
+    assert copy == prompt and copy is not prompt
+    first = CompactMessageStore(conversation(prompt))
+    second = CompactMessageStore(conversation(copy))
+    assert first.content_at(0) is second.content_at(0)
+
+def test_in_memory_manager_keeps_messages_compact():
+    manager = InMemoryChatHistoryManager(conversation())
+    assert isinstance(manager.messages, CompactMessageStore)
+    assert manager.messages == conversation()
+    assert [(m.type, m.content) for m in manager.get_just_ai_human_message()] == [
+        ("human", "Weather in SF?"), ("ai", "It is foggy.")]
+    manager.clear()
+    assert len(manager.messages) == 0
@@ -0,0 +1,44 @@
+from uuid import uuid4
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, LLMResult
+from services.metrics import Histogram, MetricsCallbackHandler, MetricsRegistry
+
+
+def test_histogram_buckets_and_quantile():
+    hist = Histogram((1, 2, 4))
+    for value in (0.5, 1, 1.5, 3, 10):
+        hist.observe(value)
+    assert hist.counts == [2, 1, 1, 1]
+    assert hist.count == 5
+    assert hist.sum == 16
+    assert 1 < hist.quantile(0.5) <= 2
+    assert hist.quantile(0.99) == 4
+
+def test_render_prometheus():
+    registry = MetricsRegistry()
+    registry.histogram("tool_seconds", "Tool time", (0.1, 1), tool="get_weather").observe(0.5)
+    registry.counter("errors_total", "Errors", model='m"1').inc()
+    text = registry.render_prometheus()
+    assert "# TYPE tool_seconds histogram" in text
+    assert 'tool_seconds_bucket{tool="get_weather",le="0.1"} 0' in text
+    assert 'tool_seconds_bucket{tool="get_weather",le="1"} 1' in text
+    assert 'tool_seconds_bucket{tool="get_weather",le="+Inf"} 1' in text
+    assert 'tool_seconds_count{tool="get_weather"} 1' in text
+    assert 'errors_total{model="m\\"1"} 1' in text
+
+def test_callback_handler_records_latency_ttft_and_tokens():
+    registry = MetricsRegistry()
+    handler = MetricsCallbackHandler(registry)
+    run_id = uuid4()
+    handler.on_chat_model_start({}, [[]], run_id=run_id, metadata={"ls_model_name": "llama"})
+    handler.on_llm_new_token("Hi", run_id=run_id)
+    handler.on_llm_new_token(" there", run_id=run_id)
+    message = AIMessage(content="Hi there", usage_metadata={"input_tokens": 100, "output_tokens": 2, "total_tokens": 102})
+    handler.on_llm_end(LLMResult(generations=[[ChatGeneration(message=message)]]), run_id=run_id)
+
+    rows = {row["metric"]: row for row in registry.summaries()}
+    assert rows["toolchat7_llm_call_seconds"]["count"] == 1
+    assert rows["toolchat7_llm_call_seconds"]["labels"] == "model=llama"
+    assert rows["toolchat7_llm_time_to_first_token_seconds"]["count"] == 1
+    assert rows["toolchat7_llm_prompt_tokens"]["mean"] == 100
+    assert rows["toolchat7_llm_completion_tokens"]["mean"] == 2
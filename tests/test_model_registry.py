@@ -0,0 +1,26 @@
+from services.model_registry import (ModelRegistry, load_model_index, TOGETHER_MODELS_JSON,
+                                     TOGETHERAI_LLAMA33_70B_MODEL, LLAMA3_STOPS)
+
+
+def test_model_index(tmp_path):
+    index = load_model_index.__wrapped__(TOGETHER_MODELS_JSON, tmp_path)
+    llama = index.get(TOGETHERAI_LLAMA33_70B_MODEL)
+    assert llama.type == "chat"
+    assert llama.context_length == 131072
+    assert llama in index.of_organization(llama.organization)
+    assert all(m.context_length >= 100000 for m in index.with_min_context(100000))
+    cheapest_chat = index.cheapest("chat")
+    assert cheapest_chat[0].price <= cheapest_chat[-1].price
+    # second load comes from the pickled index in tmp_path
+    assert list(tmp_path.glob("model-index-*.pickle"))
+    assert load_model_index.__wrapped__(TOGETHER_MODELS_JSON, tmp_path).by_id.keys() == index.by_id.keys()
+
+def test_clients_are_lazy_and_memoized():
+    registry = ModelRegistry()
+    assert registry.clients() == []
+    client = registry.get_client(TOGETHERAI_LLAMA33_70B_MODEL, "fake-api-key")
+    assert client.stop == LLAMA3_STOPS
+    assert client.max_retries == 0
+    assert registry.get_client(TOGETHERAI_LLAMA33_70B_MODEL, "fake-api-key") is client
+    assert registry.get_client(TOGETHERAI_LLAMA33_70B_MODEL, "fake-api-key", max_tokens=10) is not client
+    assert len(registry.clients()) == 2
@@ -0,0 +1,9 @@
+from services.rate_limit import RateLimiter
+
+
+def test_rate_limiter_allows_burst_then_spaces_requests():
+    limiter = RateLimiter(rate=10, burst=2)
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == 0
+    assert 0.09 < limiter.reserve() <= 0.1
+    assert 0.19 < limiter.reserve() <= 0.2
@@ -0,0 +1,133 @@
+import asyncio
+import time
+import pytest
+from services.resilience import ResiliencePolicy, ResilientCaller, is_transient
+from services.scheduler import _scope, request_scope
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+
+def scripted(*outcomes):
+    """attempt_fn returning or raising the outcomes in order, each a value, an exception or (seconds, value)."""
+    outcomes = list(outcomes)
+    calls = []
+
+    def attempt(model, client):
+        calls.append(model)
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, tuple):
+            time.sleep(outcome[0])
+            outcome = outcome[1]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    return attempt, calls
+
+def test_is_transient():
+    assert is_transient(StatusError(429)) and is_transient(StatusError(503)) and is_transient(TimeoutError())
+    assert not is_transient(StatusError(400)) and not is_transient(ValueError("bad args"))
+
+def test_retries_transient_errors_then_falls_back():
+    caller = ResilientCaller(ResiliencePolicy(max_retries=2, base_delay=0))
+    events = []
+    attempt, calls = scripted(StatusError(503), StatusError(503), StatusError(503), StatusError(429), "ok")
+    model, result = caller.call(attempt, [("big", None), ("medium", None), ("small", None)], events.append)
+    assert (model, result) == ("medium", "ok")
+    assert calls == ["big", "big", "big", "medium", "medium"]
+    assert [(e.kind, e.model) for e in events] == [("retry", "big"), ("retry", "big"), ("fallback", "medium"),
+                                                   ("retry", "medium")]
+
+    attempt, calls = scripted(*[TimeoutError("no")] * 5, TimeoutError("still no"))
+    with pytest.raises(TimeoutError, match="still no"):
+        caller.call(attempt, [("big", None), ("small", None)])
+    assert calls == ["big"] * 3 + ["small"] * 3
+
+def test_non_transient_error_is_not_retried_or_sent_to_other_models():
+    caller = ResilientCaller(ResiliencePolicy(max_retries=2, base_delay=0))
+    events = []
+    attempt, calls = scripted(StatusError(503), StatusError(400), "ok")
+    with pytest.raises(StatusError, match="status 400"):
+        caller.call(attempt, [("big", None), ("small", None)], events.append)
+    assert calls == ["big", "big"]
+    assert [e.kind for e in events] == ["retry"]
+
+    attempt, calls = scripted(ValueError("bad args"), "ok")
+    with pytest.raises(ValueError):
+        asyncio.run(caller.acall(lambda model, client: asyncio.sleep(0, attempt(model, client)),
+                                 [("big", None), ("small", None)]))
+    assert calls == ["big"]
+
+def test_hedged_request_answers_first():
+    caller = ResilientCaller(ResiliencePolicy(hedge=0.05))
+    events = []
+    attempt, calls = scripted((0.5, "slow"), "fast")
+    start = time.perf_counter()
+    assert caller.call(attempt, [("big", None)], events.append) == ("big", "fast")
+    assert time.perf_counter() - start < 0.4
+    assert [e.kind for e in events] == ["hedge", "hedge_won"]
+
+def test_hedged_attempts_keep_request_scope_and_deadline_starts_after_acquire():
+    caller = ResilientCaller(ResiliencePolicy(hedge=0.05))
+    scopes, acquired = [], []
+    attempt, calls = scripted((0.3, "slow"), "fast")
+
+    def scoped_attempt(model, client):
+        scopes.append(_scope.get())
+        return attempt(model, client)
+
+    def acquire():
+        # a full scheduler queue, longer than the hedge deadline
+        acquired.append(_scope.get())
+        time.sleep(0.1 if len(acquired) == 1 else 0)
+
+    events = []
+    with request_scope(session="alice", priority=2, timeout=9):
+        assert caller.call(scoped_attempt, [("big", None)], events.append, acquire=acquire) == ("big", "fast")
+    assert [(s.session, s.priority, s.timeout) for s in scopes + acquired] == [("alice", 2, 9)] * 4
+    assert [e.kind for e in events] == ["hedge", "hedge_won"]
+
+    # the queue wait alone does not trigger a hedge
+    attempt, calls = scripted("ok")
+    acquired.clear()
+    assert caller.call(attempt, [("big", None)], events.append, acquire=acquire) == ("big", "ok")
+    assert calls == ["big"]
+
+def test_async_hedge_cancels_the_slower_request():
+    caller = ResilientCaller(ResiliencePolicy(hedge=0.05))
+    cancelled = []
+
+    async def attempt(model, client):
+        delay = 0.5 if not cancelled else 0
+        cancelled.append(False)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            cancelled[0] = True
+            raise
+        return delay
+
+    events = []
+    assert asyncio.run(caller.acall(attempt, [("big", None)], events.append)) == ("big", 0)
+    assert cancelled == [True, False]
+    assert [e.kind for e in events] == ["hedge", "hedge_won"]
+
+def test_stream_retried_only_before_first_chunk():
+    caller = ResilientCaller(ResiliencePolicy(base_delay=0))
+    opened = []
+
+    def stream(model, client):
+        opened.append(model)
+        if len(opened) == 1:
+            raise StatusError(502)
+        yield "a"
+        raise StatusError(502)
+
+    model, chunks = caller.open_stream(stream, [("big", None)])
+    assert next(chunks) == "a"
+    with pytest.raises(StatusError):
+        next(chunks)
+    assert opened == ["big", "big"]
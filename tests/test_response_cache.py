@@ -0,0 +1,49 @@
+import os
+import time
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from services.response_cache import ResponseCache
+
+
+def tool_call_response():
+    return AIMessage(content="", tool_calls=[{"name": "get_weather", "args": {"location": "SF"}, "id": "call_1"}],
+                     response_metadata={"finish_reason": "tool_calls"})
+
+def test_key_depends_on_request_not_ids():
+    namespace = ResponseCache.namespace("llama", {"temperature": 0}, [])
+    first = [SystemMessage(content="be nice"), HumanMessage(content="hi", id="a")]
+    same = [SystemMessage(content="be nice"), HumanMessage(content="hi", id="b")]
+    other = [SystemMessage(content="be nice"), HumanMessage(content="hello")]
+    assert ResponseCache.make_key(namespace, first) == ResponseCache.make_key(namespace, same)
+    assert ResponseCache.make_key(namespace, first) != ResponseCache.make_key(namespace, other)
+    other_model = ResponseCache.namespace("mixtral", {"temperature": 0}, [])
+    assert ResponseCache.make_key(namespace, first) != ResponseCache.make_key(other_model, first)
+
+def test_memory_lru_replays_tool_calls():
+    cache = ResponseCache(max_entries=2)
+    cache.put("a", tool_call_response())
+    cache.put("b", AIMessage(content="B", response_metadata={"finish_reason": "stop"}))
+    cache.get("a")
+    cache.put("c", AIMessage(content="C"))  # evicts b, the least recently used
+    assert cache.get("b") is None
+    replayed = cache.get("a")
+    assert replayed.tool_calls[0]["args"] == {"location": "SF"}
+    assert replayed.tool_calls[0]["id"] == "call_1"
+    assert replayed is not cache.get("a")
+
+def test_truncated_responses_are_not_cached():
+    cache = ResponseCache()
+    cache.put("a", AIMessage(content="cut sho", response_metadata={"finish_reason": "length"}))
+    assert cache.get("a") is None
+
+def test_disk_tier_survives_new_instance_and_evicts_by_size(tmp_path):
+    cache = ResponseCache(disk_dir=tmp_path)
+    cache.put("aa1", AIMessage(content="x" * 600))
+    assert ResponseCache(disk_dir=tmp_path).get("aa1").content == "x" * 600
+
+    small = ResponseCache(disk_dir=tmp_path, max_disk_bytes=1000)
+    old = time.time() - 100
+    os.utime(tmp_path / "aa" / "aa1.json", (old, old))
+    small.put("bb1", AIMessage(content="y" * 600))
+    small.put("cc1", AIMessage(content="z" * 600))
+    assert not (tmp_path / "aa" / "aa1.json").exists()
+    assert ResponseCache(disk_dir=tmp_path).get("cc1").content == "z" * 600
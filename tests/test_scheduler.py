@@ -0,0 +1,47 @@
+import asyncio
+import time
+import pytest
+from services.metrics import metrics
+from services.scheduler import LLMScheduler, QueueTimeout, request_scope
+
+
+def drained(rps):
+    """Scheduler with an empty requests bucket, so waiters queue up and are admitted every 1/rps seconds."""
+    scheduler = LLMScheduler(rps=rps)
+    scheduler.requests.reserve(scheduler.requests.burst)
+    return scheduler
+
+async def run_requests(scheduler, requests):
+    order = []
+
+    async def request(name, session, priority):
+        with request_scope(session=session, priority=priority):
+            await scheduler.aacquire()
+        order.append(name)
+
+    await asyncio.gather(*(request(*r) for r in requests))
+    return order
+
+def test_sessions_take_turns_and_priority_goes_first():
+    order = asyncio.run(run_requests(drained(50), [("a1", "a", 0), ("a2", "a", 0), ("a3", "a", 0), ("b1", "b", 0)]))
+    assert order == ["a1", "b1", "a2", "a3"]
+    order = asyncio.run(run_requests(drained(50), [("a1", "a", 0), ("a2", "a", 0), ("urgent", "b", 1)]))
+    assert order == ["urgent", "a1", "a2"]
+
+def test_waiting_request_times_out():
+    scheduler = drained(1)
+    with request_scope(timeout=0.05), pytest.raises(QueueTimeout):
+        scheduler.acquire()
+    assert scheduler.depth() == 0
+    assert "toolchat7_llm_queue_timeouts_total" in metrics.render_prometheus()
+    assert "toolchat7_llm_queue_depth 0" in metrics.render_prometheus()
+
+def test_tokens_per_minute_settled_with_actual_usage():
+    scheduler = LLMScheduler(tpm=600)
+    assert scheduler.acquire(600) < 0.05
+    scheduler.settle(600, 100)
+    start = time.perf_counter()
+    scheduler.acquire(500)
+    assert time.perf_counter() - start < 0.05
+    # the bucket is now empty, refilling at 10 tokens a second
+    assert scheduler.tokens.wait_time(10) > 0.5
@@ -0,0 +1,87 @@
+import os
+import time
+from langchain_core.messages import AIMessage, ToolMessage
+from services.session_manager import SessionManager
+
+
+def chat(history, turns=1):
+    for i in range(turns):
+        history.add_human_message(f"Weather in SF? {i}")
+        history.add_ai_message(AIMessage(content="", tool_calls=[{"name": "get_weather", "args": {"location": "SF"},
+                                                                  "id": f"call_{i}"}]))
+        history.add_tool_message(ToolMessage(content="foggy", name="get_weather", tool_call_id=f"call_{i}"))
+        history.add_ai_message(f"It is foggy. {i}")
+
+def test_idle_session_spilled_and_reloaded_when_used(tmp_path):
+    manager = SessionManager(spill_dir=tmp_path, idle_seconds=0.05, sweep_interval=0)
+    history = manager.history("abc")
+    history.add_system_message("system prompt")
+    chat(history)
+    original = list(history.messages)
+    display = list(history.get_just_ai_human_message())
+
+    time.sleep(0.06)
+    assert manager.sweep() == 1
+    assert not history.resident and (tmp_path / "abc.ndjson.gz").exists()
+    assert manager.counts() == {"resident": 0, "spilled": 1, "resident_bytes": 0}
+
+    assert history.get_just_ai_human_message() == display
+    assert list(history.messages) == original
+    assert manager.counts()["resident"] == 1
+
+    # a new process finds the spilled session
+    other = SessionManager(spill_dir=tmp_path)
+    assert other.find("unknown") is None and other.counts()["spilled"] == 0
+    assert list(other.find("abc").messages) == original
+
+def test_least_recently_used_spilled_past_memory_limit(tmp_path):
+    manager = SessionManager(spill_dir=tmp_path, sweep_interval=3600)
+    histories = [manager.history(f"s{i}") for i in range(3)]
+    for history in histories:
+        chat(history, turns=5)
+    histories[0].add_human_message("still here")
+    manager.max_resident_bytes = histories[0].nbytes + histories[1].nbytes
+    assert manager.sweep() == 1
+    assert [h.resident for h in histories] == [True, False, True]
+
+def test_sweep_while_adding_messages_keeps_them(tmp_path):
+    # every use sweeps and every session is over the limit, including the one being written to
+    manager = SessionManager(spill_dir=tmp_path, max_resident_bytes=1, sweep_interval=0)
+    history = manager.history("s1")
+    for i in range(5):
+        history.add_human_message(f"m{i}")
+    manager.history("s2").add_human_message("other")
+    assert not history.resident
+    assert [m.content for m in SessionManager(spill_dir=tmp_path).history("s1").messages] == [f"m{i}" for i in range(5)]
+
+def test_clear_and_forget_delete_the_spill_file(tmp_path):
+    manager = SessionManager(spill_dir=tmp_path, idle_seconds=0, sweep_interval=3600)
+    history = manager.history("abc")
+    chat(history)
+    manager.sweep()
+    history.clear()
+    assert len(history.messages) == 0 and not (tmp_path / "abc.ndjson.gz").exists()
+
+    chat(history)
+    manager.sweep()
+    manager.forget("abc")
+    assert not (tmp_path / "abc.ndjson.gz").exists()
+    assert len(manager.history("abc").messages) == 0
+
+def test_expired_spill_file_of_id_with_unsafe_characters(tmp_path):
+    manager = SessionManager(spill_dir=tmp_path, spill_ttl=60, sweep_interval=3600)
+    history = manager.history("user@example.com")
+    chat(history)
+    assert history.spill()
+    path = manager.spill_path("user@example.com")
+    assert path.name == "user_example.com.ndjson.gz"
+    assert len(history.messages) == 4  # reloaded, and not dirty, so its file is not written again
+    os.utime(path, (time.time() - 120, time.time() - 120))
+    manager.sweep()
+    assert path.exists()
+
+    assert history.spill()
+    os.utime(path, (time.time() - 120, time.time() - 120))
+    manager.sweep()
+    assert not path.exists()
+    assert manager.counts()["spilled"] == 0
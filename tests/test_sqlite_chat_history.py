@@ -0,0 +1,71 @@
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+from services.context_window import ContextWindowBuilder, count_message_tokens
+from services.sqlite_chat_history import SQLiteChatHistoryManager
+
+
+def add_turns(history: SQLiteChatHistoryManager, count: int) -> None:
+    history.add_system_message("system prompt")
+    for i in range(count):
+        history.add_human_message(f"question {i}")
+        history.add_ai_message(AIMessage(content="", tool_calls=[{"name": "get_weather", "args": {"location": str(i)}, "id": f"call_{i}"}]))
+        history.add_tool_message(ToolMessage(content=f"weather {i}", name="get_weather", tool_call_id=f"call_{i}"))
+        history.add_ai_message(f"answer {i}")
+
+def test_persists_across_instances(tmp_path):
+    db_path = tmp_path / "history.sqlite3"
+    history = SQLiteChatHistoryManager("session-1", db_path, page_size=3)
+    add_turns(history, 3)
+    SQLiteChatHistoryManager("session-2", db_path).add_human_message("other session")
+
+    resumed = SQLiteChatHistoryManager("session-1", db_path, page_size=3)
+    assert resumed.message_count == 13
+    assert resumed.messages == history.messages
+    assert resumed.messages[2].tool_calls[0]["id"] == "call_0"
+    assert [m.content for m in resumed.recent_messages(2)] == ["weather 2", "answer 2"]
+    assert [m.content for m in resumed.get_just_ai_human_message()] == \
+        ["question 0", "answer 0", "question 1", "answer 1", "question 2", "answer 2"]
+    resumed.add_human_message("question 3")
+    assert history.messages[-1].content == "question 3"
+
+def test_two_managers_share_a_session(tmp_path):
+    # eg two browser tabs with the same ?session= url, or the API server and streamlit sharing the database
+    db_path = tmp_path / "history.sqlite3"
+    tab1 = SQLiteChatHistoryManager("session-1", db_path)
+    tab2 = SQLiteChatHistoryManager("session-1", db_path)
+    tab1.add_human_message("from tab 1")
+    assert [m.content for m in tab2.get_just_ai_human_message()] == ["from tab 1"]
+    tab2.add_human_message("from tab 2")
+    tab1.add_ai_message("answer in tab 1")
+    tab2.add_ai_message("answer in tab 2")
+    expected = ["from tab 1", "from tab 2", "answer in tab 1", "answer in tab 2"]
+    assert [m.content for m in tab1.messages] == expected
+    assert [m.content for m in tab2.recent_messages(2)] == expected[2:]
+    assert [m.content for m in tab1.get_just_ai_human_message()] == expected
+    assert [m.content for m in tab2.get_just_ai_human_message()] == expected
+
+def test_context_messages_load_only_recent_pages(tmp_path):
+    history = SQLiteChatHistoryManager("session-1", tmp_path / "history.sqlite3", page_size=4)
+    add_turns(history, 20)
+    history.add_human_message("latest")
+    last_turn = history.messages[-5:]
+    budget = sum(count_message_tokens(m) for m in [history.messages[0]] + last_turn)
+
+    context = history.get_context_messages(ContextWindowBuilder(budget))
+
+    assert isinstance(context[0], SystemMessage)
+    assert isinstance(context[1], HumanMessage)
+    assert context[-3:] == [last_turn[0], last_turn[3], last_turn[4]]
+    assert len(context) < 20
+    for i, msg in enumerate(context):
+        if isinstance(msg, ToolMessage):
+            assert context[i - 1].tool_calls[0]["id"] == msg.tool_call_id
+
+def test_export_import_ndjson(tmp_path):
+    history = SQLiteChatHistoryManager("session-1", tmp_path / "history.sqlite3")
+    add_turns(history, 2)
+    lines = list(history.export_ndjson())
+    copy = SQLiteChatHistoryManager("session-copy", tmp_path / "history.sqlite3")
+    copy.import_ndjson(lines)
+    assert copy.messages == history.messages
+    copy.clear()
+    assert copy.messages == []
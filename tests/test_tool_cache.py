@@ -0,0 +1,60 @@
+import threading
+import time
+from langchain_core.messages import ToolMessage
+from services.tool_cache import ToolCachePolicy, ToolResultCache
+
+
+def counting_run(calls: list, delay: float = 0):
+    def run(tool_call):
+        calls.append(tool_call["id"])
+        time.sleep(delay)
+        return ToolMessage(content=f"result {tool_call['args']}", name=tool_call["name"], tool_call_id=tool_call["id"])
+    return run
+
+def call(call_id: str, **args):
+    return {"name": "echo", "args": args, "id": call_id, "type": "tool_call"}
+
+def test_key_ignores_argument_order_and_casefolds():
+    cache = ToolResultCache({"echo": ToolCachePolicy(ttl=60, casefold=True)})
+    assert cache.make_key("echo", {"a": "SF", "b": 1}) == cache.make_key("echo", {"b": 1, "a": "sf"})
+
+def test_ttl_expiry_and_lru_eviction():
+    cache = ToolResultCache({"echo": ToolCachePolicy(ttl=0.05, maxsize=2)})
+    calls = []
+    run = counting_run(calls)
+    cache.get_or_run(call("1", x=1), run)
+    cache.get_or_run(call("2", x=2), run)
+    cache.get_or_run(call("3", x=1), run)  # hit, x=1 becomes most recently used
+    cache.get_or_run(call("4", x=3), run)  # evicts x=2
+    cache.get_or_run(call("5", x=2), run)
+    assert calls == ["1", "2", "4", "5"]
+    assert cache.stats()["echo"]["evictions"] == 2
+    time.sleep(0.06)
+    cache.get_or_run(call("6", x=1), run)
+    assert calls[-1] == "6"
+
+def test_single_flight_runs_tool_once():
+    cache = ToolResultCache({"echo": ToolCachePolicy(ttl=60)})
+    calls = []
+    run = counting_run(calls, delay=0.2)
+    results = {}
+    def worker(call_id):
+        results[call_id] = cache.get_or_run(call(call_id, x=1), run)
+    threads = [threading.Thread(target=worker, args=(str(i),)) for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    assert {r.tool_call_id for r in results.values()} == {"0", "1", "2", "3", "4"}
+    assert cache.stats()["echo"]["coalesced"] == 4
+
+def test_errors_are_not_cached():
+    cache = ToolResultCache({"echo": ToolCachePolicy(ttl=60)})
+    calls = []
+    def run(tool_call):
+        calls.append(tool_call["id"])
+        return ToolMessage(content="Error", name="echo", tool_call_id=tool_call["id"], status="error")
+    cache.get_or_run(call("1", x=1), run)
+    cache.get_or_run(call("2", x=1), run)
+    assert calls == ["1", "2"]
@@ -0,0 +1,78 @@
+import asyncio
+import time
+from langchain_core.messages import AIMessage, ToolMessage
+from langchain_core.tools import tool
+from services.tool_output import ToolOutputPolicy, full_content
+from tests.conftest import ai_message_with_calls, make_tool_manager
+
+
+@tool
+def slow_echo(text: str, delay: float):
+    """Echo text after a delay."""
+    time.sleep(delay)
+    return text
+
+
+@tool
+async def async_echo(text: str):
+    """Echo text asynchronously."""
+    await asyncio.sleep(0.01)
+    return text
+
+
+def test_execute_tool_calls_in_order():
+    manager = make_tool_manager(slow_echo, async_echo)
+    msg = ai_message_with_calls(("get_weather", {"location": "SF"}), ("get_coolest_cities", {}))
+    responses = manager.execute_tool_calls(msg)
+    assert [r.tool_call_id for r in responses] == ["call_0", "call_1"]
+    assert "foggy" in responses[0].content
+    assert responses[1].content == "nyc, sf"
+
+def test_execute_tool_calls_runs_in_parallel():
+    manager = make_tool_manager(slow_echo, async_echo)
+    msg = ai_message_with_calls(*[("slow_echo", {"text": str(i), "delay": 0.3}) for i in range(4)])
+    start = time.monotonic()
+    responses = manager.execute_tool_calls(msg)
+    assert time.monotonic() - start < 0.9
+    assert [r.content for r in responses] == ["0", "1", "2", "3"]
+
+def test_execute_tool_calls_timeout_and_errors():
+    manager = make_tool_manager(slow_echo, async_echo, tool_timeouts={"slow_echo": 0.1})
+    msg = ai_message_with_calls(("slow_echo", {"text": "late", "delay": 0.5}), ("no_such_tool", {}),
+                                ("get_weather", {}), ("async_echo", {"text": "hi"}))
+    responses = manager.execute_tool_calls(msg)
+    assert all(isinstance(r, ToolMessage) for r in responses)
+    assert [r.status for r in responses] == ["error", "error", "error", "success"]
+    assert "timed out" in responses[0].content
+    assert "not a valid tool" in responses[1].content
+    assert responses[3].content == "hi"
+
+def test_aexecute_tool_calls():
+    manager = make_tool_manager(slow_echo, async_echo, tool_timeouts={"slow_echo": 0.1})
+    msg = ai_message_with_calls(("async_echo", {"text": "a"}), ("slow_echo", {"text": "b", "delay": 0}),
+                                ("slow_echo", {"text": "late", "delay": 0.5}))
+    responses = asyncio.run(manager.aexecute_tool_calls(msg))
+    assert [r.content for r in responses[:2]] == ["a", "b"]
+    assert responses[2].status == "error"
+
+def test_tool_cache_hit_uses_new_tool_call_id():
+    manager = make_tool_manager(slow_echo, async_echo)
+    first = manager.execute_tool_calls(ai_message_with_calls(("get_weather", {"location": "SF"})))
+    second = manager.execute_tool_calls(AIMessage(content="", tool_calls=[
+        {"name": "get_weather", "args": {"location": "SF"}, "id": "call_other"}]))
+    assert second[0].content == first[0].content
+    assert second[0].tool_call_id == "call_other"
+    # get_weather repeats the location as given, so other casing is another result
+    third = manager.execute_tool_calls(ai_message_with_calls(("get_weather", {"location": "sf"})))
+    assert third[0].content == "It's 60 degrees and foggy in sf."
+    assert manager.tool_cache.stats()["get_weather"]["hits"] == 1
+    assert manager.tool_cache.stats()["get_weather"]["misses"] == 2
+
+def test_large_output_limited_with_full_output_in_artifact():
+    manager = make_tool_manager(slow_echo, async_echo, output_policies={"async_echo": ToolOutputPolicy(max_chars=100)})
+    text = "word " * 100
+    msg = ai_message_with_calls(("slow_echo", {"text": text, "delay": 0}), ("async_echo", {"text": text}))
+    for responses in (manager.execute_tool_calls(msg), asyncio.run(manager.aexecute_tool_calls(msg))):
+        assert responses[0].content == text
+        assert len(responses[1].content) <= 100
+        assert full_content(responses[1]) == text
@@ -0,0 +1,42 @@
+import json
+from langchain_core.messages import ToolMessage
+from services.tool_output import ToolOutputLimiter, ToolOutputPolicy, full_content
+
+
+def tool_message(content, name="search", **kwargs):
+    return ToolMessage(content=content, name=name, tool_call_id="call_1", **kwargs)
+
+def test_small_output_is_left_alone():
+    limiter = ToolOutputLimiter({})
+    toolmsg = tool_message("It's 60 degrees and foggy in SF.")
+    assert limiter.limit(toolmsg) is toolmsg
+
+def test_json_projected_and_cut_to_the_items_that_fit():
+    results = [{"title": f"result {i}", "url": f"https://example.com/{i}", "body": "x" * 200} for i in range(100)]
+    content = json.dumps({"query": "weather", "results": results})
+    limiter = ToolOutputLimiter({"search": ToolOutputPolicy(max_chars=1000, fields=("title", "url"))})
+    limited = limiter.limit(tool_message(content))
+
+    assert len(limited.content) <= 1000
+    data, note = limited.content.split("\n", 1)
+    kept = json.loads(data)
+    assert kept["query"] == "weather"
+    assert kept["results"][0] == {"title": "result 0", "url": "https://example.com/0"}
+    assert f"kept {len(kept['results'])} of 100 list items" in note
+    assert full_content(limited) == content
+
+def test_top_items_kept_even_when_small():
+    limiter = ToolOutputLimiter({"search": ToolOutputPolicy(max_items=2)})
+    limited = limiter.limit(tool_message(json.dumps([1, 2, 3, 4])))
+    assert limited.content.startswith("[1,2]\n") and "kept 2 of 4 list items" in limited.content
+
+def test_text_summarized_or_cut_and_tool_artifact_kept():
+    content = "line of text\n" * 1000
+    summarized = ToolOutputLimiter({}, ToolOutputPolicy(max_chars=500, summarize=lambda text: "a long text")).limit(
+        tool_message(content, artifact={"rows": 1000}))
+    assert summarized.content.startswith("a long text\n[Tool output shortened")
+    assert summarized.artifact == {"full_content": content, "artifact": {"rows": 1000}}
+
+    cut = ToolOutputLimiter({}, ToolOutputPolicy(max_chars=500)).limit(tool_message(content))
+    assert len(cut.content) <= 500 and cut.content.startswith("line of text\n")
+    assert full_content(cut) == content
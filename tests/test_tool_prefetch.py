@@ -0,0 +1,69 @@
+import threading
+from unittest.mock import Mock
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.tools import tool
+from services.chat_history import InMemoryChatHistoryManager
+from services.chat_model import ChatModelService
+from services.tool_prefetch import ToolCallPrefetcher
+from tests.conftest import make_tool_manager
+
+
+def make_lookup_manager():
+    """ToolManager with a lookup tool that records its calls and may be prefetched."""
+    started = threading.Event()
+    calls = []
+
+    @tool
+    def lookup(key: str):
+        """Look up a key."""
+        calls.append(key)
+        started.set()
+        return f"value of {key}"
+
+    return make_tool_manager(lookup, cache_policies={}, prefetch_tools=["lookup"]), started, calls
+
+def chunk(args, index=0, name=None, id=None) -> AIMessageChunk:
+    return AIMessageChunk(content="", tool_call_chunks=[{"name": name, "args": args, "id": id, "index": index}])
+
+def test_started_once_args_complete_and_discarded_if_final_args_differ():
+    manager, started, calls = make_lookup_manager()
+    prefetcher = ToolCallPrefetcher(manager)
+    merged = chunk('{"key": "a', name="lookup", id="call_a")
+    prefetcher.update(merged)
+    merged += chunk('"}') + chunk('{"key": ', index=1, name="lookup", id="call_b")
+    prefetcher.update(merged)
+    assert started.wait(5) and calls == ["a"]
+
+    final = AIMessage(content="", tool_calls=[{"name": "lookup", "args": {"key": "a"}, "id": "call_a"},
+                                              {"name": "lookup", "args": {"key": "b"}, "id": "call_b"}])
+    prefetched = prefetcher.take(final)
+    assert list(prefetched) == ["call_a"]
+    responses = manager.execute_tool_calls(final, prefetched)
+    assert [r.content for r in responses] == ["value of a", "value of b"]
+    assert [r.tool_call_id for r in responses] == ["call_a", "call_b"]
+    assert sorted(calls) == ["a", "b"]
+
+    # the final message disagrees with what was streamed, eg a retried stream, so the early result is dropped
+    prefetcher.update(chunk('{"key": "c"}', name="lookup", id="call_c"))
+    other = AIMessage(content="", tool_calls=[{"name": "lookup", "args": {"key": "d"}, "id": "call_c"}])
+    assert prefetcher.take(other) == {}
+    assert manager.execute_tool_calls(other)[0].content == "value of d"
+
+def test_stream_runs_tool_while_response_still_streaming():
+    manager, started, calls = make_lookup_manager()
+    service = ChatModelService("fake-api-key")
+    service.tool_manager = manager
+    service.chat_llm = Mock()
+    service.set_chat_history(InMemoryChatHistoryManager())
+
+    def tool_call_stream():
+        yield chunk('{"key": "x"}', name="lookup", id="call_1")
+        # the rest of the message only arrives once the tool is running
+        assert started.wait(5)
+        yield AIMessageChunk(content="", response_metadata={"finish_reason": "tool_calls"})
+
+    service.chat_llm.stream.side_effect = [tool_call_stream(), iter([AIMessageChunk(content="Found it.")])]
+    assert list(service.stream_response_langchain("Look up x")) == ["Found it."]
+    assert calls == ["x"]
+    assert [m.type for m in service.chat_history.messages] == ["system", "human", "ai", "tool", "ai"]
+    assert service.chat_history.messages[3].content == "value of x"
@@ -0,0 +1,81 @@
+import sys
+from unittest.mock import Mock
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.tools import tool
+from services.tool_registry import TOOL_SELECT_ABOVE, ToolRegistry, tokenize
+
+
+PLUGIN_SOURCE = '''
+from langchain_core.tools import tool
+
+@tool
+def lookup_stock(symbol: str):
+    """Look up the latest share price of a stock ticker symbol."""
+    return f"{symbol} is at 100"
+'''
+
+@tool
+def get_weather(location: str):
+    """Call to get the current weather."""
+    return "sunny"
+
+def make_plugin(tmp_path, monkeypatch, name="stock_plugin"):
+    (tmp_path / f"{name}.py").write_text(PLUGIN_SOURCE)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    sys.modules.pop(name, None)
+    return f"{name}:lookup_stock"
+
+def filler_tools(count):
+    tools = []
+    for i in range(count):
+        def fn(x: str):
+            return x
+        fn.__name__ = f"filler_{i}"
+        fn.__doc__ = f"Filler tool number {i} for topic{i}."
+        tools.append(tool(fn))
+    return tools
+
+def test_tokenize_stems_and_drops_stop_words():
+    assert tokenize("What are the coolest Cities?") == ["coolest", "city"]
+
+def test_lazy_target_imported_on_first_use_and_schema_cached_on_disk(tmp_path, monkeypatch):
+    target = make_plugin(tmp_path, monkeypatch)
+    cache_path = tmp_path / "schemas.json"
+    registry = ToolRegistry(schema_cache_path=cache_path)
+    registry.register(target)
+    assert "lookup_stock" in registry and "stock_plugin" not in sys.modules
+    assert registry.schema("lookup_stock")["function"]["name"] == "lookup_stock"
+    assert "stock_plugin" in sys.modules
+
+    sys.modules.pop("stock_plugin")
+    other = ToolRegistry(schema_cache_path=cache_path)
+    other.register(target)
+    assert other.schema("lookup_stock") == registry.schema("lookup_stock")
+    assert "stock_plugin" not in sys.modules
+    assert other.get("lookup_stock").invoke({"symbol": "ACME"}) == "ACME is at 100"
+
+def test_selects_relevant_tools_and_keeps_tools_already_called(tmp_path, monkeypatch):
+    registry = ToolRegistry()
+    registry.register(get_weather)
+    registry.register(make_plugin(tmp_path, monkeypatch), keywords=["shares", "market"])
+    for t in filler_tools(TOOL_SELECT_ABOVE):
+        registry.register(t)
+
+    assert registry.select_for_messages([SystemMessage(content="be nice"),
+                                         HumanMessage(content="What's the share price of ACME?")]) == ("lookup_stock",)
+    history = [
+        HumanMessage(content="Weather in SF?"),
+        AIMessage(content="", tool_calls=[{"name": "get_weather", "args": {"location": "SF"}, "id": "call_1"}]),
+        HumanMessage(content="how is the market doing"),
+    ]
+    assert registry.select_for_messages(history) == ("get_weather", "lookup_stock")
+
+def test_few_tools_are_all_sent_and_bind_is_memoized():
+    registry = ToolRegistry()
+    registry.register(get_weather)
+    assert registry.select_for_messages([HumanMessage(content="hello")]) is None
+    llm = Mock()
+    assert registry.bind(llm) is registry.bind(llm)
+    assert registry.bind(llm, ("get_weather",)) is registry.bind(llm, ("get_weather",))
+    assert llm.bind_tools.call_count == 2
+    llm.bind_tools.assert_called_with([registry.schema("get_weather")])
@@ -0,0 +1,85 @@
+import asyncio
+import os
+import time
+from langchain_core.tools import tool
+from services.tool_sandbox import ToolSandbox
+from tests.conftest import ai_message_with_calls, make_tool_manager
+
+
+SANDBOXED = ["crunch", "hang", "explode"]
+
+
+@tool
+def crunch(n: int):
+    """Sum the first n integers the slow way, and say which process did it."""
+    return f"{sum(range(n))} pid={os.getpid()}"
+
+
+@tool
+def hang(seconds: float):
+    """Sleep, standing in for a tool stuck on a request."""
+    time.sleep(seconds)
+    return "woke up"
+
+
+@tool
+def explode():
+    """Fail."""
+    raise ValueError("bad input")
+
+
+def pid(toolmsg) -> int:
+    return int(toolmsg.content.rsplit("pid=", 1)[1])
+
+def test_tools_run_in_worker_processes_recycled_after_max_calls():
+    sandbox = ToolSandbox(max_workers=1, max_calls_per_worker=2)
+    manager = make_tool_manager(crunch, hang, explode, sandboxed_tools=SANDBOXED, sandbox=sandbox)
+    try:
+        first, second = manager.execute_tool_calls(ai_message_with_calls(("crunch", {"n": 10}), ("crunch", {"n": 100})))
+        assert first.content.startswith("45 ") and first.tool_call_id == "call_0"
+        assert second.content.startswith("4950 ")
+        assert pid(first) == pid(second) != os.getpid()
+        third, = asyncio.run(manager.aexecute_tool_calls(ai_message_with_calls(("crunch", {"n": 3}))))
+        assert third.content.startswith("3 ") and pid(third) != pid(first)
+
+        error, = manager.execute_tool_calls(ai_message_with_calls(("explode", {})))
+        assert error.status == "error" and "bad input" in error.content
+    finally:
+        sandbox.shutdown()
+
+def test_hung_tool_killed_and_worker_replaced():
+    sandbox = ToolSandbox(max_workers=1)
+    manager = make_tool_manager(crunch, hang, explode, sandboxed_tools=SANDBOXED, sandbox=sandbox,
+                                tool_timeouts={"hang": 0.5}, cache_policies={})
+    try:
+        # a started worker, so its start is not in the timing below
+        assert manager.execute_tool_calls(ai_message_with_calls(("hang", {"seconds": 0})))[0].content == "woke up"
+        start = time.monotonic()
+        timed_out, = manager.execute_tool_calls(ai_message_with_calls(("hang", {"seconds": 60})))
+        assert time.monotonic() - start < 5
+        assert timed_out.status == "error" and "timed out" in timed_out.content
+        # the killed worker is replaced in the background
+        for _ in range(100):
+            if sandbox.idle_workers():
+                break
+            time.sleep(0.1)
+        assert sandbox.idle_workers() == 1
+        ok, = manager.execute_tool_calls(ai_message_with_calls(("hang", {"seconds": 0})))
+        assert ok.content == "woke up"
+    finally:
+        sandbox.shutdown()
+
+def test_wait_for_worker_counts_towards_timeout():
+    sandbox = ToolSandbox(max_workers=1)
+    manager = make_tool_manager(crunch, hang, explode, sandboxed_tools=SANDBOXED, sandbox=sandbox,
+                                tool_timeouts={"hang": 2.0}, cache_policies={})
+    try:
+        manager.execute_tool_calls(ai_message_with_calls(("hang", {"seconds": 0})))
+        # one worker, so the second call runs after the first and would finish after its 2 seconds
+        first, second = manager.execute_tool_calls(ai_message_with_calls(("hang", {"seconds": 1.2}),
+                                                                          ("hang", {"seconds": 1.2})))
+        timed_out, ok = sorted([first, second], key=lambda toolmsg: toolmsg.status == "success")
+        assert ok.content == "woke up"
+        assert timed_out.status == "error" and "timed out after 2.0 seconds" in timed_out.content
+    finally:
+        sandbox.shutdown()